@@ -23,6 +23,8 @@ def main(cfg: DictConfig) -> None:
     # pr.plot_tau_comparison_responses(
     #                           base_responses, comp_responses, "ggH_htt", cfg)
 
+    # The efficiencies are loaded from the result cache (performance.result_cache)
+    # when the ntuples were evaluated before with the same cuts
     comp_eff_input_path = '/home/laurits/tmp34/normal/ggH_htt_tauID_eff.root'
     comp_fake_input_path = '/home/laurits/tmp34/normal/QCD_tauID_fake.root'
     eff_tree_path = 'Events'
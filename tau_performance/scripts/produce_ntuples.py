@@ -4,36 +4,83 @@ import hydra
 from omegaconf import DictConfig
 from tau_performance.tools import ntuple_production as npro
 from tau_performance.tools import general
+from tau_performance.tools import parallel_production as ppro
+from tau_performance.tools import caching
+
+
+def produce_sample_ntuples(
+        file_info: DictConfig,
+        input_paths: list,
+        ref_objs: list,
+        cfg: DictConfig) -> None:
+    """ Produces the ntuples of all reference objects for one sample, in
+    parallel, in chunks or in one go depending on the configuration """
+    sample_name = file_info.sample_name
+    if cfg.production.n_workers > 1 or len(input_paths) > 1:
+        print(f"Processing {len(input_paths)} {sample_name} file(s) "
+              f"with {cfg.production.n_workers} workers")
+        ppro.fill_ntuples_in_parallel(
+                            input_paths, file_info.tree, ref_objs,
+                            sample_name, cfg)
+    elif cfg.production.step_size is not None:
+        print(f"Streaming {sample_name} events from {input_paths[0]} "
+              f"in chunks of {cfg.production.step_size}")
+        if cfg.production.checkpoint:
+            ppro.fill_ntuples_in_checkpointed_chunks(
+                            input_paths[0], file_info.tree, ref_objs,
+                            sample_name, cfg)
+        else:
+            npro.fill_ntuples_in_chunks(
+                            input_paths[0], file_info.tree, ref_objs,
+                            sample_name, cfg)
+    else:
+        print(f"Started loading {sample_name} events from {input_paths[0]}")
+        events = general.load_events(
+                                file_path=input_paths[0],
+                                tree_name=file_info.tree,
+                                branches=general.construct_input_branches(cfg))
+        print(f"Events loaded, filling ntuples for {sample_name}")
+        npro.fill_ntuples(events, ref_objs, sample_name, cfg)
+    print(f"Finished filling ntuples for {sample_name}")
+
+
+def find_sample_outputs(
+        sample_name: str,
+        ref_objs: list,
+        cfg: DictConfig) -> list:
+    """ Finds the existing ntuples of all reference objects of the sample,
+    i.e. the merged ntuples or the numbered ntuples of the work units when
+    production.merge is disabled. Empty if any reference object has none """
+    output_paths = []
+    for ref_obj in ref_objs:
+        output_path = npro.infer_output_path(ref_obj, sample_name, cfg)[0]
+        ref_obj_paths = ppro.find_output_paths(output_path)
+        if not ref_obj_paths:
+            return []
+        output_paths.extend(ref_obj_paths)
+    return output_paths
 
 
 @hydra.main(config_path='../config', config_name='config')
 def main(cfg: DictConfig) -> None:
     os.makedirs(cfg.output_dir, exist_ok=True)
-    signal_info = cfg.eff_file
-    background_info = cfg.fakes_file
-    print(f"Started loading signal ({signal_info.sample_name}) "
-        f"events from {signal_info.path}")
-    signal_events = general.load_events(
-                                file_path=signal_info.path,
-                                tree_name=signal_info.tree)
-    print("Events loaded, filling ntuples for signal")
-    npro.fill_ref_obj_ntuple(
-                        signal_events, cfg.genTau, signal_info.sample_name, cfg)
-    npro.fill_ref_obj_ntuple(
-                signal_events, cfg.fakes.recoJet, signal_info.sample_name, cfg)
-    print("Finished filling ntuples for background.")
-    print(f"Loading events for fakes ({background_info.sample_name}) "
-        f"events from {background_info.path}")
-    background_events = general.load_events(
-                                file_path=background_info.path,
-                                tree_name=background_info.tree)
-    print("Events loaded, filling ntuples for fakes")
-    npro.fill_ref_obj_ntuple(
-                background_events,  cfg.genTau, background_info.sample_name, cfg)
-    npro.fill_ref_obj_ntuple(
-         background_events, cfg.fakes.recoJet, background_info.sample_name, cfg)
-    print("Fakes ntuple filled")
-
+    ref_objs = [cfg.genTau, cfg.fakes.recoJet]
+    for file_info in [cfg.eff_file, cfg.fakes_file]:
+        sample_name = file_info.sample_name
+        input_paths = general.expand_input_paths(file_info.path)
+        if cfg.production.cache.enabled:
+            key = caching.compute_ntuple_key(input_paths, cfg)
+            if caching.is_cached(find_sample_outputs(sample_name, ref_objs, cfg), key):
+                print(f"Reusing the cached {sample_name} ntuples")
+                continue
+            caching.remove_outputs([
+                path for ref_obj in ref_objs
+                for path in ppro.find_output_paths(
+                        npro.infer_output_path(ref_obj, sample_name, cfg)[0])])
+        produce_sample_ntuples(file_info, input_paths, ref_objs, cfg)
+        if cfg.production.cache.enabled:
+            caching.record_cache(
+                    find_sample_outputs(sample_name, ref_objs, cfg), key, input_paths)
 
 if __name__ == '__main__':
     main()
@@ -6,6 +6,8 @@ from tau_performance.tools import plot_eff_fake as pef
 from tau_performance.tools.tau_response import Response
 from tau_performance.tools import plot_response as pr
 from tau_performance.tools import plot_roc_curve as prc
+from tau_performance.tools.general import EventStore
+from tau_performance.tools.masking import MaskCache
 import os
 
 
@@ -19,16 +21,20 @@ def infer_input_path_and_tree(ref_obj, sample_name, cfg):
 @hydra.main(config_path='../config', config_name='config')
 def main(cfg: DictConfig) -> None:
     os.makedirs(cfg.output_dir, exist_ok=True)
+    # Each ntuple column is read and each mask computed once for all stages,
+    # unless the ntuples are streamed in chunks (performance.step_size)
+    event_store = EventStore()
+    mask_cache = MaskCache(event_store)
 
     ################### DM RECONSTRUCTION ###################
-    dm.decay_mode_reconstruction(cfg)
+    dm.decay_mode_reconstruction(cfg, event_store)
 
 
     ################### EFFICIENCY ###################
     eff_input_path, eff_tree_path = infer_input_path_and_tree(cfg.genTau, 'ggH_htt', cfg)
     eff = Efficiency(
                     'ggH_htt', cfg.comparison_tau, eff_input_path,
-                    eff_tree_path, cfg.genTau, cfg)
+                    eff_tree_path, cfg.genTau, cfg, event_store, mask_cache)
     efficiencies = eff.efficiencies
     eff_reco_histos = eff.reco_histos
     eff_obj = cfg.genTau
@@ -39,7 +45,8 @@ def main(cfg: DictConfig) -> None:
     ################### FAKE RATES ###################
     fake_input_path, fake_tree_path = infer_input_path_and_tree(cfg.fakes.recoJet, 'QCD', cfg)
     fake = Efficiency('QCD', cfg.comparison_tau, fake_input_path,
-                    fake_tree_path, cfg.fakes.recoJet, cfg)
+                    fake_tree_path, cfg.fakes.recoJet, cfg, event_store,
+                    mask_cache)
     fake_rates = fake.efficiencies
     fake_reco_histos = fake.reco_histos
     fake_obj = cfg.fakes.recoJet
@@ -48,8 +55,10 @@ def main(cfg: DictConfig) -> None:
 
 
     ################### RESPONSE ###################
-    res_eff = Response("ggH_htt", cfg.genTau, cfg)
-    pr.plot_all_responses(res_eff.energy_response, cfg.genTau, "ggH_htt", cfg)
+    res_eff = Response("ggH_htt", cfg.genTau, cfg, event_store, mask_cache)
+    # The histograms are filled in every mode, so that the plots do not
+    # depend on streaming or on the result cache
+    pr.plot_all_responses(res_eff.response_histograms, cfg.genTau, "ggH_htt", cfg)
 
 
     ###################   ROC   ###################
@@ -0,0 +1,169 @@
+import os
+import numpy as np
+import awkward
+import pytest
+import uproot
+from omegaconf import OmegaConf
+
+CONFIG_DIR = os.path.join(os.path.dirname(__file__), os.pardir, "config")
+
+
+def load_config(**overrides):
+    """ Composes the package configuration the same way as hydra does """
+    main_cfg = OmegaConf.load(os.path.join(CONFIG_DIR, "config.yaml"))
+    parts = []
+    for name in main_cfg.defaults:
+        if name == "_self_":
+            continue
+        parts.append(OmegaConf.load(os.path.join(CONFIG_DIR, f"{name}.yaml")))
+    del main_cfg["defaults"]
+    cfg = OmegaConf.merge(*parts, main_cfg, OmegaConf.create(overrides))
+    return cfg
+
+
+def random_collection(rng, counts, prefix, variables):
+    """ Creates a jagged NanoAOD-like collection with the given counts """
+    n_total = int(np.sum(counts))
+    collection = {}
+    for var in variables:
+        if var == "pt":
+            values = rng.uniform(10, 100, n_total)
+        elif var == "eta":
+            values = rng.uniform(-2.5, 2.5, n_total)
+        elif var == "phi":
+            values = rng.uniform(-np.pi, np.pi, n_total)
+        else:
+            values = rng.integers(-1, 12, n_total)
+        collection[f"{prefix}_{var}"] = awkward.unflatten(values, counts)
+    collection[f"n{prefix}"] = counts
+    return collection
+
+
+def smear_collection(rng, collection, prefix, new_prefix, variables, n_copy):
+    """ Creates a collection close in eta-phi to the first n_copy objects of
+    the given one, so that the objects can be matched """
+    counts = np.minimum(collection[f"n{prefix}"], n_copy)
+    eta = awkward.flatten(collection[f"{prefix}_eta"][:, :n_copy])
+    phi = awkward.flatten(collection[f"{prefix}_phi"][:, :n_copy])
+    n_total = len(eta)
+    smeared = random_collection(rng, counts, new_prefix, variables)
+    smeared[f"{new_prefix}_eta"] = awkward.unflatten(
+                        eta + rng.normal(0, 0.1, n_total), counts)
+    new_phi = phi + rng.normal(0, 0.1, n_total)
+    new_phi = (new_phi + np.pi) % (2 * np.pi) - np.pi
+    smeared[f"{new_prefix}_phi"] = awkward.unflatten(new_phi, counts)
+    return smeared
+
+
+def make_events(cfg, n_events=300, seed=1):
+    """ Creates synthetic NanoAOD-like events with taus overlapping with
+    the generator level taus and jets """
+    rng = np.random.default_rng(seed)
+    branches = {}
+    branches["run"] = np.ones(n_events, dtype=np.int64)
+    branches["luminosityBlock"] = rng.integers(1, 100, n_events)
+    branches["event"] = np.arange(n_events)
+    branches["Pileup_nTrueInt"] = rng.uniform(50, 80, n_events)
+    gen_taus = random_collection(
+                    rng, rng.integers(0, 4, n_events), cfg.genTau,
+                    cfg.allVariables.GenVisTau)
+    jets = random_collection(
+                    rng, rng.integers(0, 7, n_events), cfg.fakes.recoJet,
+                    list(cfg.allVariables.Jet) + ["btagDeepB"])
+    taus_from_gen = smear_collection(
+                    rng, gen_taus, cfg.genTau, cfg.comparison_tau,
+                    cfg.allVariables.tau, 2)
+    taus_from_jets = smear_collection(
+                    rng, jets, cfg.fakes.recoJet, cfg.comparison_tau,
+                    cfg.allVariables.tau, 3)
+    # Links of the taus to the objects they were made from, with some of the
+    # jet links missing
+    tau = cfg.comparison_tau
+    gen_tau_idx = awkward.local_index(taus_from_gen[f"{tau}_pt"])
+    taus_from_gen[f"{tau}_genPartIdx"] = gen_tau_idx
+    taus_from_gen[f"{tau}_genPartFlav"] = gen_tau_idx * 0 + 5
+    taus_from_gen[f"{tau}_jetIdx"] = gen_tau_idx * 0 - 1
+    jet_idx = awkward.local_index(taus_from_jets[f"{tau}_pt"])
+    has_link = awkward.unflatten(
+                    rng.random(len(awkward.flatten(jet_idx))) < 0.9,
+                    taus_from_jets[f"n{tau}"])
+    taus_from_jets[f"{tau}_jetIdx"] = awkward.where(has_link, jet_idx, -1)
+    taus_from_jets[f"{tau}_genPartFlav"] = jet_idx * 0
+    taus_from_jets[f"{tau}_genPartIdx"] = jet_idx * 0 - 1
+    gen_jets = smear_collection(
+                    rng, jets, cfg.fakes.recoJet, "GenJet",
+                    cfg.allVariables.GenJet, 5)
+    jets["Jet_genJetIdx"] = awkward.where(
+                    awkward.local_index(jets["Jet_pt"]) < 5,
+                    awkward.local_index(jets["Jet_pt"]), -1)
+    gen_parts = smear_collection(
+                    rng, gen_jets, "GenJet", "GenPart",
+                    ["pt", "eta", "phi", "pdgId", "status", "statusFlags"], 3)
+    n_gen_parts = len(awkward.flatten(gen_parts["GenPart_pt"]))
+    for var, choices in [("pdgId", [11, -11, 13, -13, 15, -15, 211, 22]),
+                         ("status", [1, 2]),
+                         ("statusFlags", [0, 1, 2, 3, 8193])]:
+        gen_parts[f"GenPart_{var}"] = awkward.unflatten(
+                        rng.choice(choices, n_gen_parts),
+                        gen_parts["nGenPart"])
+    branches.update(gen_taus)
+    branches.update(jets)
+    branches.update(gen_jets)
+    branches.update(gen_parts)
+    for key in taus_from_gen:
+        branches[key] = awkward.concatenate(
+                            [taus_from_gen[key], taus_from_jets[key]], axis=-1)
+    branches[f"n{cfg.comparison_tau}"] = (
+                            taus_from_gen[f"n{cfg.comparison_tau}"]
+                            + taus_from_jets[f"n{cfg.comparison_tau}"])
+    return awkward.Array(branches)
+
+
+def assert_same_ntuples(expected, observed):
+    """ Asserts that the ntuples of each reference object have the same
+    columns with the same values """
+    assert observed.keys() == expected.keys()
+    for ref_obj, res in expected.items():
+        assert observed[ref_obj].keys() == res.keys()
+        for var, values in res.items():
+            np.testing.assert_array_equal(observed[ref_obj][var], values)
+
+
+@pytest.fixture
+def cfg():
+    return load_config(comparison_tau="Tau")
+
+
+@pytest.fixture
+def events(cfg):
+    return make_events(cfg)
+
+
+def write_nanoaod(path, events, tree_name="Events"):
+    """ Writes the synthetic events to a .root file with the NanoAOD layout,
+    i.e. jagged collections with an n<Collection> counter branch """
+    collections = {}
+    branches = {}
+    for field in events.fields:
+        if field.startswith("n") and f"{field[1:]}_pt" in events.fields:
+            continue
+        if events[field].ndim > 1:
+            prefix, var = field.split("_", 1)
+            collections.setdefault(prefix, {})[var] = events[field]
+        else:
+            branches[field] = events[field]
+    for prefix, collection in collections.items():
+        branches[prefix] = awkward.zip(collection)
+    with uproot.recreate(path) as root_file:
+        tree = root_file.mktree(
+                    tree_name,
+                    {key: values.type for key, values in branches.items()},
+                    field_name=lambda outer, inner: f"{outer}_{inner}",
+                    counter_name=lambda counted: f"n{counted}")
+        tree.extend(branches)
+    return str(path)
+
+
+@pytest.fixture
+def nanoaod_file(tmp_path, events):
+    return write_nanoaod(tmp_path / "nanoaod.root", events)
@@ -0,0 +1,40 @@
+import os
+from tau_performance.tools import caching
+
+
+def test_ntuple_key_changes_with_inputs_and_config(nanoaod_file, cfg):
+    key = caching.compute_ntuple_key([nanoaod_file], cfg)
+    assert key == caching.compute_ntuple_key([nanoaod_file], cfg)
+    cfg.matching.dR_max = 0.4
+    assert key != caching.compute_ntuple_key([nanoaod_file], cfg)
+    cfg.matching.dR_max = 0.3
+    cfg.production.merge = False
+    assert key != caching.compute_ntuple_key([nanoaod_file], cfg)
+    cfg.production.merge = True
+    os.utime(nanoaod_file, (0, 0))
+    assert key != caching.compute_ntuple_key([nanoaod_file], cfg)
+    cfg.production.cache.checksum = True
+    checksum_key = caching.compute_ntuple_key([nanoaod_file], cfg)
+    os.utime(nanoaod_file, (1, 1))
+    assert checksum_key == caching.compute_ntuple_key([nanoaod_file], cfg)
+
+
+def test_outputs_are_cached_only_with_matching_key(tmp_path):
+    output_paths = [str(tmp_path / "eff.root"), str(tmp_path / "fake.root")]
+    for output_path in output_paths:
+        open(output_path, "wb").close()
+    assert not caching.is_cached(output_paths, "key")
+    caching.record_cache(output_paths, "key")
+    assert caching.is_cached(output_paths, "key")
+    assert not caching.is_cached(output_paths, "other_key")
+    os.remove(output_paths[1])
+    assert not caching.is_cached(output_paths, "key")
+
+
+def test_removed_outputs_are_not_cached(tmp_path):
+    output_path = str(tmp_path / "eff.root")
+    open(output_path, "wb").close()
+    caching.record_cache([output_path], "key")
+    caching.remove_outputs([output_path])
+    assert os.listdir(tmp_path) == []
+    assert not caching.is_cached([], "key")
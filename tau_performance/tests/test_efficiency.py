@@ -0,0 +1,192 @@
+import numpy as np
+import pytest
+from tau_performance.tools import general
+from tau_performance.tools import masking
+from tau_performance.tools import uncertainties
+from tau_performance.tools import ntuple_production as npro
+from tau_performance.tools import efficiency as efficiency_module
+from tau_performance.tools.efficiency import Efficiency
+from tau_performance.tools.tau_response import Response
+from conftest import load_config
+
+
+def write_ntuple(path, cfg, n_entries=500):
+    rng = np.random.default_rng(21)
+    columns = {
+        f"{cfg.genTau}_pt": rng.uniform(10, 400, n_entries),
+        f"{cfg.genTau}_eta": rng.uniform(-2.6, 2.6, n_entries),
+        "Pileup_nTrueInt": rng.uniform(50, 80, n_entries),
+    }
+    for var in ["pt", "eta", "idLeadTkFinding", "idDecayModeNewDMs",
+                "idChargedIso", "idIso", "chargedIso", "rawIso"]:
+        columns[f"{cfg.comparison_tau}_{var}"] = rng.uniform(-3, 30, n_entries)
+    columns[f"{cfg.comparison_tau}_rawIso"][:10] = 10.0
+    with npro.NtupleWriter(str(path), "Events") as writer:
+        writer.write(columns)
+    return columns
+
+
+def test_bin_indices_agree_with_histogram():
+    bins = np.array([0.0, 1.0, 2.5, 4.0])
+    values = np.array([-1.0, 0.0, 0.5, 1.0, 2.5, 3.9, 4.0, 4.1, np.nan])
+    indices = general.bin_indices(values, bins)
+    assert indices.tolist() == [-1, 0, 0, 1, 2, 2, 2, -1, -1]
+    np.testing.assert_array_equal(
+        np.bincount(indices[indices >= 0], minlength=3),
+        np.histogram(values, bins=bins)[0])
+
+
+@pytest.mark.parametrize("wp_block_size", [2, 8])
+def test_single_pass_histograms_match_per_wp_histograms(
+        tmp_path, cfg, monkeypatch, wp_block_size):
+    monkeypatch.setattr(efficiency_module, "WP_BLOCK_SIZE", wp_block_size)
+    path = tmp_path / "ntuple.root"
+    columns = write_ntuple(path, cfg)
+    cfg.output_dir = str(tmp_path)
+    efficiency = Efficiency(
+            "ggH_htt", cfg.comparison_tau, str(path), "Events", cfg.genTau, cfg)
+    events = general.load_events(str(path), "Events")
+    assert efficiency.events is None and efficiency.masks is None
+    masks = masking.Masks(events, "numerators", cfg.genTau, cfg).store
+    denominator = masking.Masks(
+            events, "denominators", cfg.genTau, cfg).store.unpack('Base')
+    for var in ["pt", "eta"]:
+        var_name = f"{cfg.genTau}_{var}"
+        bins = np.array(
+            [v.bins for v in cfg.TauID_eff.variables.genTau if v.name == var][0])
+        h_gen = np.histogram(columns[var_name][denominator], bins=bins)[0]
+        for tau_id_key, wps in efficiency.numerators.items():
+            for wp_key in wps:
+                mask = denominator & masks.unpack((tau_id_key, wp_key))
+                h_wp = np.histogram(columns[var_name][mask], bins=bins)[0]
+                result = efficiency.efficiencies[var_name][tau_id_key][wp_key]
+                np.testing.assert_allclose(
+                    result.binned_data, np.nan_to_num(h_wp / h_gen))
+                np.testing.assert_allclose(
+                    result.interval,
+                    uncertainties.efficiency_intervals(h_wp, h_gen))
+    raw_iso = f"{cfg.comparison_tau}_rawIso"
+    mask = denominator & masks.unpack(("idIso", "Loose"))
+    np.testing.assert_array_equal(
+        efficiency.reco_histos[raw_iso]["idIso"]["Loose"][0],
+        np.histogram(columns[raw_iso][mask], bins=[float(b) for b in range(11)])[0])
+
+
+def test_streaming_matches_whole_file(tmp_path, cfg):
+    path = tmp_path / "ggH_htt_tauID_eff.root"
+    write_ntuple(path, cfg)
+    streamed_cfg = load_config(
+        comparison_tau="Tau", output_dir=str(tmp_path),
+        performance={"step_size": 120, "result_cache": {"enabled": False}})
+    cfg.output_dir = str(tmp_path)
+    cfg.performance.result_cache.enabled = False
+    whole = Efficiency(
+            "ggH_htt", cfg.comparison_tau, str(path), "Events", cfg.genTau, cfg)
+    streamed = Efficiency(
+            "ggH_htt", cfg.comparison_tau, str(path), "Events", cfg.genTau,
+            streamed_cfg)
+    assert streamed.events is None
+    assert streamed.total_efficiencies == whole.total_efficiencies
+    for var_name, id_eff in whole.efficiencies.items():
+        for tau_id_key, wp_eff in id_eff.items():
+            for wp_key, histogram in wp_eff.items():
+                np.testing.assert_allclose(
+                    streamed.efficiencies[var_name][tau_id_key][wp_key].binned_data,
+                    histogram.binned_data)
+    whole_response = Response("ggH_htt", cfg.genTau, cfg)
+    streamed_response = Response("ggH_htt", cfg.genTau, streamed_cfg)
+    assert streamed_response.energy_response == {}
+    responses = whole_response.energy_response["idIso"]["Tight"]
+    summary = streamed_response.response_summaries["idIso"]["Tight"]
+    assert summary["n"] == len(responses)
+    assert np.isclose(summary["mean"], np.mean(responses))
+    assert np.isclose(summary["std"], np.std(responses))
+    np.testing.assert_array_equal(
+        streamed_response.response_histograms["idIso"]["Tight"].binned_data,
+        whole_response.response_histograms["idIso"]["Tight"].binned_data)
+
+
+@pytest.mark.parametrize("step_size", [None, 120])
+def test_ntuple_without_entries_gives_empty_results(tmp_path, cfg, step_size):
+    path = tmp_path / "ggH_htt_tauID_eff.root"
+    write_ntuple(path, cfg, n_entries=0)
+    cfg.output_dir = str(tmp_path)
+    cfg.performance.step_size = step_size
+    efficiency = Efficiency(
+            "ggH_htt", cfg.comparison_tau, str(path), "Events", cfg.genTau, cfg)
+    assert efficiency.numerators == masking.read_working_points(
+                                            cfg, "numerators", cfg.genTau)
+    assert np.all(np.isnan(efficiency.total_efficiencies["idIso"]))
+    pt_eff = efficiency.efficiencies[f"{cfg.genTau}_pt"]["idIso"]["Tight"]
+    assert not np.any(pt_eff.binned_data)
+    response = Response("ggH_htt", cfg.genTau, cfg)
+    assert response.response_summaries["idIso"]["Tight"]["n"] == 0
+    cached = Efficiency(
+            "ggH_htt", cfg.comparison_tau, str(path), "Events", cfg.genTau, cfg)
+    assert cached.numerators == efficiency.numerators
+    cached_response = Response("ggH_htt", cfg.genTau, cfg)
+    assert not np.any(
+        cached_response.response_histograms["idIso"]["Tight"].binned_data)
+
+
+def test_efficiency_intervals():
+    passed = np.array([[0, 3, 10], [1, 5, 10]])
+    total = np.array([0, 10, 10])
+    for method in uncertainties.INTERVALS:
+        lower, upper = uncertainties.efficiency_intervals(
+                                            passed, total, method=method)
+        assert lower.shape == passed.shape
+        assert np.all(np.isnan(lower[:, 0])) and np.all(np.isnan(upper[:, 0]))
+        efficiency = passed[:, 1:] / total[1:]
+        assert np.all(lower[:, 1:] <= efficiency)
+        assert np.all(upper[:, 1:] >= efficiency)
+    lower, upper = uncertainties.efficiency_intervals(passed, total)
+    np.testing.assert_allclose(lower[0, 1:], [0.1417, 0.1587**0.1], atol=1e-4)
+    np.testing.assert_allclose(upper[0, 1:], [0.5083, 1.0], atol=1e-4)
+    # Doubling the weights of all the entries does not change the intervals
+    np.testing.assert_allclose(
+        uncertainties.efficiency_intervals(2*passed, 2*total, total_sumw2=4*total),
+        (lower, upper))
+    lower, upper = uncertainties.efficiency_intervals(
+                                        passed, total, method='wilson')
+    np.testing.assert_allclose(lower[0, 1:], [0.1788, 1/1.1], atol=1e-4)
+
+
+def test_results_are_cached(tmp_path, cfg, monkeypatch):
+    path = tmp_path / "ggH_htt_tauID_eff.root"
+    write_ntuple(path, cfg)
+    cfg.output_dir = str(tmp_path)
+    efficiency = Efficiency(
+            "ggH_htt", cfg.comparison_tau, str(path), "Events", cfg.genTau, cfg)
+    response = Response("ggH_htt", cfg.genTau, cfg)
+    assert len(list((tmp_path / "results").glob("*.npz"))) == 2
+
+    def fail(*args, **kwargs):
+        raise AssertionError("The ntuple should not be read")
+
+    monkeypatch.setattr("tau_performance.tools.efficiency.iterate_masks", fail)
+    monkeypatch.setattr("tau_performance.tools.tau_response.iterate_masks", fail)
+    cached = Efficiency(
+            "ggH_htt", cfg.comparison_tau, str(path), "Events", cfg.genTau, cfg)
+    assert cached.total_efficiencies == efficiency.total_efficiencies
+    for var_name, id_eff in efficiency.efficiencies.items():
+        for tau_id_key, wp_eff in id_eff.items():
+            for wp_key, histogram in wp_eff.items():
+                result = cached.efficiencies[var_name][tau_id_key][wp_key]
+                np.testing.assert_array_equal(
+                    result.binned_data, histogram.binned_data)
+                np.testing.assert_array_equal(result.interval, histogram.interval)
+    raw_iso = f"{cfg.comparison_tau}_rawIso"
+    np.testing.assert_array_equal(
+        cached.reco_histos[raw_iso]["idIso"]["Loose"][0],
+        efficiency.reco_histos[raw_iso]["idIso"]["Loose"][0])
+    cached_response = Response("ggH_htt", cfg.genTau, cfg)
+    assert (cached_response.response_summaries["idIso"]
+            == response.response_summaries["idIso"])
+    np.testing.assert_array_equal(
+        cached_response.response_histograms["idIso"]["Tight"].binned_data,
+        response.response_histograms["idIso"]["Tight"].binned_data)
+    cfg.TauID_eff.denominators.Base = "pt >= 30 && |eta| < 2.3"
+    with pytest.raises(AssertionError, match="should not be read"):
+        Efficiency(
+            "ggH_htt", cfg.comparison_tau, str(path), "Events", cfg.genTau, cfg)
@@ -0,0 +1,51 @@
+import numpy as np
+from tau_performance.tools import general
+from tau_performance.tools import ntuple_production as npro
+from tau_performance.tools.masking import MaskCache
+
+
+def write_ntuple(path, cfg, n_entries=50):
+    rng = np.random.default_rng(8)
+    columns = {
+        f"{cfg.genTau}_pt": rng.uniform(10, 100, n_entries),
+        f"{cfg.genTau}_eta": rng.uniform(-2.5, 2.5, n_entries),
+        f"{cfg.genTau}_phi": rng.uniform(-3, 3, n_entries),
+    }
+    for var in ["pt", "eta", "idLeadTkFinding", "idDecayModeNewDMs",
+                "idChargedIso", "idIso", "chargedIso", "rawIso"]:
+        columns[f"{cfg.comparison_tau}_{var}"] = rng.uniform(-3, 30, n_entries)
+    with npro.NtupleWriter(str(path), "Events") as writer:
+        writer.write(columns)
+    return columns
+
+
+def test_event_store_reads_each_column_once(tmp_path, cfg, monkeypatch):
+    path = tmp_path / "ntuple.root"
+    columns = write_ntuple(path, cfg)
+    reads = []
+    load_events = general.load_events
+
+    def counting_load_events(file_path, tree_name, branches=None, **kwargs):
+        reads.append(list(branches))
+        return load_events(file_path, tree_name, branches, **kwargs)
+
+    monkeypatch.setattr(general, "load_events", counting_load_events)
+    store = general.EventStore()
+    pt, eta = f"{cfg.genTau}_pt", f"{cfg.genTau}_eta"
+    events = store.load(str(path), "Events", [pt])
+    events = store.load(str(path), "Events", [eta, pt])
+    assert events.fields == [eta, pt]
+    np.testing.assert_array_equal(events[pt], columns[pt])
+    assert reads == [[pt], [eta]]
+    assert len(store.load(str(path), "Events").fields) == len(columns)
+
+
+def test_mask_cache_shares_masks(tmp_path, cfg):
+    path = tmp_path / "ntuple.root"
+    write_ntuple(path, cfg)
+    cache = MaskCache(general.EventStore())
+    masks = cache.get(str(path), "Events", "numerators", cfg.genTau, cfg)
+    assert cache.get(str(path), "Events", "numerators", cfg.genTau, cfg) is masks
+    assert cache.get(
+        str(path), "Events", "denominators", cfg.genTau, cfg) is not masks
+    assert ("idIso", "Tight") in masks.store
@@ -0,0 +1,53 @@
+import pickle
+import numpy as np
+import pytest
+from tau_performance.tools.general import Histogram
+
+
+BINS = [0.0, 1.0, 2.0, 4.0]
+
+
+def test_weighted_counts_and_sumw2():
+    h = Histogram([0.5, 0.5, 3.0, 5.0], BINS, "Test", weights=[1.0, 2.0, 3.0, 4.0])
+    np.testing.assert_array_equal(h.binned_data, [3.0, 0.0, 3.0])
+    np.testing.assert_array_equal(h.sumw2, [5.0, 0.0, 9.0])
+    np.testing.assert_array_equal(h.bin_centers, [0.5, 1.5, 3.0])
+    assert Histogram([0.5], BINS, "Test", keep_data=False).data is None
+
+
+def test_merging_in_place():
+    h = Histogram([0.5, 1.5], BINS, "Test")
+    h_copy = h
+    h += Histogram([1.5, 3.0], BINS, "Test")
+    assert h is h_copy and h.data is None
+    np.testing.assert_array_equal(h.binned_data, [1, 2, 1])
+    np.testing.assert_array_equal(h.sumw2, [1.0, 2.0, 1.0])
+    h.fill([0.1], weights=[0.5])
+    np.testing.assert_array_equal(h.binned_data, [1.5, 2, 1])
+    np.testing.assert_array_equal(h.sumw2, [1.25, 2.0, 1.0])
+    np.testing.assert_array_equal((h + h).binned_data, [3.0, 4, 2])
+
+
+def test_mismatched_edges_are_rejected():
+    h = Histogram([0.5], BINS, "Test")
+    other = Histogram([0.5], [0.0, 1.0, 2.0, 5.0], "Test")
+    for operation in [lambda: h + other, lambda: h / other, lambda: h * other]:
+        with pytest.raises(ArithmeticError):
+            operation()
+
+
+def test_ratio_of_empty_bins_is_zero():
+    numerator = Histogram([0.5, 1.5], BINS, "Numerator")
+    denominator = Histogram([0.5, 0.5, 1.5], BINS, "Denominator")
+    ratio = numerator / denominator
+    np.testing.assert_allclose(ratio.binned_data, [0.5, 1.0, 0.0])
+    np.testing.assert_allclose(ratio.sumw2, [0.375, 2.0, 0.0])
+
+
+def test_serialization():
+    h = Histogram([0.5, 1.5, 3.0], BINS, "Test", weights=[1.0, 2.0, 2.0])
+    for restored in [Histogram.from_dict(h.to_dict()), pickle.loads(pickle.dumps(h))]:
+        assert str(restored) == "Test histogram"
+        np.testing.assert_array_equal(restored.binned_data, h.binned_data)
+        np.testing.assert_array_equal(restored.sumw2, h.sumw2)
+        np.testing.assert_array_equal(restored.bin_edges, h.bin_edges)
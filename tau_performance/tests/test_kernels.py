@@ -0,0 +1,66 @@
+import numpy as np
+from tau_performance.tools import kernels
+from tau_performance.tools import matching_algorithms as ma
+from tau_performance.tools import particle_matching as pm
+from tau_performance.tools import ntuple_production as npro
+from conftest import assert_same_ntuples
+
+
+def flat_collections(events, ref_obj, cfg):
+    ref_eta, ref_counts = pm.flatten_collection(events[f"{ref_obj}_eta"])
+    ref_phi, _ = pm.flatten_collection(events[f"{ref_obj}_phi"])
+    tau_eta, tau_counts = pm.flatten_collection(events[f"{cfg.comparison_tau}_eta"])
+    tau_phi, _ = pm.flatten_collection(events[f"{cfg.comparison_tau}_phi"])
+    return ref_eta, ref_phi, ref_counts, tau_eta, tau_phi, tau_counts
+
+
+def test_candidate_pairs_kernel(events, cfg):
+    ref_eta, ref_phi, ref_counts, tau_eta, tau_phi, tau_counts = flat_collections(
+                                                    events, cfg.fakes.recoJet, cfg)
+    expected = pm.form_candidate_pairs(
+            ref_eta, ref_phi, ref_counts, tau_eta, tau_phi, tau_counts, 0.3)
+    observed = kernels.candidate_pairs(
+            ref_eta, ref_phi, kernels.counts_to_offsets(ref_counts),
+            tau_eta, tau_phi, kernels.counts_to_offsets(tau_counts), 0.3)
+    np.testing.assert_array_equal(observed[0], expected[0])
+    np.testing.assert_array_equal(observed[1], expected[1])
+    np.testing.assert_allclose(observed[2], expected[2], rtol=1e-6)
+
+
+def test_matching_kernels():
+    rng = np.random.default_rng(5)
+    ref_idx = np.repeat(np.arange(50), 4)
+    tau_idx = rng.integers(0, 40, len(ref_idx))
+    distances = rng.random(len(ref_idx))
+    np.testing.assert_array_equal(
+        kernels.greedy_matching(ref_idx, tau_idx, distances, 50, 40),
+        ma.greedy_matching(ref_idx, tau_idx, distances, 50))
+    np.testing.assert_array_equal(
+        kernels.closest_first_matching(ref_idx, tau_idx, distances, 50, 40),
+        ma.closest_first_matching(ref_idx, tau_idx, distances, 50))
+
+
+def test_compiled_backend_gives_same_ntuples(events, cfg, monkeypatch):
+    cfg.production.backend = 'numpy'
+    expected = npro.create_ntuples(events, [cfg.genTau, cfg.fakes.recoJet], cfg)
+    # Runs the kernels also when numba is not installed
+    monkeypatch.setattr(kernels, "use_compiled", lambda backend: True)
+    observed = npro.create_ntuples(events, [cfg.genTau, cfg.fakes.recoJet], cfg)
+    assert_same_ntuples(expected, observed)
+
+
+def test_candidate_pairs_at_dR_max_in_float32():
+    # The separation equals dR_max only when both are rounded to float32
+    ref_eta = np.zeros(1, dtype=np.float32)
+    tau_eta = np.array([0.3, 0.31], dtype=np.float32)
+    ref_phi, tau_phi = np.zeros(1, np.float32), np.zeros(2, np.float32)
+    ref_counts, tau_counts = np.array([1]), np.array([2])
+    expected = pm.form_candidate_pairs(
+            ref_eta, ref_phi, ref_counts, tau_eta, tau_phi, tau_counts, 0.3)
+    observed = kernels.candidate_pairs(
+            ref_eta, ref_phi, kernels.counts_to_offsets(ref_counts),
+            tau_eta, tau_phi, kernels.counts_to_offsets(tau_counts), 0.3)
+    assert expected[1].tolist() == [0]
+    for expected_values, observed_values in zip(expected, observed):
+        np.testing.assert_array_equal(observed_values, expected_values)
+        assert observed_values.dtype == expected_values.dtype
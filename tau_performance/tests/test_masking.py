@@ -0,0 +1,135 @@
+import numpy as np
+import awkward
+import pytest
+from tau_performance.tools import masking
+
+
+COLUMNS = {
+    "pt": np.array([10.0, 25.0, 30.0, 50.0]),
+    "eta": np.array([0.5, -2.5, 1.0, -1.0]),
+    "Pileup_nTrueInt": np.array([55.0, 70.0, 65.0, 52.0]),
+}
+
+
+def get_column(name, abs_value):
+    values = COLUMNS[name.lstrip("@")]
+    return np.abs(values) if abs_value else values
+
+
+def evaluate(cut_string):
+    return masking.GeneralCut(cut_string).evaluate(get_column).tolist()
+
+
+def test_conjunction_and_absolute_values():
+    assert evaluate("pt >= 20 && |eta| < 2.3") == [False, False, True, True]
+    assert evaluate("pt>=20&&|eta|<2.3") == [False, False, True, True]
+
+
+def test_disjunction_precedence_and_parentheses():
+    assert evaluate("pt < 20 || pt > 40 && eta < 0") == [True, False, False, True]
+    assert evaluate("(pt < 20 || pt > 40) && eta > 0") == [True, False, False, False]
+    assert evaluate("@Pileup_nTrueInt > 60 || (|eta| < 0.6)") == [True, True, True, False]
+
+
+def test_number_on_the_left():
+    assert evaluate("20 <= pt") == evaluate("pt >= 20")
+
+
+def test_all_cuts():
+    cut = masking.GeneralCut("idLeadTkFinding > 0.5 && (|eta| < 2.3 || @x == 1)")
+    assert cut.all_cuts == [
+        ["idLeadTkFinding", ">", 0.5], ["|eta|", "<", 2.3], ["@x", "==", 1.0]]
+
+
+@pytest.mark.parametrize(
+    "cut_string", ["", "pt >", "pt >= 20 &&", "(pt > 1", "pt > eta", "pt = 1"])
+def test_invalid_cuts(cut_string):
+    with pytest.raises(ValueError):
+        masking.GeneralCut(cut_string)
+
+
+def test_interpret_name(cfg):
+    assert masking.interpret_name("|eta|", cfg) == ("Tau_eta", True)
+    assert masking.interpret_name(
+        "@Pileup_nTrueInt", cfg, denominator=True, obj_type="Jet") == (
+                                                    "Pileup_nTrueInt", False)
+    assert masking.interpret_name(
+                    "pt", cfg, denominator=True, obj_type="Jet") == ("Jet_pt", False)
+
+
+def test_masks(cfg):
+    events = awkward.Array({
+        "GenVisTau_pt": [10.0, 25.0, 30.0, 50.0],
+        "GenVisTau_eta": [0.5, -2.5, 1.0, -1.0],
+        "Tau_pt": [12.0, 22.0, 31.0, -999.0],
+        "Tau_eta": [0.4, -2.4, 1.1, -999.0],
+        "Tau_idLeadTkFinding": [1, 1, 1, -999],
+        "Tau_idDecayModeNewDMs": [1, 0, 1, -999],
+        "Tau_idChargedIso": [1, 7, 3, -999],
+        "Tau_idIso": [7, 7, 1, -999],
+        "Tau_chargedIso": [1.0, 3.0, 0.5, -999.0],
+        "Tau_rawIso": [1.0, 3.0, 0.5, -999.0],
+    })
+    denominator = masking.Masks(events, "denominators", cfg.genTau, cfg).masks
+    assert denominator.tolist() == [False, False, True, True]
+    numerators = masking.Masks(events, "numerators", cfg.genTau, cfg).masks
+    assert numerators["idIso"]["Loose"].tolist() == [True, True, True, False]
+    assert numerators["idDecayModeNewDMs_idChargedIso"]["Medium"].tolist() == [
+                                                    False, False, True, False]
+
+
+def test_conjunction_prefixes_are_shared():
+    memo = {}
+    calls = []
+
+    def counting_get_column(name, abs_value):
+        calls.append(name)
+        return get_column(name, abs_value)
+
+    loose = masking.GeneralCut("pt >= 20 && |eta| < 2.3 && eta > 0")
+    tight = masking.GeneralCut("pt >= 20 && |eta| < 2.3 && eta > 0.8")
+    assert loose.evaluate(counting_get_column, memo).tolist() == [
+                                                    False, False, True, False]
+    assert tight.evaluate(counting_get_column, memo).tolist() == [
+                                                    False, False, True, False]
+    assert calls == ["pt", "eta", "eta", "eta"]
+    assert "(pt>=20.0&&|eta|<2.3)" in memo
+    assert not memo["pt>=20.0"].flags.writeable
+
+
+def test_masks_evaluate_each_comparison_once(cfg, monkeypatch):
+    events = awkward.Array({
+        f"Tau_{var}": np.linspace(-3, 5, 11)
+        for var in ["pt", "eta", "idLeadTkFinding", "idDecayModeNewDMs",
+                    "idChargedIso", "idIso", "chargedIso", "rawIso"]
+    })
+    comparisons = []
+    original = masking.Comparison.evaluate
+
+    def counting_evaluate(self, get_column, memo=None):
+        if memo is None or self.key not in memo:
+            comparisons.append(self.key)
+        return original(self, get_column, memo)
+
+    monkeypatch.setattr(masking.Comparison, "evaluate", counting_evaluate)
+    masking.Masks(events, "numerators", cfg.genTau, cfg)
+    assert len(comparisons) == len(set(comparisons))
+
+
+def test_mask_store():
+    rng = np.random.default_rng(2)
+    masks = {f"wp{idx}": rng.random(1001) < 0.3 for idx in range(20)}
+    store = masking.MaskStore(1001)
+    for key, mask in masks.items():
+        store.add(key, mask)
+    assert len(store) == 20
+    assert store.matrix.shape == (20, 126)
+    for key, mask in masks.items():
+        np.testing.assert_array_equal(store.unpack(key), mask)
+        assert store.count(key) == np.sum(mask)
+    combined = store.logical_and("wp3", "wp7", "wp11")
+    expected = masks["wp3"] & masks["wp7"] & masks["wp11"]
+    assert store.count(combined) == np.sum(expected)
+    np.testing.assert_array_equal(store.unpack(combined), expected)
+    with pytest.raises(ValueError):
+        store.add("short", np.ones(1000, dtype=bool))
@@ -0,0 +1,89 @@
+import itertools
+import numpy as np
+import pytest
+from tau_performance.tools import matching_algorithms as ma
+
+
+def random_pairs(n_events=200, max_objects=4, seed=3):
+    rng = np.random.default_rng(seed)
+    ref_idx, tau_idx, distances, pair_event = [], [], [], []
+    n_refs = n_taus = 0
+    for event in range(n_events):
+        event_refs = rng.integers(0, max_objects + 1)
+        event_taus = rng.integers(0, max_objects + 1)
+        for ref, tau in itertools.product(range(event_refs), range(event_taus)):
+            if rng.random() < 0.6:
+                ref_idx.append(n_refs + ref)
+                tau_idx.append(n_taus + tau)
+                distances.append(rng.random())
+                pair_event.append(event)
+        n_refs += event_refs
+        n_taus += event_taus
+    return (np.array(ref_idx, dtype=np.int64), np.array(tau_idx, dtype=np.int64),
+            np.array(distances), n_refs, np.array(pair_event, dtype=np.int64))
+
+
+def sequential_greedy(ref_idx, tau_idx, distances, n_refs):
+    matched = np.full(n_refs, -1)
+    taken_taus = set()
+    for pair in np.argsort(distances, kind='stable'):
+        if matched[ref_idx[pair]] < 0 and tau_idx[pair] not in taken_taus:
+            matched[ref_idx[pair]] = tau_idx[pair]
+            taken_taus.add(tau_idx[pair])
+    return matched
+
+
+def test_greedy_matching_equals_sequential_greedy():
+    ref_idx, tau_idx, distances, n_refs, _ = random_pairs()
+    np.testing.assert_array_equal(
+        ma.greedy_matching(ref_idx, tau_idx, distances, n_refs),
+        sequential_greedy(ref_idx, tau_idx, distances, n_refs))
+
+
+def test_greedy_differs_from_closest_first():
+    # Both objects prefer tau 0, object 1 is closer to it and object 0 then
+    # takes its second choice only with the greedy algorithm
+    ref_idx = np.array([0, 0, 1])
+    tau_idx = np.array([0, 1, 0])
+    distances = np.array([0.10, 0.20, 0.05])
+    assert ma.match_pairs(
+        ref_idx, tau_idx, distances, 2, algorithm='closest_first').tolist() == [-1, 0]
+    assert ma.match_pairs(
+        ref_idx, tau_idx, distances, 2, algorithm='greedy').tolist() == [1, 0]
+
+
+def test_hungarian_matching_is_optimal():
+    pytest.importorskip("scipy")
+    ref_idx, tau_idx, distances, n_refs, pair_event = random_pairs(n_events=60)
+    matched = ma.hungarian_matching(
+                            ref_idx, tau_idx, distances, n_refs, pair_event)
+    pair_distance = dict(zip(zip(ref_idx.tolist(), tau_idx.tolist()), distances))
+    for event in np.unique(pair_event):
+        in_event = pair_event == event
+        refs = np.unique(ref_idx[in_event]).tolist()
+        taus = np.unique(tau_idx[in_event]).tolist()
+        best = (0, 0.0)
+        for choice in itertools.product([-1] + taus, repeat=len(refs)):
+            chosen = [(r, t) for r, t in zip(refs, choice) if t >= 0]
+            if len({t for _, t in chosen}) < len(chosen):
+                continue
+            if any(pair not in pair_distance for pair in chosen):
+                continue
+            total = sum(pair_distance[pair] for pair in chosen)
+            best = min(best, (-len(chosen), total))
+        chosen = [(r, matched[r]) for r in refs if matched[r] >= 0]
+        assert -len(chosen) == best[0]
+        assert sum(pair_distance[pair] for pair in chosen) == pytest.approx(best[1])
+
+
+def test_unknown_algorithm():
+    with pytest.raises(ValueError):
+        ma.match_pairs(np.array([0]), np.array([0]), np.array([0.1]), 1,
+                       algorithm='nearest')
+
+
+@pytest.mark.parametrize("algorithm", ma.ALGORITHMS)
+def test_no_candidate_pairs(algorithm):
+    empty = np.array([], dtype=np.int64)
+    matched = ma.match_pairs(empty, empty, np.array([]), 3, algorithm=algorithm)
+    assert matched.tolist() == [-1, -1, -1]
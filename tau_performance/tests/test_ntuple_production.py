@@ -0,0 +1,373 @@
+import os
+import numpy as np
+import awkward
+import uproot
+import pytest
+from tau_performance.tools import ntuple_production as npro
+from tau_performance.tools import general
+from tau_performance.tools import particle_matching as pm
+from tau_performance.tools import parallel_production as ppro
+from conftest import assert_same_ntuples, make_events, write_nanoaod
+
+
+def test_columnar_ntuple_matches_event_by_event(events, cfg):
+    for ref_obj in [cfg.genTau, cfg.fakes.recoJet]:
+        mismatches = npro.validate_columnar_ntuple(events, ref_obj, cfg)
+        assert mismatches == {}
+
+
+def test_columnar_ntuple_has_all_variables(events, cfg):
+    res = npro.create_ref_obj_ntuple_columnar(events, cfg.genTau, cfg)
+    n_entries = len(res[f"{cfg.genTau}_pt"])
+    assert n_entries > 0
+    assert all(len(values) == n_entries for values in res.values())
+    assert np.any(res[f"{cfg.comparison_tau}_pt"] != -999)
+
+
+def test_chunked_ntuples_match_single_pass(nanoaod_file, tmp_path, cfg):
+    cfg.output_dir = str(tmp_path / "single")
+    os.makedirs(cfg.output_dir)
+    events = general.load_events(nanoaod_file, "Events")
+    npro.fill_ref_obj_ntuple(events, cfg.genTau, "ggH_htt", cfg)
+    single_path, tree_path = npro.infer_output_path(cfg.genTau, "ggH_htt", cfg)
+    cfg.output_dir = str(tmp_path / "chunked")
+    os.makedirs(cfg.output_dir)
+    cfg.production.step_size = 70
+    npro.fill_ntuples_in_chunks(
+                    nanoaod_file, "Events", [cfg.genTau], "ggH_htt", cfg)
+    chunked_path, _ = npro.infer_output_path(cfg.genTau, "ggH_htt", cfg)
+    single = general.load_events(single_path, tree_path)
+    chunked = general.load_events(chunked_path, tree_path)
+    assert single.fields == chunked.fields
+    for field in single.fields:
+        np.testing.assert_allclose(
+                    single[field].to_numpy(), chunked[field].to_numpy())
+
+
+def test_ntuples_are_written_as_trees(tmp_path):
+    path = str(tmp_path / "ntuple.root")
+    with npro.NtupleWriter(path, "Events") as writer:
+        writer.write({"a": np.arange(3.0), "b": np.arange(3)})
+        writer.write({"a": np.arange(2.0), "b": np.arange(2)})
+    with uproot.open(path) as ntuple_file:
+        ntuple = ntuple_file["Events"].arrays(["b"])
+    assert ntuple.fields == ["b"]
+    assert ntuple["b"].tolist() == [0, 1, 2, 0, 1]
+
+
+def test_input_branches_suffice_for_ntuple(nanoaod_file, cfg):
+    branches = general.construct_input_branches(cfg)
+    projected = general.load_events(nanoaod_file, "Events", branches)
+    full = general.load_events(nanoaod_file, "Events")
+    assert set(projected.fields) < set(full.fields)
+    ref_objs = [cfg.genTau, cfg.fakes.recoJet]
+    assert_same_ntuples(
+        {ref_obj: npro.create_ntuple(full, ref_obj, cfg) for ref_obj in ref_objs},
+        {ref_obj: npro.create_ntuple(projected, ref_obj, cfg) for ref_obj in ref_objs})
+
+
+def test_parallel_ntuples_match_single_pass(nanoaod_file, tmp_path, cfg):
+    cfg.output_dir = str(tmp_path / "single")
+    os.makedirs(cfg.output_dir)
+    events = general.load_events(nanoaod_file, "Events")
+    npro.fill_ref_obj_ntuple(events, cfg.fakes.recoJet, "QCD", cfg)
+    single_path, tree_path = npro.infer_output_path(cfg.fakes.recoJet, "QCD", cfg)
+    cfg.output_dir = str(tmp_path / "parallel")
+    os.makedirs(cfg.output_dir)
+    cfg.production.n_workers = 2
+    cfg.production.entries_per_range = 45
+    ppro.fill_ntuples_in_parallel(
+                    [nanoaod_file], "Events", [cfg.fakes.recoJet], "QCD", cfg)
+    parallel_path, _ = npro.infer_output_path(cfg.fakes.recoJet, "QCD", cfg)
+    single = general.load_events(single_path, tree_path)
+    parallel = general.load_events(parallel_path, tree_path)
+    for field in single.fields:
+        np.testing.assert_array_equal(
+                    single[field].to_numpy(), parallel[field].to_numpy())
+
+
+def test_multiple_input_files_are_merged_in_order(events, tmp_path, cfg):
+    input_dir = tmp_path / "input"
+    os.makedirs(input_dir)
+    write_nanoaod(input_dir / "nano_0.root", events[:120])
+    write_nanoaod(input_dir / "nano_1.root", events[120:])
+    input_paths = general.expand_input_paths(str(input_dir / "nano_*.root"))
+    assert len(input_paths) == 2
+    cfg.output_dir = str(tmp_path / "output")
+    os.makedirs(cfg.output_dir)
+    cfg.production.n_workers = 2
+    ppro.fill_ntuples_in_parallel(
+                    input_paths, "Events", [cfg.genTau], "ggH_htt", cfg)
+    output_path, tree_path = npro.infer_output_path(cfg.genTau, "ggH_htt", cfg)
+    merged = general.load_events(output_path, tree_path)
+    expected = npro.create_ntuple(events, cfg.genTau, cfg)
+    for key in expected:
+        np.testing.assert_array_equal(merged[key].to_numpy(), expected[key])
+
+
+def test_unmerged_outputs_are_found(nanoaod_file, tmp_path, cfg):
+    cfg.output_dir = str(tmp_path)
+    cfg.production.n_workers = 2
+    cfg.production.entries_per_range = 45
+    cfg.production.merge = False
+    output_path, tree_path = npro.infer_output_path(cfg.genTau, "ggH_htt", cfg)
+    assert ppro.find_output_paths(output_path) == []
+    ppro.fill_ntuples_in_parallel(
+                    [nanoaod_file], "Events", [cfg.genTau], "ggH_htt", cfg)
+    output_paths = ppro.find_output_paths(output_path)
+    file_name, extension = os.path.splitext(output_path)
+    assert not os.path.exists(output_path)
+    assert output_paths == [
+        f"{file_name}_{unit_idx:05d}{extension}"
+        for unit_idx in range(len(output_paths))]
+    assert len(output_paths) > 1
+    expected = npro.create_ntuple(
+                general.load_events(nanoaod_file, "Events"), cfg.genTau, cfg)
+    assert sum(len(general.load_events(path, tree_path))
+               for path in output_paths) == len(expected[f"{cfg.genTau}_pt"])
+
+
+def test_rerun_skips_checkpointed_work_units(
+        nanoaod_file, tmp_path, cfg, events, monkeypatch):
+    cfg.output_dir = str(tmp_path)
+    cfg.production.entries_per_range = 100
+    processed_units = []
+    process_entry_range = ppro.process_entry_range
+
+    def interrupted_process_entry_range(*args):
+        if args[3] == 2:
+            raise KeyboardInterrupt
+        processed_units.append(args[3])
+        return process_entry_range(*args)
+    monkeypatch.setattr(
+            ppro, "process_entry_range", interrupted_process_entry_range)
+    with pytest.raises(KeyboardInterrupt):
+        ppro.fill_ntuples_in_parallel(
+                    [nanoaod_file], "Events", [cfg.genTau], "ggH_htt", cfg)
+    assert processed_units == [0, 1]
+    monkeypatch.setattr(ppro, "process_entry_range", process_entry_range)
+    resumed_units = []
+
+    def recorded_process_entry_range(*args):
+        resumed_units.append(args[3])
+        return process_entry_range(*args)
+    monkeypatch.setattr(
+            ppro, "process_entry_range", recorded_process_entry_range)
+    ppro.fill_ntuples_in_parallel(
+                    [nanoaod_file], "Events", [cfg.genTau], "ggH_htt", cfg)
+    assert resumed_units == [2]
+    output_path, tree_path = npro.infer_output_path(cfg.genTau, "ggH_htt", cfg)
+    merged = general.load_events(output_path, tree_path)
+    expected = npro.create_ntuple(events, cfg.genTau, cfg)
+    for key in expected:
+        np.testing.assert_allclose(merged[key].to_numpy(), expected[key])
+
+
+def test_ntuple_columns_are_typed(events, cfg):
+    res = npro.create_ntuple(events, cfg.genTau, cfg)
+    assert res[f"{cfg.genTau}_pt"].dtype == np.float32
+    assert res[f"{cfg.comparison_tau}_decayMode"].dtype == np.int16
+    assert res["event"].dtype == np.int64
+    unmatched = res[f"{cfg.comparison_tau}_pt"] == -999
+    assert np.all(res[f"{cfg.comparison_tau}_decayMode"][unmatched] == -999)
+
+
+def test_combined_ntuples_match_separate_ones(events, cfg):
+    ref_objs = [cfg.genTau, cfg.fakes.recoJet]
+    expected = {
+        ref_obj: npro.create_ntuple(events, ref_obj, cfg) for ref_obj in ref_objs
+    }
+    assert_same_ntuples(expected, npro.create_ntuples(events, ref_objs, cfg))
+
+
+def test_pollution_veto_removes_jets_near_leptons(events, cfg):
+    vetoed = npro.select_suitable_ref_objects(events, cfg.fakes.recoJet, cfg)
+    cfg.quality_cuts.pollution_veto.enabled = False
+    all_jets = npro.select_suitable_ref_objects(events, cfg.fakes.recoJet, cfg)
+    assert 0 < np.sum(vetoed) < np.sum(all_jets)
+    assert not np.any(vetoed & ~all_jets)
+
+
+def test_index_matching_mostly_agrees_with_dR(events, cfg):
+    cfg.matching.method = 'index'
+    cfg.matching.report_disagreement = True
+    res = npro.create_ntuples(events, [cfg.genTau, cfg.fakes.recoJet], cfg)
+    assert np.any(res[cfg.fakes.recoJet][f"{cfg.comparison_tau}_pt"] != -999)
+    for ref_obj in [cfg.genTau, cfg.fakes.recoJet]:
+        ref_mask = npro.select_suitable_ref_objects(events, ref_obj, cfg)
+        kinematics = [
+            events[f"{ref_obj}_eta"], events[f"{ref_obj}_phi"],
+            events[f"{cfg.comparison_tau}_eta"],
+            events[f"{cfg.comparison_tau}_phi"], cfg.matching.dR_max, ref_mask
+        ]
+        matched_by_index = pm.match_by_index(
+                        pm.index_links(events, ref_obj, cfg), *kinematics)
+        matched_by_dR = pm.match_collections(*kinematics)
+        n_disagreements, n_objects = pm.count_disagreements(
+                        matched_by_index, matched_by_dR, ref_mask)
+        assert n_objects > 0
+        assert n_disagreements < 0.05 * n_objects
+
+
+def test_spatial_index_gives_same_ntuples(events, cfg):
+    cfg.production.backend = 'numpy'
+    expected = npro.create_ntuples(events, [cfg.genTau, cfg.fakes.recoJet], cfg)
+    cfg.matching.spatial_index = True
+    observed = npro.create_ntuples(events, [cfg.genTau, cfg.fakes.recoJet], cfg)
+    assert_same_ntuples(expected, observed)
+
+
+def replace_first_event(events, prefix, **values):
+    """ Replaces the objects of the collection in the first event by ones
+    with the given values, the other variables are copied from the first
+    objects of the collection """
+    n_objects = len(next(iter(values.values())))
+    counts = np.asarray(events[f"n{prefix}"])
+    counts = np.concatenate([[n_objects], counts[1:]])
+    fields = {}
+    for field in events.fields:
+        if not field.startswith(f"{prefix}_"):
+            continue
+        flat = np.asarray(awkward.flatten(events[field]))
+        first = np.asarray(values.get(field[len(prefix) + 1:], flat[:n_objects]))
+        rest = flat[awkward.num(events[field])[0]:]
+        fields[field] = awkward.unflatten(
+                np.concatenate([first.astype(flat.dtype), rest]), counts)
+    fields[f"n{prefix}"] = counts
+    return awkward.Array(
+            {field: fields.get(field, events[field]) for field in events.fields})
+
+
+def test_columnar_conflict_resolution_matches_event_by_event(cfg):
+    # Objects 0 and 1 share tau 0, objects 2 and 3 share tau 1, so the loser
+    # of the first conflict takes the tau claimed in the second one
+    events = make_events(cfg, n_events=20)
+    events = replace_first_event(
+            events, cfg.genTau, pt=np.full(4, 50.0),
+            eta=[-0.01, 0.09, 0.32, 0.33], phi=np.zeros(4))
+    events = replace_first_event(
+            events, cfg.comparison_tau, eta=[0.0, 0.2], phi=np.zeros(2))
+    assert npro.validate_columnar_ntuple(events, cfg.genTau, cfg) == {}
+    res = npro.create_ref_obj_ntuple_columnar(events[:1], cfg.genTau, cfg)
+    np.testing.assert_array_equal(
+            res[f"{cfg.comparison_tau}_eta"], np.float32([0.0, 0.2, -999, -999]))
+
+
+@pytest.mark.parametrize("algorithm", ['greedy', 'hungarian'])
+def test_event_by_event_ntuple_uses_matching_algorithm(events, cfg, algorithm):
+    cfg.matching.algorithm = algorithm
+    for ref_obj in [cfg.genTau, cfg.fakes.recoJet]:
+        assert npro.validate_columnar_ntuple(events, ref_obj, cfg) == {}
+
+
+def test_event_by_event_ntuple_rejects_index_matching(events, cfg):
+    cfg.matching.method = 'index'
+    cfg.production.columnar = False
+    with pytest.raises(ValueError):
+        npro.create_ntuple(events, cfg.genTau, cfg)
+
+
+def test_failed_work_units_report_their_errors(nanoaod_file, tmp_path, cfg):
+    cfg.output_dir = str(tmp_path)
+    cfg.production.n_workers = 2
+    corrupt_path = tmp_path / "corrupt.root"
+    corrupt_path.write_bytes(b"not a root file")
+    with pytest.raises(RuntimeError, match=r"Work units \[1\] failed") as error:
+        ppro.fill_ntuples_in_parallel(
+            [nanoaod_file, str(corrupt_path)], "Events", [cfg.genTau],
+            "ggH_htt", cfg)
+    assert f"unit 1: {type(error.value.__cause__).__name__}" in str(error.value)
+
+
+def test_manifest_key_depends_on_input_files(nanoaod_file, cfg):
+    work_units = ppro.create_work_units([nanoaod_file], "Events", cfg)
+    key = ppro.compute_manifest_key(work_units, [cfg.genTau], "ggH_htt", cfg)
+    modification_time = os.path.getmtime(nanoaod_file)
+    os.utime(nanoaod_file, (modification_time + 10, modification_time + 10))
+    assert key != ppro.compute_manifest_key(
+                            work_units, [cfg.genTau], "ggH_htt", cfg)
+
+
+def test_checkpointed_chunks_resume_after_interruption(
+        nanoaod_file, tmp_path, cfg, events, monkeypatch):
+    cfg.output_dir = str(tmp_path)
+    cfg.production.step_size = 70
+    process_entry_range = ppro.process_entry_range
+
+    def interrupted_process_entry_range(*args):
+        if args[3] == 2:
+            raise KeyboardInterrupt
+        return process_entry_range(*args)
+    monkeypatch.setattr(
+            ppro, "process_entry_range", interrupted_process_entry_range)
+    with pytest.raises(KeyboardInterrupt):
+        ppro.fill_ntuples_in_checkpointed_chunks(
+                        nanoaod_file, "Events", [cfg.genTau], "ggH_htt", cfg)
+    resumed_units = []
+
+    def recorded_process_entry_range(*args):
+        resumed_units.append(args[3])
+        return process_entry_range(*args)
+    monkeypatch.setattr(
+            ppro, "process_entry_range", recorded_process_entry_range)
+    ppro.fill_ntuples_in_checkpointed_chunks(
+                    nanoaod_file, "Events", [cfg.genTau], "ggH_htt", cfg)
+    assert resumed_units == [2, 3, 4]
+    output_path, tree_path = npro.infer_output_path(cfg.genTau, "ggH_htt", cfg)
+    merged = general.load_events(output_path, tree_path)
+    expected = npro.create_ntuple(events, cfg.genTau, cfg)
+    for key in expected:
+        np.testing.assert_array_equal(merged[key].to_numpy(), expected[key])
+
+
+@pytest.mark.parametrize("step_size", [None, 70])
+def test_empty_work_units_are_merged(nanoaod_file, tmp_path, cfg, step_size):
+    cfg.output_dir = str(tmp_path)
+    cfg.production.step_size = step_size
+    os.makedirs(tmp_path / "partial")
+    empty_paths = ppro.process_entry_range(
+            nanoaod_file, "Events", (0, 0), 0, [cfg.genTau], "ggH_htt", cfg)
+    full_paths = ppro.process_entry_range(
+            nanoaod_file, "Events", (None, None), 1, [cfg.genTau], "ggH_htt", cfg)
+    output_path, tree_path = npro.infer_output_path(cfg.genTau, "ggH_htt", cfg)
+    ppro.merge_partial_ntuples(
+            [empty_paths[cfg.genTau], full_paths[cfg.genTau]],
+            output_path, tree_path)
+    empty = general.load_events(empty_paths[cfg.genTau], tree_path)
+    merged = general.load_events(output_path, tree_path)
+    full = general.load_events(full_paths[cfg.genTau], tree_path)
+    assert len(empty) == 0
+    assert empty.fields == merged.fields
+    for field in full.fields:
+        assert merged[field].type == full[field].type
+        np.testing.assert_array_equal(
+                    merged[field].to_numpy(), full[field].to_numpy())
+
+
+@pytest.mark.parametrize("n_partials", [0, 2])
+def test_merged_ntuple_without_entries_has_tree(tmp_path, cfg, n_partials):
+    cfg.output_dir = str(tmp_path)
+    output_path, tree_path = npro.infer_output_path(cfg.genTau, "ggH_htt", cfg)
+    partial_paths = [str(tmp_path / f"partial_{idx}.root") for idx in range(n_partials)]
+    dtypes = npro.ntuple_dtypes(cfg)
+    for partial_path in partial_paths:
+        npro.NtupleWriter(partial_path, tree_path, dtypes=dtypes).close()
+    ppro.merge_partial_ntuples(
+            partial_paths, output_path, tree_path, dtypes=dtypes)
+    with uproot.open(output_path) as output_file:
+        assert output_file[tree_path].num_entries == 0
+    merged = general.load_events(output_path, tree_path)
+    assert set(merged.fields) == set(dtypes)
+    for field, dtype in dtypes.items():
+        assert merged[field].to_numpy().dtype == dtype
+
+
+@pytest.mark.parametrize("columnar", [True, False])
+def test_pollution_veto_keeps_jets_of_genuine_taus(events, cfg, columnar):
+    cfg.production.columnar = columnar
+    jet_key = f"{cfg.fakes.recoJet}_pt"
+    vetoed = npro.create_ntuple(events, cfg.genTau, cfg)
+    assert np.any(vetoed[jet_key] != -999)
+    cfg.quality_cuts.pollution_veto.enabled = False
+    not_vetoed = npro.create_ntuple(events, cfg.genTau, cfg)
+    np.testing.assert_array_equal(vetoed[jet_key], not_vetoed[jet_key])
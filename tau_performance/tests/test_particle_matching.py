@@ -1,4 +1,6 @@
-from tau_performance import particle_matching as pm
+import numpy as np
+import awkward
+from tau_performance.tools import particle_matching as pm
 
 
 def test_check_for_double_count():
@@ -12,3 +14,108 @@ def test_check_for_double_count():
     observed_double_count, obj_sharing = pm.check_for_double_count(input_map)
     assert expected_double_count == observed_double_count
     assert obj_sharing == [2, 4]
+
+
+def legacy_deltaPhi(phi1, phi2):
+    phi = np.abs(phi1 - phi2)
+    if phi <= np.pi:
+        return phi
+    else:
+        return 2*np.pi - phi
+
+
+def test_deltaPhi_scalars_match_legacy():
+    rng = np.random.default_rng(1)
+    for phi1, phi2 in rng.uniform(-np.pi, np.pi, (100, 2)):
+        assert pm.deltaPhi(phi1, phi2) == legacy_deltaPhi(phi1, phi2)
+    assert pm.deltaPhi(-3.1, 3.1) == legacy_deltaPhi(-3.1, 3.1)
+
+
+def test_deltaR_broadcasts_over_arrays():
+    eta = np.array([0.0, 1.0, -1.0])
+    phi = np.array([3.1, -3.1, 0.5])
+    expected = [pm.deltaR(e, p, 0.2, -3.0) for e, p in zip(eta, phi)]
+    np.testing.assert_allclose(pm.deltaR(eta, phi, 0.2, -3.0), expected)
+    jagged = awkward.Array([[0.0, 1.0], [], [-1.0]])
+    jagged_phi = awkward.Array([[3.1, -3.1], [], [0.5]])
+    observed = pm.deltaR(jagged, jagged_phi, 0.2, -3.0)
+    np.testing.assert_allclose(awkward.flatten(observed), expected)
+
+
+def test_deltaR_matrix_pairs_objects_per_event():
+    eta1 = awkward.Array([[0.0, 1.0], [2.0]])
+    phi1 = awkward.Array([[0.0, 3.0], [-3.0]])
+    eta2 = awkward.Array([[0.5, 1.0, 0.0], []])
+    phi2 = awkward.Array([[0.0, -3.0, 0.1], []])
+    distances = pm.deltaR_matrix(eta1, phi1, eta2, phi2)
+    assert awkward.num(distances, axis=2).tolist() == [[3, 3], [0]]
+    flat = pm.deltaR_matrix(eta1[0], phi1[0], eta2[0], phi2[0])
+    np.testing.assert_allclose(distances[0].to_list(), flat)
+    assert flat[1, 1] == pm.deltaR(1.0, 3.0, 1.0, -3.0)
+
+
+def test_match_collections_resolves_conflicts_closest_first():
+    ref_eta = awkward.Array([[0.0, 0.1, 2.0], [], [1.0]])
+    ref_phi = awkward.Array([[0.0, 0.0, 0.0], [], [1.0]])
+    tau_eta = awkward.Array([[0.08, 2.5, 2.1], [0.0], []])
+    tau_phi = awkward.Array([[0.0, 0.0, 0.0], [0.0], []])
+    matched = pm.match_collections(ref_eta, ref_phi, tau_eta, tau_phi, 0.3)
+    assert matched.tolist() == [[-1, 0, 2], [], [-1]]
+    ref_mask = awkward.Array([[True, False, True], [], [True]])
+    matched = pm.match_collections(
+                        ref_eta, ref_phi, tau_eta, tau_phi, 0.3, ref_mask)
+    assert matched.tolist() == [[0, -1, 2], [], [-1]]
+
+
+def test_match_collections_greedy():
+    ref_eta = awkward.Array([[0.0, 0.1, 2.0], [], [1.0]])
+    ref_phi = awkward.Array([[0.0, 0.0, 0.0], [], [1.0]])
+    tau_eta = awkward.Array([[0.08, 0.2, 2.1], [0.0], []])
+    tau_phi = awkward.Array([[0.0, 0.0, 0.0], [0.0], []])
+    matched = pm.match_collections(
+            ref_eta, ref_phi, tau_eta, tau_phi, 0.3, algorithm='greedy')
+    assert matched.tolist() == [[1, 0, 2], [], [-1]]
+
+
+def test_match_by_index_falls_back_to_dR():
+    ref_eta = awkward.Array([[0.0, 1.0, 2.0], [0.5]])
+    ref_phi = awkward.Array([[0.0, 0.0, 0.0], [0.0]])
+    tau_eta = awkward.Array([[1.05, 0.02, 2.9], [0.45]])
+    tau_phi = awkward.Array([[0.0, 0.0, 0.0], [0.0]])
+    links = awkward.Array([[1, -1, 0], [-1]])
+    matched = pm.match_by_index(
+                        links, ref_eta, ref_phi, tau_eta, tau_phi, 0.3)
+    # The link of tau 2 is beyond dR_max, so object 0 is matched by dR
+    assert matched.tolist() == [[1, 0, -1], [0]]
+
+
+def test_match_by_index_ignores_links_to_unselected_objects():
+    ref_eta = awkward.Array([[0.0, 1.0]])
+    ref_phi = awkward.Array([[0.0, 0.0]])
+    tau_eta = awkward.Array([[0.05, 0.98]])
+    tau_phi = awkward.Array([[0.0, 0.0]])
+    links = awkward.Array([[-1, 0]])
+    ref_mask = awkward.Array([[False, True]])
+    matched = pm.match_by_index(
+                links, ref_eta, ref_phi, tau_eta, tau_phi, 0.3, ref_mask)
+    assert matched.tolist() == [[-1, 1]]
+
+
+def test_closest_first_reassigns_like_the_event_path(cfg):
+    # Objects 0 and 1 share tau 0, objects 2 and 3 share tau 1. The loser of
+    # the first conflict takes tau 1, which is claimed by the second one
+    ref_eta = np.array([-0.01, 0.09, 0.32, 0.33])
+    tau_eta = np.array([0.0, 0.2])
+    event = {
+        f"{cfg.genTau}_eta": ref_eta, f"{cfg.genTau}_phi": np.zeros(4),
+        f"{cfg.comparison_tau}_eta": tau_eta,
+        f"{cfg.comparison_tau}_phi": np.zeros(2)
+    }
+    expected = pm.match_taus_to_refs(range(4), event, cfg.genTau, cfg)
+    assert expected == {0: 0, 1: 1}
+    for backend in ['numpy', 'numba']:
+        matched = pm.match_collections(
+                awkward.Array([ref_eta]), awkward.Array([np.zeros(4)]),
+                awkward.Array([tau_eta]), awkward.Array([np.zeros(2)]),
+                cfg.matching.dR_max, backend=backend)
+        assert matched.tolist() == [[0, 1, -1, -1]]
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from tau_performance.tools import particle_matching as pm
+from tau_performance.tools import spatial_index
+
+
+def random_objects(rng, n_events, max_objects):
+    counts = rng.integers(0, max_objects, n_events)
+    n_total = np.sum(counts)
+    eta = rng.uniform(-2.5, 2.5, n_total)
+    # Crowd the objects around the phi = +-pi boundary
+    phi = np.where(rng.random(n_total) < 0.5,
+                   rng.uniform(-np.pi, np.pi, n_total),
+                   np.pi - rng.uniform(-0.2, 0.2, n_total))
+    phi = (phi + np.pi) % (2*np.pi) - np.pi
+    return eta, phi, counts
+
+
+@pytest.mark.parametrize("dR_max", [0.05, 0.3, 0.4, 2.5, 4.0])
+def test_grid_finds_all_close_pairs(dR_max):
+    rng = np.random.default_rng(11)
+    refs = random_objects(rng, 50, 40)
+    taus = random_objects(rng, 50, 40)
+    expected = pm.form_candidate_pairs(*refs, *taus, dR_max)
+    observed = pm.form_candidate_pairs(*refs, *taus, dR_max, use_grid=True)
+    assert len(expected[0]) > 0
+    for expected_values, observed_values in zip(expected, observed):
+        np.testing.assert_array_equal(observed_values, expected_values)
+
+
+def test_grid_skips_far_pairs():
+    rng = np.random.default_rng(12)
+    refs = random_objects(rng, 20, 60)
+    taus = random_objects(rng, 20, 60)
+    ref_idx, _ = spatial_index.neighbour_pairs(*refs, *taus, 0.3)
+    assert len(ref_idx) < 0.1 * np.sum(refs[2] * taus[2])
@@ -1,6 +1,11 @@
 from . import general
 from . import ntuple_production
+from . import kernels
+from . import spatial_index
+from . import matching_algorithms
 from . import particle_matching
 from . import decay_mode_reconstruction
 from . import masking
-from . import efficiency
\ No newline at end of file
+from . import uncertainties
+from . import efficiency
+from . import parallel_production
\ No newline at end of file
@@ -0,0 +1,240 @@
+""" Tools for recognizing outputs that were already produced from the same
+inputs, configuration and code """
+import os
+import json
+import hashlib
+import numpy as np
+from omegaconf import DictConfig, OmegaConf
+from tau_performance.tools import general
+from tau_performance.tools import ntuple_production
+from tau_performance.tools import particle_matching
+from tau_performance.tools import matching_algorithms
+from tau_performance.tools import kernels
+from tau_performance.tools import spatial_index
+
+NTUPLE_CODE_MODULES = [
+    general, ntuple_production, particle_matching, matching_algorithms,
+    kernels, spatial_index]
+
+
+def hash_content(content) -> str:
+    """ Hashes any JSON serializable content independently of the key order """
+    serialized = json.dumps(content, sort_keys=True)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+def hash_file(path: str, block_size: int = 2**20) -> str:
+    """ Calculates the checksum of the file content """
+    checksum = hashlib.sha256()
+    with open(path, "rb") as input_file:
+        for block in iter(lambda: input_file.read(block_size), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def file_identity(path: str, checksum: bool = False) -> dict:
+    """ Describes the identity of a file either by its path, size and
+    modification time or, if requested, by the checksum of its content
+
+    Args:
+        path : str
+            Path to the file
+        checksum : bool
+            [default: False] Whether to identify the file by its content
+
+    Returns:
+        identity : dict
+            The properties identifying the file
+    """
+    identity = {"path": os.path.abspath(path), "size": os.path.getsize(path)}
+    if checksum:
+        identity["sha256"] = hash_file(path)
+    else:
+        identity["mtime"] = os.path.getmtime(path)
+    return identity
+
+
+def code_version(modules: list = NTUPLE_CODE_MODULES) -> str:
+    """ Hashes the source of the modules that determine the output content """
+    checksum = hashlib.sha256()
+    for module in modules:
+        with open(module.__file__, "rb") as source_file:
+            checksum.update(source_file.read())
+    return checksum.hexdigest()
+
+
+def ntuple_config(cfg: DictConfig) -> dict:
+    """ Collects the parts of the configuration that affect the content of
+    the produced ntuples """
+    return {
+        "comparison_tau": cfg.comparison_tau,
+        "genTau": cfg.genTau,
+        "fakes": OmegaConf.to_container(cfg.fakes, resolve=True),
+        "matching": OmegaConf.to_container(cfg.matching, resolve=True),
+        "quality_cuts": OmegaConf.to_container(cfg.quality_cuts, resolve=True),
+        "allVariables": OmegaConf.to_container(cfg.allVariables, resolve=True),
+        "column_dtypes": OmegaConf.to_container(
+                                cfg.production.column_dtypes, resolve=True),
+        "merge": cfg.production.merge,
+    }
+
+
+def compute_ntuple_key(input_paths: list, cfg: DictConfig) -> str:
+    """ Computes the cache key of the ntuples produced from the given input
+    files with the given configuration by the current code
+
+    Args:
+        input_paths : list
+            Paths of the input .root files
+        cfg : omegaconf.DictConfig
+            The configuration
+
+    Returns:
+        key : str
+            The cache key
+    """
+    checksum = cfg.production.cache.checksum
+    return hash_content({
+        "inputs": [file_identity(path, checksum) for path in input_paths],
+        "config": ntuple_config(cfg),
+        "code": code_version(),
+    })
+
+
+def cache_record_path(output_path: str) -> str:
+    """ Path of the record storing the cache key next to the output """
+    return f"{output_path}.cache.json"
+
+
+def is_cached(output_paths: list, key: str) -> bool:
+    """ Checks whether all the outputs exist and were produced with the key
+
+    Args:
+        output_paths : list
+            Paths of the outputs
+        key : str
+            The cache key of the current inputs and configuration
+
+    Returns:
+        cached : bool
+            Whether the outputs can be reused
+    """
+    if not output_paths:
+        return False
+    for output_path in output_paths:
+        record_path = cache_record_path(output_path)
+        if not (os.path.exists(output_path) and os.path.exists(record_path)):
+            return False
+        with open(record_path, "rt") as record_file:
+            if json.load(record_file)["key"] != key:
+                return False
+    return True
+
+
+def record_cache(output_paths: list, key: str, inputs: list = None) -> None:
+    """ Stores the cache key next to each of the produced outputs
+
+    Args:
+        output_paths : list
+            Paths of the produced outputs
+        key : str
+            The cache key of the inputs and configuration used
+        inputs : list
+            [default: None] The input paths, stored for reference only
+
+    Returns:
+        None
+    """
+    for output_path in output_paths:
+        with open(cache_record_path(output_path), "wt") as record_file:
+            json.dump({"key": key, "inputs": inputs}, record_file, indent=4)
+    return None
+
+
+def remove_outputs(output_paths: list) -> None:
+    """ Removes the outputs together with their cache records, so that no
+    stale output of an earlier production is taken as cached
+
+    Args:
+        output_paths : list
+            Paths of the outputs
+
+    Returns:
+        None
+    """
+    for output_path in output_paths:
+        for path in [output_path, cache_record_path(output_path)]:
+            if os.path.exists(path):
+                os.remove(path)
+    return None
+
+
+def compute_result_key(
+        ntuple_path: str,
+        content: dict,
+        modules: list,
+        checksum: bool = False) -> str:
+    """ Computes the cache key of the results reduced from an ntuple
+
+    Args:
+        ntuple_path : str
+            Path of the ntuple the results are calculated from
+        content : dict
+            JSON serializable description of the results, e.g. the cuts and
+            binning from the configuration
+        modules : list
+            The modules that calculate the results
+        checksum : bool
+            [default: False] Whether to identify the ntuple by its content
+
+    Returns:
+        key : str
+            The cache key
+    """
+    return hash_content({
+        "ntuple": file_identity(ntuple_path, checksum),
+        "content": content,
+        "code": code_version(modules),
+    })
+
+
+def result_cache_path(cfg: DictConfig, kind: str, key: str) -> str:
+    """ Path of the cached results of the given kind and key, None if the
+    result cache is disabled """
+    cache_cfg = cfg.performance.result_cache
+    if not cache_cfg.enabled:
+        return None
+    return os.path.join(cfg.output_dir, cache_cfg.directory, f"{kind}_{key[:16]}.npz")
+
+
+def save_arrays(path: str, arrays: dict, metadata: dict) -> None:
+    """ Stores the named arrays and the JSON serializable metadata in a
+    compressed .npz file. The file is written under a temporary name first,
+    so that an interrupted run does not leave a partial file behind
+
+    Args:
+        path : str
+            Path of the .npz file
+        arrays : dict
+            The arrays to be stored, keyed by name
+        metadata : dict
+            Information describing the arrays
+
+    Returns:
+        None
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as output_file:
+        np.savez_compressed(
+                output_file, metadata=np.array(json.dumps(metadata)), **arrays)
+    os.replace(temporary_path, path)
+    return None
+
+
+def load_arrays(path: str) -> tuple[dict, dict]:
+    """ Loads the arrays and the metadata stored with save_arrays """
+    with np.load(path, allow_pickle=False) as content:
+        arrays = {name: content[name] for name in content.files}
+    metadata = json.loads(str(arrays.pop("metadata")))
+    return arrays, metadata
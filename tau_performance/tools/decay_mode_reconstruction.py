@@ -1,4 +1,5 @@
 import os
+import sys
 import uproot
 import awkward
 import numpy as np
@@ -7,6 +8,7 @@ import matplotlib.pyplot as plt
 from sklearn.metrics import confusion_matrix
 from omegaconf import  OmegaConf, DictConfig
 from . import general
+from . import caching
 
 
 def extract_dm_info(conf_entry):
@@ -91,25 +93,53 @@ def extract_matched_tau_decay_modes(
     return truth_dms, comparison_dms
 
 
-def decay_mode_reconstruction(cfg: DictConfig) -> None:
+def decay_mode_reconstruction(
+        cfg: DictConfig,
+        event_store: general.EventStore = None) -> None:
     """ Collects all functions in order to estimate the tau decay mode
-    reconstruction
+    reconstruction. The confusion matrix is stored in the result cache and
+    loaded from there while the ntuple and the configuration are unchanged
 
     Args:
         cfg: omegaconf.DictConfig
             The configuration for plotting
+        event_store : general.EventStore
+            [default: None] Store to read the events through, shared with
+            the other stages
     Returns:
         None
     """
-    print("Started loading file")
     input_path = os.path.join(
                         cfg.output_dir, cfg.TauID_eff.data_files.ggH_htt.path)
-    events = general.load_events(
-        input_path, cfg.TauID_eff.data_files.ggH_htt.tree_path)
+    tree_path = cfg.TauID_eff.data_files.ggH_htt.tree_path
+    cache_path = caching.result_cache_path(
+        cfg, "decay_modes", caching.compute_result_key(
+            input_path,
+            {
+                "tree": tree_path,
+                "comparison_tau": cfg.comparison_tau,
+                "genTau": cfg.genTau,
+            },
+            [general, sys.modules[__name__]], cfg.production.cache.checksum))
+    if cache_path is not None and os.path.exists(cache_path):
+        print(f"Loading the cached confusion matrix from {cache_path}")
+        arrays, _ = caching.load_arrays(cache_path)
+        plot_confusion_matrix(arrays["confusion_matrix"], cfg)
+        return
+    print("Started loading file")
+    if event_store is None:
+        event_store = general.EventStore()
+    events = event_store.load(
+        input_path, tree_path,
+        [f"{cfg.comparison_tau}_decayMode", f"{cfg.genTau}_status"])
     print("Finished loading file")
     truth_dms, comparison_dms = extract_matched_tau_decay_modes(events, cfg)
     conf_matrix = confusion_matrix(
                                   truth_dms, comparison_dms,
                                   labels=[0,1,2,10,11,15],
                                   normalize='true')
+    if cache_path is not None:
+        caching.save_arrays(
+            cache_path, {"confusion_matrix": conf_matrix},
+            {"labels": [0, 1, 2, 10, 11, 15], "n_taus": len(truth_dms)})
     plot_confusion_matrix(conf_matrix, cfg)
@@ -1,16 +1,30 @@
 import os
+import sys
 import uproot
 import awkward
 import numpy as np
 from omegaconf import DictConfig, OmegaConf
 from tau_performance.tools import general
-from tau_performance.tools.masking import Masks
+from tau_performance.tools import caching
+from tau_performance.tools import masking
+from tau_performance.tools import uncertainties
+from tau_performance.tools.masking import construct_cut_var_names, iterate_masks
+
+# Number of working point masks unpacked at a time when filling the histograms
+WP_BLOCK_SIZE = 8
 
 
 class Efficiency:
     """ Class for calculating either the fake rate or efficiency given the
-    correct parameters """
-    def __init__(self, sample_name, comparison_tau, input_path, input_tree, ref_obj, cfg):
+    correct parameters. The numerator and denominator histograms are
+    accumulated over the chunks of the ntuple when performance.step_size is
+    set, otherwise the whole ntuple is loaded and the events and masks can be
+    shared with the other stages through an event store and a mask cache.
+    The accumulated histograms and counts are stored in the result cache and
+    loaded from there while the ntuple and the configuration are unchanged """
+    def __init__(
+            self, sample_name, comparison_tau, input_path, input_tree, ref_obj,
+            cfg, event_store=None, mask_cache=None):
         self.sample_name = sample_name
         self.ref_obj = ref_obj
         self.cfg = cfg
@@ -18,65 +32,255 @@ class Efficiency:
         self._efficiencies = {}
         self._reco_eff = {}
         self._total_effs = {}
+        self._numerator_histos = {}
+        self._denominator_histos = {}
+        self._n_passing = {}
+        self._n_denominator = 0
         self.eff_type = "eff" if self.ref_obj == cfg.genTau else "fake"
-        self.events = general.load_events(input_path, input_tree)
-        self.numerators = Masks(self.events, "numerators", ref_obj, cfg).masks
-        self.denominator = Masks(self.events, "denominators", ref_obj, cfg).masks
+        self.numerators = masking.read_working_points(cfg, "numerators", ref_obj)
+        cache_path = caching.result_cache_path(
+                    cfg, f"{self.eff_type}_{sample_name}",
+                    self.compute_result_key(input_path, input_tree))
+        if cache_path is not None and os.path.exists(cache_path):
+            print(f"Loading the cached {self.eff_type} results from {cache_path}")
+            self.restore(*caching.load_arrays(cache_path))
+        else:
+            self.initialize_results()
+            step_size = cfg.performance.step_size
+            for events, numerator_masks, denominator_masks in iterate_masks(
+                            input_path, input_tree, self.construct_branch_names(),
+                            ref_obj, cfg, step_size, event_store, mask_cache):
+                self.accumulate(events, numerator_masks, denominator_masks)
+                self.release_chunk()
+            if cache_path is not None:
+                caching.save_arrays(cache_path, *self.reduced_results())
         self.calculate_var_efficiencies()
 
+    def release_chunk(self):
+        """ Drops the references to the events and masks of the last
+        accumulated chunk, only the histograms and counts are kept """
+        self.events = self.masks = self.denominator = self.selected = None
+
+    def initialize_results(self):
+        """ Sets the histograms and counts of all variables and working
+        points to zero, so that an ntuple without entries gives empty
+        results """
+        self.release_chunk()
+        self._n_passing = {key: 0 for key in self.wp_keys}
+        variables = {**self.efficiency_variables, **self.reco_variables}
+        for var_name, bins in variables.items():
+            empty = np.zeros(len(bins) - 1, dtype=np.int64)
+            self._numerator_histos[var_name] = {
+                key: general.Histogram(empty, bins, 'Numerator', binned=True)
+                for key in self.wp_keys}
+            self._denominator_histos[var_name] = general.Histogram(
+                                    empty, bins, "Denominator", binned=True)
+
+    def compute_result_key(self, input_path, input_tree):
+        content = {
+            "tree": input_tree,
+            "ref_obj": self.ref_obj,
+            "comparison_tau": self.comparison_tau,
+            "genTau": self.cfg.genTau,
+            "TauID": OmegaConf.to_container(
+                        self.cfg[f"TauID_{self.eff_type}"], resolve=True),
+        }
+        return caching.compute_result_key(
+                    input_path, content,
+                    [general, masking, sys.modules[__name__]],
+                    self.cfg.production.cache.checksum)
+
+    def reduced_results(self):
+        """ The accumulated histograms and counts as named arrays, with the
+        working points of each ID as metadata """
+        arrays = {"n_denominator": np.array(self._n_denominator)}
+        for (tau_id_key, wp_key), n_passing in self._n_passing.items():
+            arrays[f"n_passing::{tau_id_key}::{wp_key}"] = np.array(n_passing)
+        for var_name, h_gen in self._denominator_histos.items():
+            for name, value in h_gen.to_dict().items():
+                arrays[f"denominator::{var_name}::{name}"] = np.asarray(value)
+            for (tau_id_key, wp_key), histogram in self._numerator_histos[var_name].items():
+                for name, value in histogram.to_dict().items():
+                    arrays[f"numerator::{var_name}::{tau_id_key}::{wp_key}::{name}"
+                           ] = np.asarray(value)
+        metadata = {
+            "sample_name": self.sample_name,
+            "ref_obj": self.ref_obj,
+            "comparison_tau": self.comparison_tau,
+            "numerators": self.numerators,
+        }
+        return arrays, metadata
+
+    def restore(self, arrays, metadata):
+        """ Sets the accumulated histograms and counts from reduced_results """
+        self.numerators = metadata["numerators"]
+        self.release_chunk()
+        self._n_denominator = int(arrays["n_denominator"])
+        histograms = {}
+        for name, value in arrays.items():
+            kind, *keys = name.split("::")
+            if kind == "n_passing":
+                self._n_passing[tuple(keys)] = int(value)
+            elif kind in ["numerator", "denominator"]:
+                *histogram_key, field = keys
+                histograms.setdefault((kind, *histogram_key), {})[field] = value
+        for (kind, var_name, *wp), content in histograms.items():
+            histogram = general.Histogram.from_dict(content)
+            if kind == "denominator":
+                self._denominator_histos[var_name] = histogram
+            else:
+                self._numerator_histos.setdefault(var_name, {})[tuple(wp)] = histogram
+        for var_name in self._numerator_histos:
+            self._numerator_histos[var_name] = {
+                key: self._numerator_histos[var_name][key] for key in self.wp_keys}
+
+    def construct_branch_names(self):
+        eff_cfg = self.cfg[f"TauID_{self.eff_type}"]
+        branches = [f"{self.ref_obj}_{var.name}" for var in eff_cfg.variables.genTau]
+        branches.extend(var.name for var in eff_cfg.variables.other)
+        branches.extend(
+            f"{self.comparison_tau}_{var.name}" for var in eff_cfg.variables.recoTau)
+        for mask_type in ["numerators", "denominators"]:
+            branches.extend(
+                    construct_cut_var_names(self.cfg, mask_type, self.ref_obj))
+        return general.unique(branches)
+
     def infer_input_path(self):
         file_name = self.cfg[f"TauID_{self.eff_type}"].data_files[self.sample_name].path
         full_path = os.path.join(self.cfg.output_dir, file_name)
         return full_path
 
+    @property
+    def efficiency_variables(self):
+        """ Bins of the reference object and event variables """
+        variables = self.cfg[f"TauID_{self.eff_type}"].variables
+        bins = {
+            f"{self.ref_obj}_{var.name}": np.array(var.bins)
+            for var in variables.genTau}
+        bins.update({var.name: np.array(var.bins) for var in variables.other})
+        return bins
+
+    @property
+    def reco_variables(self):
+        """ Bins of the comparison tau variables """
+        return {
+            f"{self.comparison_tau}_{var.name}": np.array(var.bins)
+            for var in self.cfg[f"TauID_{self.eff_type}"].variables.recoTau}
+
+    @property
+    def wp_keys(self):
+        return [
+            (tau_id_key, wp_key) for tau_id_key, wps in self.numerators.items()
+            for wp_key in wps]
+
+    def accumulate(self, events, numerator_masks, denominator_masks):
+        """ Adds the entries of the events to the numerator and denominator
+        histograms of all variables and to the total efficiency counts
+
+        Args:
+            events : awkward.Array
+                The events of the ntuple or of one chunk of it
+            numerator_masks : masking.Masks
+                The numerator masks of the events
+            denominator_masks : masking.Masks
+                The denominator masks of the events
+
+        Returns:
+            None
+        """
+        self.events = events
+        self.masks = numerator_masks.store
+        self.denominator = denominator_masks.store.packed('Base')
+        self._n_denominator += self.masks.count(self.denominator)
+        self.selected = self.masks.unpack(self.denominator)
+        for key in self.wp_keys:
+            self._n_passing[key] += self.masks.count(
+                                self.masks.logical_and(key, self.denominator))
+        variables = {**self.efficiency_variables, **self.reco_variables}
+        for var_name, bins in variables.items():
+            binned = self.fill_histograms(var_name, bins)
+            numerators = [
+                general.Histogram(wp_binned, bins, 'Numerator', binned=True)
+                for wp_binned in binned[:-1]]
+            denominator = general.Histogram(binned[-1], bins, "Denominator", binned=True)
+            for key, numerator in zip(self.wp_keys, numerators):
+                self._numerator_histos[var_name][key] += numerator
+            self._denominator_histos[var_name] += denominator
+
     def calculate_var_efficiencies(self):
-        for tau_var in self.cfg[f"TauID_{self.eff_type}"].variables.genTau:
-            var_name = f"{self.ref_obj}_{tau_var.name}"
-            self._efficiencies[var_name] = self.calculate_id_efficiencies(
-                                            var_name, np.array(tau_var.bins))
-        for other_var in self.cfg[f"TauID_{self.eff_type}"].variables.other:
-            self._efficiencies[other_var.name] = self.calculate_id_efficiencies(
-                                    other_var.name, np.array(other_var.bins))
-        for reco_var in self.cfg[f"TauID_{self.eff_type}"].variables.recoTau:
-            var_name = f"{self.comparison_tau}_{reco_var.name}"
+        self.calculate_total_efficiencies()
+        for var_name in self.efficiency_variables:
+            self._efficiencies[var_name] = self.calculate_id_efficiencies(var_name)
+        for var_name in self.reco_variables:
             self._reco_eff[var_name] = {}
-            self.calculate_reco_efficiencies(var_name, reco_var.bins)
+            self.calculate_reco_efficiencies(var_name)
 
-    def calculate_id_efficiencies(self, var_name, bins):
-        id_eff = {}
-        for tau_id_key in self.numerators:
-            full_id_key = f"{self.comparison_tau}_{tau_id_key}"
-            wp_numerators = self.numerators[tau_id_key]
-            id_eff[tau_id_key], total_eff = self.calculate_wp_efficiencies(
-                                                var_name, bins, wp_numerators)
-            self._total_effs[tau_id_key] = total_eff
+    def fill_histograms(self, var_name, bins):
+        """ Fills the denominator and the numerators of all IDs and working
+        points of the variable. The bin of each entry is found once and the
+        working point masks are unpacked WP_BLOCK_SIZE at a time, with one
+        bincount over the combined (working point, bin) index of each block,
+        so that the masks are never all expanded at once
+
+        Args:
+            var_name : str
+                Name of the variable to be binned
+            bins : np.array
+                Edges of the bins
+
+        Returns:
+            binned : np.array
+                Entries per bin, one row per working point in the order of
+                wp_keys and the denominator as the last row
+        """
+        n_bins = len(bins) - 1
+        keys = self.wp_keys
+        bin_idx = general.bin_indices(self.events[var_name].to_numpy(), bins)
+        selected = self.selected & (bin_idx >= 0)
+        bin_idx = bin_idx[selected]
+        binned = np.zeros((len(keys) + 1, n_bins), dtype=np.int64)
+        for start in range(0, len(keys), WP_BLOCK_SIZE):
+            block = self.masks.unpack_rows(keys[start:start + WP_BLOCK_SIZE])
+            wp_idx, entry_idx = np.nonzero(block[:, selected])
+            binned[start:start + len(block)] = np.bincount(
+                        wp_idx * n_bins + bin_idx[entry_idx],
+                        minlength=len(block) * n_bins).reshape(len(block), n_bins)
+        binned[-1] = np.bincount(bin_idx, minlength=n_bins)
+        return binned
+
+    def calculate_total_efficiencies(self):
+        """ Fractions of the denominator entries passing each working point,
+        NaN if no entry passes the denominator """
+        for tau_id_key, wps in self.numerators.items():
+            self._total_effs[tau_id_key] = [
+                self._n_passing[(tau_id_key, wp_key)] / self._n_denominator
+                if self._n_denominator > 0 else np.nan
+                for wp_key in wps]
+
+    def calculate_id_efficiencies(self, var_name):
+        """ Efficiencies of all IDs and working points of the variable, with
+        the confidence intervals of all their bins computed in one call """
+        h_gen = self._denominator_histos[var_name]
+        numerators = self._numerator_histos[var_name]
+        interval_cfg = self.cfg.performance.efficiency_interval
+        lower, upper = uncertainties.efficiency_intervals(
+                        np.stack([h.binned_data for h in numerators.values()]),
+                        h_gen.binned_data, h_gen.sumw2,
+                        method=interval_cfg.method,
+                        confidence=interval_cfg.confidence)
+        id_eff = {tau_id_key: {} for tau_id_key in self.numerators}
+        for i, ((tau_id_key, wp_key), h_cleaned) in enumerate(numerators.items()):
+            efficiency = h_cleaned/h_gen
+            efficiency.interval = (lower[i], upper[i])
+            id_eff[tau_id_key][wp_key] = efficiency
         return id_eff
 
-    def calculate_wp_efficiencies(self, var_name, bins, wp_numerators):
-        efficiency_histograms = {}
-        total_efficiency = []
-        all_entries = self.events[var_name].to_numpy()
-        tau_entries = all_entries[self.denominator]
-        h_gen = general.Histogram(tau_entries, bins, "Denominator")
-        for wp_numerator_key in wp_numerators:
-            full_mask = self.denominator & wp_numerators[wp_numerator_key]
-            cleaned_comparison = all_entries[full_mask]
-            total_efficiency.append(len(cleaned_comparison)/len(tau_entries))
-            h_cleaned = general.Histogram(cleaned_comparison, bins, 'Numerator')
-            efficiency_histograms[wp_numerator_key] = h_cleaned/h_gen
-        return efficiency_histograms, total_efficiency
-
-    def calculate_reco_efficiencies(self, var_name, bins):
+    def calculate_reco_efficiencies(self, var_name):
         for tau_id_key in self.numerators:
-            wp_numerators = self.numerators[tau_id_key]
-            efficiency_histograms = {}
-            iso_key = f"{self.comparison_tau}_{tau_id_key}"
-            for wp_numerator_key in wp_numerators:
-                full_mask = self.denominator & wp_numerators[wp_numerator_key]
-                var_entries = self.events[var_name][full_mask]
-                histo_full = np.histogram(np.array(var_entries), bins=bins)
-                efficiency_histograms[wp_numerator_key] = histo_full
-            self._reco_eff[var_name][tau_id_key] = efficiency_histograms
+            self._reco_eff[var_name][tau_id_key] = {}
+        for (tau_id_key, wp_key), histogram in self._numerator_histos[var_name].items():
+            self._reco_eff[var_name][tau_id_key][wp_key] = (
+                                histogram.binned_data, histogram.bin_edges)
 
     @property
     def efficiencies(self):
@@ -89,3 +293,13 @@ class Efficiency:
     @property
     def total_efficiencies(self):
         return self._total_effs
+
+    @property
+    def numerator_histos(self):
+        """ Numerator histograms of each variable, keyed by (ID, working
+        point) """
+        return self._numerator_histos
+
+    @property
+    def denominator_histos(self):
+        return self._denominator_histos
@@ -1,4 +1,6 @@
 """ Some general tools """
+import os
+import glob
 import uproot
 import awkward
 from omegaconf import DictConfig
@@ -6,74 +8,357 @@ import numpy as np
 
 
 class Histogram:
+    """ Counts and the sum of the squared weights per bin, kept as NumPy
+    arrays. Histograms with the same bin edges can be merged, also in place,
+    and converted to and from a dictionary of arrays, so that partial
+    histograms of chunks or processes are reduced without the raw data.
+    Efficiency histograms can carry the (lower, upper) bounds of the
+    confidence interval of each bin in .interval """
+    __slots__ = (
+        'data', 'histogram_data_type', 'bin_edges', 'binned_data', 'sumw2',
+        'interval')
+
     def __init__(
             self,
             data: np.array,
             bin_edges: np.array,
             histogram_data_type: str,
-            binned=False) -> None:
-        """ Initializes the histogram"""
-        self.data = data
+            binned=False,
+            weights: np.array = None,
+            sumw2: np.array = None,
+            keep_data=True) -> None:
+        """ Initializes the histogram
+
+        Args:
+            data : np.array
+                The values to be binned, or the counts per bin if binned
+            bin_edges : np.array
+                Edges of the bins
+            histogram_data_type : str
+                Name of the contents of the histogram
+            binned : bool
+                [default: False] Whether the data is already binned
+            weights : np.array
+                [default: None] Weights of the values. Unit weights if None
+            sumw2 : np.array
+                [default: None] Sum of the squared weights per bin of the
+                binned data. Equal to the counts if None
+            keep_data : bool
+                [default: True] Whether to keep the unbinned values in .data
+        """
         self.histogram_data_type = histogram_data_type
-        self.bin_edges = bin_edges
-        self.bin_centers = self.calculate_bin_centers(bin_edges)
-        if not binned:
-            self.binned_data = np.histogram(data, bins=bin_edges)[0]
+        self.bin_edges = np.asarray(bin_edges, dtype=float)
+        self.data = None
+        self.interval = None
+        if binned:
+            self.binned_data = np.array(data)
+            self.sumw2 = np.array(data if sumw2 is None else sumw2, dtype=float)
         else:
-            self.binned_data = data
+            data = np.asarray(data)
+            self.binned_data = np.histogram(
+                                data, bins=self.bin_edges, weights=weights)[0]
+            if weights is None:
+                self.sumw2 = self.binned_data.astype(float)
+            else:
+                self.sumw2 = np.histogram(
+                    data, bins=self.bin_edges,
+                    weights=np.square(weights, dtype=float))[0]
+            if keep_data:
+                self.data = data
 
-    def calculate_bin_centers(self, edges: list) -> np.array:
-        bin_widths = [edges[i + 1] - edges[i] for i in range(len(edges) - 1)]
-        bin_centers = []
-        for i in range(len(edges) - 1):
-            bin_centers.append(edges[i] + (bin_widths[i] / 2))
-        return np.array(bin_centers)
+    @property
+    def bin_centers(self) -> np.array:
+        return (self.bin_edges[1:] + self.bin_edges[:-1]) / 2
 
-    def __add__(self, other):
-        if (other.bin_edges).all() != (self.bin_edges).all():
+    @property
+    def errors(self) -> np.array:
+        """ Statistical uncertainty of each bin """
+        return np.sqrt(self.sumw2)
+
+    def fill(self, values: np.array, weights: np.array = None) -> None:
+        """ Adds the values to the counts. The raw data is dropped, as it no
+        longer describes the counts """
+        self += Histogram(
+                    values, self.bin_edges, self.histogram_data_type,
+                    weights=weights, keep_data=False)
+
+    def check_edges(self, other, operation: str) -> None:
+        if not np.array_equal(self.bin_edges, other.bin_edges):
             raise ArithmeticError(
-                "The bins of two histograms do not match, cannot sum them.")
+                f"The bins of two histograms do not match, cannot {operation} them.")
+
+    def __add__(self, other):
+        self.check_edges(other, "sum")
         result = self.binned_data + other.binned_data
-        return Histogram(result, self.bin_edges, "Sum", binned=True)
+        return Histogram(
+                    result, self.bin_edges, "Sum", binned=True,
+                    sumw2=self.sumw2 + other.sumw2)
+
+    def __iadd__(self, other):
+        self.check_edges(other, "sum")
+        if np.can_cast(other.binned_data.dtype, self.binned_data.dtype):
+            self.binned_data += other.binned_data
+        else:
+            self.binned_data = self.binned_data + other.binned_data
+        self.sumw2 += other.sumw2
+        self.data = None
+        return self
 
     def __str__(self):
         return f"{self.histogram_data_type} histogram"
 
     def __truediv__(self, other):
-        if (other.bin_edges).all() != (self.bin_edges).all():
-            raise ArithmeticError(
-                "The bins of two histograms do not match, cannot divide them.")
-        result = np.nan_to_num(
-                                self.binned_data / other.binned_data,
-                                copy=True, nan=0.0, posinf=None, neginf=None)
-        return Histogram(result, self.bin_edges, "Efficiency", binned=True)
+        """ Bin-by-bin ratio. The uncertainties are propagated as for
+        independent histograms, empty bins give zero """
+        self.check_edges(other, "divide")
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = self.binned_data / other.binned_data
+            sumw2 = (self.sumw2 * np.square(other.binned_data)
+                     + other.sumw2 * np.square(self.binned_data)
+                     ) / np.power(other.binned_data, 4.0)
+        result = np.nan_to_num(result, copy=False, nan=0.0, posinf=None, neginf=None)
+        sumw2 = np.nan_to_num(sumw2, copy=False, nan=0.0, posinf=None, neginf=None)
+        return Histogram(result, self.bin_edges, "Efficiency", binned=True, sumw2=sumw2)
 
     def __mul__(self, other):
-        if (other.bin_edges).all() != (self.bin_edges).all():
-            raise ArithmeticError(
-                "The bins of two histograms do not match, cannot multiply them.")
+        self.check_edges(other, "multiply")
         result = self.binned_data * other.binned_data
-        return Histogram(result, self.bin_edges, "Multiplicity", binned=True)
+        sumw2 = (self.sumw2 * np.square(other.binned_data)
+                 + other.sumw2 * np.square(self.binned_data))
+        return Histogram(
+                    result, self.bin_edges, "Multiplicity", binned=True, sumw2=sumw2)
+
+    def to_dict(self) -> dict:
+        """ The histogram without the raw data, as plain arrays """
+        content = {
+            "histogram_data_type": self.histogram_data_type,
+            "bin_edges": self.bin_edges,
+            "binned_data": self.binned_data,
+            "sumw2": self.sumw2,
+        }
+        if self.interval is not None:
+            content["interval"] = np.stack(self.interval)
+        return content
+
+    @classmethod
+    def from_dict(cls, content: dict):
+        histogram = cls(
+                content["binned_data"], content["bin_edges"],
+                str(content["histogram_data_type"]), binned=True,
+                sumw2=content["sumw2"])
+        if "interval" in content:
+            histogram.interval = tuple(np.asarray(content["interval"]))
+        return histogram
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        restored = Histogram.from_dict(state)
+        for slot in self.__slots__:
+            setattr(self, slot, getattr(restored, slot))
+
+
+def bin_indices(values: np.array, bin_edges: np.array) -> np.array:
+    """ Finds the bin of each value as np.histogram would bin it: the bins are
+    half-open except for the last one, which includes its right edge
+
+    Args:
+        values : np.array
+            The values to be binned
+        bin_edges : np.array
+            Monotonically increasing edges of the bins
+
+    Returns:
+        indices : np.array
+            Index of the bin of each value, -1 for the values outside of the
+            bins or NaN
+    """
+    bin_edges = np.asarray(bin_edges)
+    n_bins = len(bin_edges) - 1
+    indices = np.searchsorted(bin_edges, values, side='right') - 1
+    indices[values == bin_edges[-1]] = n_bins - 1
+    indices[indices >= n_bins] = -1
+    return indices
 
 
-def load_events(file_path: str, tree_name: str) -> awkward.Array:
-    """ Loads all the events from a given path and a tree name
+def load_events(
+        file_path: str,
+        tree_name: str,
+        branches: list = None,
+        filter_name=None,
+        entry_start: int = None,
+        entry_stop: int = None) -> awkward.Array:
+    """ Loads the events from a given path and a tree name. Only the requested
+    branches are read, all of them if neither branches nor filter_name is given
 
     Args:
         file_path : str
             Path to the .root file to be read
         tree_name : str
             Path in the .root file where branches of interest are located
+        branches : list
+            [default: None] Names of the branches to be read
+        filter_name : str, list or callable
+            [default: None] Filter on the branch names as in uproot
+        entry_start : int
+            [default: None] First entry to be read
+        entry_stop : int
+            [default: None] Entry at which to stop reading (exclusive)
 
     Returns : awkward.Array
         The events found in the inputted .root file
     """
     with uproot.open(file_path) as input_file:
         tree = input_file[tree_name]
-        arrays = tree.arrays()
+        arrays = tree.arrays(
+                        branches, filter_name=filter_name,
+                        entry_start=entry_start, entry_stop=entry_stop)
     return arrays
 
 
+class EventStore:
+    """ In-process cache of the columns read from the ntuples, so that the
+    different stages of a run read each column of a file only once """
+    def __init__(self) -> None:
+        self._columns = {}
+
+    def load(
+            self,
+            file_path: str,
+            tree_name: str,
+            branches: list = None) -> awkward.Array:
+        """ Returns the requested branches, reading from the file only those
+        not read before
+
+        Args:
+            file_path : str
+                Path to the .root file to be read
+            tree_name : str
+                Path in the .root file where branches of interest are located
+            branches : list
+                [default: None] Names of the branches. All of them if None
+
+        Returns : awkward.Array
+            The events with the requested branches
+        """
+        key = (os.path.abspath(file_path), tree_name)
+        columns = self._columns.setdefault(key, {})
+        if branches is None:
+            with uproot.open(file_path) as input_file:
+                branches = input_file[tree_name].keys()
+        missing = [branch for branch in branches if branch not in columns]
+        if missing:
+            events = load_events(file_path, tree_name, missing)
+            for branch in missing:
+                columns[branch] = events[branch]
+        return awkward.zip(
+                {branch: columns[branch] for branch in branches}, depth_limit=1)
+
+    def clear(self) -> None:
+        self._columns.clear()
+
+
+def count_entries(file_path: str, tree_name: str) -> int:
+    """ Returns the number of entries in the tree of a given .root file """
+    with uproot.open(file_path) as input_file:
+        n_entries = input_file[tree_name].num_entries
+    return n_entries
+
+
+def count_step_entries(
+        file_path: str,
+        tree_name: str,
+        step_size: int | str,
+        branches: list = None) -> int:
+    """ Returns the number of entries in one chunk of iterate_events, i.e.
+    the step size itself or the entries fitting into the memory size
+
+    Args:
+        file_path : str
+            Path to the .root file to be read
+        tree_name : str
+            Path in the .root file where branches of interest are located
+        step_size : int | str
+            Number of entries per chunk or memory size per chunk, e.g. "100 MB"
+        branches : list
+            [default: None] Names of the branches to be read
+
+    Returns:
+        n_entries : int
+            Number of entries per chunk
+    """
+    if isinstance(step_size, int):
+        return step_size
+    with uproot.open(file_path) as input_file:
+        n_entries = input_file[tree_name].num_entries_for(step_size, branches)
+    return n_entries
+
+
+def iterate_events(
+        file_path: str,
+        tree_name: str,
+        step_size: int | str,
+        branches: list = None,
+        filter_name=None,
+        entry_start: int = None,
+        entry_stop: int = None) -> awkward.Array:
+    """ Iterates over the events from a given path and a tree name in chunks,
+    so that only one chunk is kept in memory at a time
+
+    Args:
+        file_path : str
+            Path to the .root file to be read
+        tree_name : str
+            Path in the .root file where branches of interest are located
+        step_size : int | str
+            Number of entries per chunk or memory size per chunk, e.g. "100 MB"
+        branches : list
+            [default: None] Names of the branches to be read
+        filter_name : str, list or callable
+            [default: None] Filter on the branch names as in uproot
+        entry_start : int
+            [default: None] First entry to be read
+        entry_stop : int
+            [default: None] Entry at which to stop reading (exclusive)
+
+    Yields : awkward.Array
+        The events of the current chunk
+    """
+    with uproot.open(file_path) as input_file:
+        tree = input_file[tree_name]
+        for chunk in tree.iterate(
+                            branches, filter_name=filter_name,
+                            step_size=step_size, entry_start=entry_start,
+                            entry_stop=entry_stop):
+            yield chunk
+
+
+def expand_input_paths(path) -> list:
+    """ Expands the dataset path into the list of input files. The path can be
+    a single file, a glob pattern or a list of those
+
+    Args:
+        path : str or list
+            The path(s) and/or glob pattern(s) of the input files
+
+    Returns:
+        input_paths : list
+            Paths of all the input files in a deterministic order
+    """
+    patterns = [path] if isinstance(path, str) else list(path)
+    input_paths = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if len(matches) == 0:
+                raise FileNotFoundError(f"No input files match {pattern}")
+            input_paths.extend(matches)
+        else:
+            input_paths.append(pattern)
+    return input_paths
+
+
 def construct_var_names(cfg: DictConfig, obj_type: str) -> list:
     """ Constructs all variable names that are to be loaded from the input
     .root file
@@ -105,3 +390,42 @@ def construct_var_names(cfg: DictConfig, obj_type: str) -> list:
     #         fake_var = f"{cfg.fakes[obj_type]}_{var}"
     #         all_vars.append(fake_var)
     return all_vars
+
+
+
+def unique(names: list) -> list:
+    """ Removes the duplicates from the list while keeping the order """
+    return list(dict.fromkeys(names))
+
+
+def construct_input_branches(cfg: DictConfig) -> list:
+    """ Constructs the names of all the branches that the ntuple production
+    reads from the NanoAOD file: the variables to be stored, the object
+    counters, the matching inputs and the quality cut variables
+
+    Args:
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        input_branches : list
+            Branches that are to be read from the .root file
+    """
+    input_branches = construct_var_names(cfg, cfg.genTau)
+    for obj in [cfg.comparison_tau, cfg.genTau, cfg.fakes.recoJet]:
+        input_branches.append(f"n{obj}")
+        input_branches.append(f"{obj}_eta")
+        input_branches.append(f"{obj}_phi")
+    for obj in [cfg.genTau, cfg.fakes.recoJet]:
+        for var in cfg.quality_cuts.genTau:
+            input_branches.append(f"{obj}_{var}")
+    if cfg.matching.method == 'index':
+        for var in ['genPartIdx', 'genPartFlav', 'jetIdx']:
+            input_branches.append(f"{cfg.comparison_tau}_{var}")
+    if cfg.quality_cuts.pollution_veto.enabled:
+        input_branches.extend([
+            "nGenPart", "GenPart_pdgId", "GenPart_pt", "GenPart_eta",
+            "GenPart_phi", "GenPart_status", "GenPart_statusFlags",
+            "nGenJet", "GenJet_eta", "GenJet_phi", "Jet_genJetIdx"
+        ])
+    return unique(input_branches)
@@ -0,0 +1,177 @@
+""" Compiled kernels for the matching and selection steps that do not
+vectorize cleanly. They loop over the flat content and offset arrays of the
+awkward collections and are compiled with Numba when it is installed.
+Without Numba the NumPy implementations in particle_matching,
+matching_algorithms and ntuple_production are used instead """
+import numpy as np
+
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    numba = None
+    HAS_NUMBA = False
+
+BACKENDS = ['auto', 'numpy', 'numba']
+
+
+def jit(func):
+    """ Compiles the function with Numba if it is available """
+    if HAS_NUMBA:
+        return numba.njit(cache=True)(func)
+    return func
+
+
+def use_compiled(backend: str) -> bool:
+    """ Tells whether the compiled kernels should be used for the backend
+
+    Args:
+        backend : str
+            One of BACKENDS. 'auto' uses the compiled kernels when Numba is
+            installed
+
+    Returns:
+        compiled : bool
+            Whether to use the compiled kernels
+    """
+    if backend == 'numpy':
+        return False
+    if backend == 'auto':
+        return HAS_NUMBA
+    if backend == 'numba':
+        if not HAS_NUMBA:
+            raise ImportError("The 'numba' backend requires numba")
+        return True
+    raise ValueError(f"Unknown backend '{backend}', choose from {BACKENDS}")
+
+
+def counts_to_offsets(counts: np.ndarray) -> np.ndarray:
+    """ Converts the per event counts into offsets with a leading zero """
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+@jit
+def delta_r(eta1, phi1, eta2, phi2, two_pi):
+    """ Same as particle_matching.deltaR. 2 pi is passed in the float type of
+    the inputs, so that float32 inputs are not promoted to float64 as they
+    are not in the NumPy path either """
+    dphi = abs(phi1 - phi2)
+    dphi = min(dphi, two_pi - dphi)
+    return np.hypot(eta1 - eta2, dphi)
+
+
+@jit
+def candidate_pairs(
+        ref_eta, ref_phi, ref_offsets, tau_eta, tau_phi, tau_offsets, dR_max):
+    """ Same as particle_matching.form_candidate_pairs, without materializing
+    the pairs outside of dR_max. The distances are computed and compared to
+    dR_max in the promoted float type of the inputs """
+    float_dtype = (ref_eta[:0] + ref_phi[:0] + tau_eta[:0] + tau_phi[:0]).dtype
+    two_pi = float_dtype.type(2*np.pi)
+    dR_max = float_dtype.type(dR_max)
+    n_events = len(ref_offsets) - 1
+    n_pairs = 0
+    for event in range(n_events):
+        for ref in range(ref_offsets[event], ref_offsets[event + 1]):
+            for tau in range(tau_offsets[event], tau_offsets[event + 1]):
+                if delta_r(ref_eta[ref], ref_phi[ref],
+                           tau_eta[tau], tau_phi[tau], two_pi) <= dR_max:
+                    n_pairs += 1
+    ref_idx = np.empty(n_pairs, dtype=np.int64)
+    tau_idx = np.empty(n_pairs, dtype=np.int64)
+    distances = np.empty(n_pairs, dtype=float_dtype)
+    pair = 0
+    for event in range(n_events):
+        for ref in range(ref_offsets[event], ref_offsets[event + 1]):
+            for tau in range(tau_offsets[event], tau_offsets[event + 1]):
+                distance = delta_r(
+                        ref_eta[ref], ref_phi[ref], tau_eta[tau], tau_phi[tau],
+                        two_pi)
+                if distance <= dR_max:
+                    ref_idx[pair] = ref
+                    tau_idx[pair] = tau
+                    distances[pair] = distance
+                    pair += 1
+    return ref_idx, tau_idx, distances
+
+
+@jit
+def closest_first_matching(ref_idx, tau_idx, distances, n_refs, n_taus):
+    """ Same as matching_algorithms.closest_first_matching """
+    best_tau = np.full(n_refs, -1, dtype=np.int64)
+    best_dR = np.full(n_refs, np.inf)
+    for pair in range(len(ref_idx)):
+        if distances[pair] <= best_dR[ref_idx[pair]]:
+            best_dR[ref_idx[pair]] = distances[pair]
+            best_tau[ref_idx[pair]] = tau_idx[pair]
+    n_claims = np.zeros(n_taus, dtype=np.int64)
+    for ref in range(n_refs):
+        if best_tau[ref] >= 0:
+            n_claims[best_tau[ref]] += 1
+    in_conflict = np.zeros(n_refs, dtype=np.bool_)
+    conflict_tau = np.zeros(n_taus, dtype=np.bool_)
+    matched_tau_idx = best_tau.copy()
+    for ref in range(n_refs):
+        if best_tau[ref] >= 0 and n_claims[best_tau[ref]] > 1:
+            in_conflict[ref] = True
+            conflict_tau[best_tau[ref]] = True
+            matched_tau_idx[ref] = -1
+    conflict_pairs = np.zeros(len(ref_idx), dtype=np.bool_)
+    for pair in range(len(ref_idx)):
+        conflict_pairs[pair] = (in_conflict[ref_idx[pair]]
+                                and conflict_tau[tau_idx[pair]])
+    resolved = greedy_matching(
+                    ref_idx[conflict_pairs], tau_idx[conflict_pairs],
+                    distances[conflict_pairs], n_refs, n_taus)
+    for ref in range(n_refs):
+        if in_conflict[ref]:
+            matched_tau_idx[ref] = resolved[ref]
+    return matched_tau_idx
+
+
+@jit
+def greedy_matching(ref_idx, tau_idx, distances, n_refs, n_taus):
+    """ Same as matching_algorithms.greedy_matching, walking the sorted pairs
+    one by one """
+    matched_tau_idx = np.full(n_refs, -1, dtype=np.int64)
+    tau_taken = np.zeros(n_taus, dtype=np.bool_)
+    for pair in np.argsort(distances, kind='mergesort'):
+        ref, tau = ref_idx[pair], tau_idx[pair]
+        if matched_tau_idx[ref] < 0 and not tau_taken[tau]:
+            matched_tau_idx[ref] = tau
+            tau_taken[tau] = True
+    return matched_tau_idx
+
+
+@jit
+def polluted_gen_jets(
+        gen_jet_eta, gen_jet_phi, gen_jet_offsets,
+        part_pdg_id, part_status, part_status_flags, part_pt,
+        part_eta, part_phi, part_offsets, min_pt, dR):
+    """ Flags the GenJets closer than dR to a prompt electron, muon or tau,
+    selecting the GenParts with the same criteria as
+    ntuple_production.select_prompt_leptons """
+    float_dtype = (gen_jet_eta[:0] + gen_jet_phi[:0]
+                   + part_eta[:0] + part_phi[:0]).dtype
+    two_pi = float_dtype.type(2*np.pi)
+    dR = float_dtype.type(dR)
+    min_pt = part_pt.dtype.type(min_pt)
+    polluted = np.zeros(len(gen_jet_eta), dtype=np.bool_)
+    for event in range(len(gen_jet_offsets) - 1):
+        for part in range(part_offsets[event], part_offsets[event + 1]):
+            pdg_id = abs(part_pdg_id[part])
+            flags = part_status_flags[part]
+            is_prompt = (flags & 1) == 1
+            is_lep = (pdg_id == 11 or pdg_id == 13) and part_status[part] == 1
+            is_tau = pdg_id == 15 and (flags >> 1 & 1) == 1
+            if not (is_prompt and (is_lep or is_tau)):
+                continue
+            if abs(part_pt[part]) < min_pt:
+                continue
+            for jet in range(gen_jet_offsets[event], gen_jet_offsets[event + 1]):
+                if delta_r(gen_jet_eta[jet], gen_jet_phi[jet],
+                           part_eta[part], part_phi[part], two_pi) < dR:
+                    polluted[jet] = True
+    return polluted
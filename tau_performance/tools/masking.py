@@ -1,13 +1,236 @@
+import os
+import re
 import operator
+import functools
 import numpy as np
+import awkward
+from . import general
 
 OPERATORS = {
     '>=': operator.ge,
     '<=': operator.le,
     '==': operator.eq,
+    '!=': operator.ne,
     '>': operator.gt,
     '<': operator.lt
 }
+FLIPPED_OPERATORS = {
+    '>=': '<=', '<=': '>=', '==': '==', '!=': '!=', '>': '<', '<': '>'}
+TOKEN_PATTERN = re.compile(r"""
+    \s*(?:
+        (?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+        |(?P<name>@?[A-Za-z_][A-Za-z0-9_]*)
+        |(?P<logic>&&|\|\|)
+        |(?P<operator>>=|<=|==|!=|>|<)
+        |(?P<symbol>[()|])
+    )""", re.VERBOSE)
+
+
+def remember(memo, key, mask):
+    """ Stores the evaluated mask in the memo table, if one is given. The
+    stored masks are made read-only as they are shared between the cuts """
+    if memo is not None:
+        mask.flags.writeable = False
+        memo[key] = mask
+    return mask
+
+
+class Comparison:
+    """ Comparison of a (possibly absolute valued) variable with a number """
+    def __init__(self, name, abs_value, operator_, value):
+        self.name = name
+        self.abs_value = abs_value
+        self.operator = operator_
+        self.value = value
+        self.key = self.canonical_key()
+
+    def evaluate(self, get_column, memo=None):
+        if memo is not None and self.key in memo:
+            return memo[self.key]
+        mask = np.asarray(OPERATORS[self.operator](
+                    get_column(self.name, self.abs_value), self.value), dtype=bool)
+        return remember(memo, self.key, mask)
+
+    def atoms(self):
+        return [self]
+
+    def canonical_key(self):
+        """ Canonical form of the comparison, e.g. '|eta|<2.3' """
+        name = f"|{self.name}|" if self.abs_value else self.name
+        return f"{name}{self.operator}{self.value!r}"
+
+
+class Conjunction:
+    """ Logical AND of the sub-expressions. The evaluation stops as soon as
+    no entry passes. With a memo table every leading part of the conjunction
+    is remembered, so that e.g. the Loose, Medium and Tight working points
+    sharing their first cuts evaluate those only once """
+    def __init__(self, terms):
+        self.terms = terms
+        self.prefix_keys = [
+            "(" + "&&".join(term.key for term in terms[:n_terms]) + ")"
+            for n_terms in range(1, len(terms) + 1)
+        ]
+        self.key = self.prefix_keys[-1]
+
+    def evaluate(self, get_column, memo=None):
+        if memo is not None and self.key in memo:
+            return memo[self.key]
+        n_cached = 0
+        if memo is not None:
+            n_cached = next((
+                n_terms for n_terms in range(len(self.terms) - 1, 0, -1)
+                if self.prefix_keys[n_terms - 1] in memo), 0)
+        if n_cached > 0:
+            mask = memo[self.prefix_keys[n_cached - 1]]
+        else:
+            mask = self.terms[0].evaluate(get_column, memo)
+            n_cached = 1
+            if memo is None:
+                mask = np.array(mask, dtype=bool)
+        for n_terms in range(n_cached + 1, len(self.terms) + 1):
+            if mask.any():
+                term_mask = self.terms[n_terms - 1].evaluate(get_column, memo)
+                if memo is None:
+                    mask &= term_mask
+                else:
+                    mask = mask & term_mask
+            remember(memo, self.prefix_keys[n_terms - 1], mask)
+        return mask
+
+    def atoms(self):
+        return [atom for term in self.terms for atom in term.atoms()]
+
+
+class Disjunction:
+    """ Logical OR of the sub-expressions. The evaluation stops as soon as
+    all entries pass """
+    def __init__(self, terms):
+        self.terms = terms
+        self.key = "(" + "||".join(term.key for term in terms) + ")"
+
+    def evaluate(self, get_column, memo=None):
+        if memo is not None and self.key in memo:
+            return memo[self.key]
+        mask = np.array(self.terms[0].evaluate(get_column, memo), dtype=bool)
+        for term in self.terms[1:]:
+            if mask.all():
+                break
+            mask |= term.evaluate(get_column, memo)
+        return remember(memo, self.key, mask)
+
+    def atoms(self):
+        return [atom for term in self.terms for atom in term.atoms()]
+
+
+def tokenize(cut_string):
+    """ Splits the cut string into (kind, text) tokens """
+    tokens = []
+    position = 0
+    cut_string = cut_string.strip()
+    while position < len(cut_string):
+        match = TOKEN_PATTERN.match(cut_string, position)
+        if match is None or match.end() == position:
+            raise ValueError(
+                f"Unexpected '{cut_string[position:]}' in cut '{cut_string}'")
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        position = match.end()
+    return tokens
+
+
+class CutParser:
+    """ Recursive descent parser of the cut strings. The grammar is
+
+        expression := conjunction ('||' conjunction)*
+        conjunction := term ('&&' term)*
+        term := '(' expression ')' | comparison
+        comparison := operand operator operand
+        operand := name | '|' name '|' | number
+
+    where a comparison has a variable on one side and a number on the other
+    """
+    def __init__(self, cut_string):
+        self.cut_string = cut_string
+        self.tokens = tokenize(cut_string)
+        self.position = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise ValueError('No cut selected')
+        expression = self.parse_expression()
+        if self.position != len(self.tokens):
+            self.error()
+        return expression
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self, kind, text=None):
+        token = self.peek()
+        if token[0] != kind or (text is not None and token[1] != text):
+            self.error()
+        self.position += 1
+        return token[1]
+
+    def error(self):
+        remaining = " ".join(text for _, text in self.tokens[self.position:])
+        raise ValueError(
+            f"Invalid cut '{self.cut_string}' at '{remaining or 'the end'}'")
+
+    def parse_expression(self):
+        terms = [self.parse_conjunction()]
+        while self.peek() == ('logic', '||'):
+            self.position += 1
+            terms.append(self.parse_conjunction())
+        return terms[0] if len(terms) == 1 else Disjunction(terms)
+
+    def parse_conjunction(self):
+        terms = [self.parse_term()]
+        while self.peek() == ('logic', '&&'):
+            self.position += 1
+            terms.append(self.parse_term())
+        return terms[0] if len(terms) == 1 else Conjunction(terms)
+
+    def parse_term(self):
+        if self.peek() == ('symbol', '('):
+            self.position += 1
+            expression = self.parse_expression()
+            self.take('symbol', ')')
+            return expression
+        return self.parse_comparison()
+
+    def parse_operand(self):
+        kind, text = self.peek()
+        if kind == 'number':
+            self.position += 1
+            return float(text)
+        if (kind, text) == ('symbol', '|'):
+            self.position += 1
+            name = self.take('name')
+            self.take('symbol', '|')
+            return (name, True)
+        return (self.take('name'), False)
+
+    def parse_comparison(self):
+        left = self.parse_operand()
+        operator_ = self.take('operator')
+        right = self.parse_operand()
+        if isinstance(left, float) and isinstance(right, tuple):
+            left, right = right, left
+            operator_ = FLIPPED_OPERATORS[operator_]
+        if not (isinstance(left, tuple) and isinstance(right, float)):
+            self.error()
+        return Comparison(left[0], left[1], operator_, right)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_cut(cut_string):
+    """ Parses the cut string into an expression tree. Each distinct string
+    is parsed only once """
+    return CutParser(str(cut_string)).parse()
 
 
 class GeneralCut:
@@ -17,40 +240,131 @@ class GeneralCut:
 
         Args:
             cut_string : str
-                String containing all the cuts in a default convention
+                String containing all the cuts in a default convention, e.g.
+                "pt >= 20 && (|eta| < 2.3 || @Pileup_nTrueInt > 60)"
 
         Returns:
             None
         """
         self.cut_string = cut_string
-        self._all_cuts = []
-        self.separate_cuts()
-
-    def separate_cuts(self):
-        """ Separates all the cuts in the general cut string """
-        self.cut_string = self.cut_string.replace(" ", "")
-        raw_cuts = self.cut_string.split("&&")
-        for cut_ in raw_cuts:
-            self._all_cuts.append(self.interpret_single_cut_string(cut_))
-        return self._all_cuts
-
-    def interpret_single_cut_string(self, cut_string):
-        """ Interpretes the single-cut string """
-        cut = ''
-        for operator in OPERATORS.keys():
-            if operator in cut_string:
-                cut = cut_string.split(operator)
-                cut.insert(1, operator)
-                return cut
-        if cut == '':
-            raise ValueError('No cut selected')
+        self.expression = compile_cut(cut_string)
+
+    def evaluate(self, get_column, memo=None):
+        """ Evaluates the cut into a boolean mask
+
+        Args:
+            get_column : callable
+                Returns the values of a variable given its name in the cut
+                string and whether its absolute value is taken
+            memo : dict
+                [default: None] Memo table of the already evaluated
+                comparisons and conjunctions on the same events, shared
+                between the cuts. The masks in it are read-only
+
+        Returns:
+            mask : numpy.ndarray
+                Boolean mask of the entries passing the cut
+        """
+        return self.expression.evaluate(get_column, memo)
 
     @property
     def all_cuts(self):
-        return self._all_cuts
+        """ The single comparisons as [name, operator, value] """
+        return [
+            [f"|{atom.name}|" if atom.abs_value else atom.name,
+             atom.operator, atom.value]
+            for atom in self.expression.atoms()
+        ]
+
+
+if hasattr(np, 'bitwise_count'):
+    def count_bits(packed):
+        """ Number of set bits in the packed mask """
+        return int(np.sum(np.bitwise_count(packed), dtype=np.int64))
+else:
+    POPCOUNT_TABLE = np.array(
+                    [bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+    def count_bits(packed):
+        """ Number of set bits in the packed mask """
+        return int(np.sum(POPCOUNT_TABLE[packed], dtype=np.int64))
+
+
+class MaskStore:
+    """ Keeps many boolean masks of the same length as the rows of a packed
+    bit matrix, using one bit instead of one byte per entry and mask """
+    def __init__(self, n_entries):
+        self.n_entries = n_entries
+        self.n_bytes = (n_entries + 7) // 8
+        self._rows = {}
+        self._bits = np.zeros((0, self.n_bytes), dtype=np.uint8)
+
+    def add(self, key, mask):
+        """ Packs and stores the mask under the key """
+        mask = np.asarray(mask, dtype=bool)
+        if len(mask) != self.n_entries:
+            raise ValueError(
+                f"Mask of {len(mask)} entries for a store of {self.n_entries}")
+        if key not in self._rows:
+            if len(self._rows) == len(self._bits):
+                grown = np.zeros(
+                        (max(2*len(self._bits), 8), self.n_bytes), dtype=np.uint8)
+                grown[:len(self._bits)] = self._bits
+                self._bits = grown
+            self._rows[key] = len(self._rows)
+        self._bits[self._rows[key]] = np.packbits(mask, bitorder='little')
+
+    def packed(self, key):
+        """ Packed mask stored under the key. Packed masks are passed through """
+        if isinstance(key, np.ndarray):
+            return key
+        return self._bits[self._rows[key]]
+
+    def logical_and(self, *keys):
+        """ Packed AND of the masks, given by their keys or packed """
+        result = self.packed(keys[0]).copy()
+        for key in keys[1:]:
+            result &= self.packed(key)
+        return result
+
+    def count(self, key):
+        """ Number of entries passing the mask, without unpacking it """
+        return count_bits(self.packed(key))
+
+    def unpack(self, key):
+        """ Boolean mask stored under the key (or of a packed mask) """
+        return np.unpackbits(
+                    self.packed(key), count=self.n_entries,
+                    bitorder='little').astype(bool)
+
+    def unpack_rows(self, keys):
+        """ Boolean masks of the keys as the rows of one matrix, unpacked at
+        once """
+        rows = [self._rows[key] for key in keys]
+        return np.unpackbits(
+                    self._bits[rows], axis=1, count=self.n_entries,
+                    bitorder='little').astype(bool)
+
+    @property
+    def matrix(self):
+        """ The packed bit matrix, one row per mask in the order of keys() """
+        return self._bits[:len(self._rows)]
+
+    def keys(self):
+        return self._rows.keys()
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __len__(self):
+        return len(self._rows)
 
 
 class Masks:
+    """ Evaluates the base cut and the cuts of all IDs and working points of
+    the given mask type into a MaskStore. The base cut is stored under
+    'Base' and the working point masks, which include the base cut, under
+    (ID, working point) """
     def __init__(self, events, mask_type, obj_type, cfg):
         self.events = events
         self.cfg = cfg
@@ -58,85 +372,179 @@ class Masks:
         self.obj_type = obj_type
         self.eff_type = "eff" if obj_type == cfg.genTau else "fake"
         self.denominator = True if mask_type == 'denominators' else False
-        self._masks = {}
+        self._cuts = {}
+        self._columns = {}
+        self._memo = {}
+        self.store = MaskStore(len(events))
         self.base_mask = self.create_base_mask()
+        self.store.add('Base', self.base_mask)
         self.create_masks()
+        self._columns.clear()
+        self._memo.clear()
 
     def read_mask_type(self, mask_full_info):
         wp_cuts = {}
         for working_point in mask_full_info:
             cut_string = mask_full_info[working_point]
-            gc = GeneralCut(cut_string)
-            wp_cuts[working_point] = gc.all_cuts
+            wp_cuts[working_point] = GeneralCut(cut_string)
         return wp_cuts
 
+    def get_column(self, name, abs_value):
+        if (name, abs_value) not in self._columns:
+            var_name, _ = interpret_name(
+                                name, self.cfg, denominator=self.denominator,
+                                obj_type=self.obj_type)
+            var_values = awkward.to_numpy(self.events[var_name])
+            if abs_value:
+                var_values = np.abs(var_values)
+            self._columns[(name, abs_value)] = var_values
+        return self._columns[(name, abs_value)]
+
     def create_base_mask(self):
         base_mask_str = self.cfg[f"TauID_{self.eff_type}"][self.mask_type].Base
-        gc = GeneralCut(base_mask_str)
-        total_mask = np.array([0] * len(self.events))
-        for cut_ in gc.all_cuts:
-            var_name, abs_value = interpret_name(
-                                                cut_[0], self.cfg,
-                                                denominator=self.denominator,
-                                                obj_type=self.obj_type)
-            value = float(cut_[2])
-            if abs_value:
-                var_values = np.abs(self.events[var_name])
-            else:
-                var_values = self.events[var_name]
-            mask = OPERATORS[cut_[1]](var_values, value).to_numpy()
-            total_mask += mask.astype(int)
-        base_mask = total_mask == len(gc.all_cuts)
-        return base_mask
+        return GeneralCut(base_mask_str).evaluate(self.get_column, self._memo)
 
     def create_masks(self):
         self.read_all_masks()
-        for mask_key, mask_values in self._masks.items():
-            wp_masks = {}
+        for mask_key, mask_values in self._cuts.items():
             for wp_key in mask_values:
-                wp_masks[wp_key] = self.create_single_mask(mask_values[wp_key])
-            self._masks[mask_key] = wp_masks
-        if len(self._masks) == 0:
-            self._masks = self.base_mask
+                self.store.add(
+                    (mask_key, wp_key), self.create_single_mask(mask_values[wp_key]))
 
     def create_single_mask(self, wp_mask):
-        total_mask = np.array([0] * len(self.events))
-        for cut in wp_mask:
-            value = float(cut[2])
-            var_name, abs_value = interpret_name(
-                                                cut[0], self.cfg,
-                                                denominator=self.denominator,
-                                                obj_type=self.obj_type)
-            if abs_value:
-                var_values = np.abs(self.events[var_name])
-            else:
-                var_values = self.events[var_name]
-            mask = OPERATORS[cut[1]](var_values, value).to_numpy()
-            total_mask += mask.astype(int)
-        current_mask = total_mask == len(wp_mask)
-        wp_mask = current_mask & self.base_mask
-        return wp_mask
+        return wp_mask.evaluate(self.get_column, self._memo) & self.base_mask
 
     def read_all_masks(self):
         for mask in self.cfg[f"TauID_{self.eff_type}"][self.mask_type]:
             if not mask == 'Base':
-                self._masks[mask] = self.read_mask_type(
+                self._cuts[mask] = self.read_mask_type(
                        self.cfg[f"TauID_{self.eff_type}"][self.mask_type][mask])
 
+    @property
+    def working_points(self):
+        """ The working points of each ID """
+        return {
+            mask_key: list(mask_values)
+            for mask_key, mask_values in self._cuts.items()
+        }
+
     @property
     def masks(self):
-        return self._masks
+        """ The unpacked masks as {ID: {working point: mask}}, or the base
+        mask if there are no IDs """
+        if len(self._cuts) == 0:
+            return self.base_mask
+        return {
+            mask_key: {
+                wp_key: self.store.unpack((mask_key, wp_key))
+                for wp_key in wp_keys
+            }
+            for mask_key, wp_keys in self.working_points.items()
+        }
+
+
+class MaskCache:
+    """ Shares the Masks of a file between the stages of a run, keyed by
+    (file, tree, reference object, mask type). The cut variables are read
+    through the event store """
+    def __init__(self, event_store):
+        self.event_store = event_store
+        self._masks = {}
+
+    def get(self, file_path, tree_name, mask_type, obj_type, cfg):
+        key = (os.path.abspath(file_path), tree_name, obj_type, mask_type)
+        if key not in self._masks:
+            events = self.event_store.load(
+                file_path, tree_name,
+                construct_cut_var_names(cfg, mask_type, obj_type))
+            self._masks[key] = Masks(events, mask_type, obj_type, cfg)
+        return self._masks[key]
+
+
+def iterate_masks(
+        file_path, tree_name, branches, obj_type, cfg, step_size=None,
+        event_store=None, mask_cache=None):
+    """ Yields the events of the file together with their numerator and
+    denominator masks. Without a step size the whole file is loaded at once
+    through the event store and the mask cache, otherwise the file is read
+    chunk by chunk and the masks are evaluated for each chunk separately
+
+    Args:
+        file_path : str
+            Path to the ntuple
+        tree_name : str
+            Path of the tree in the ntuple
+        branches : list
+            Branches to be read, including the cut variables of both masks
+        obj_type : str
+            Reference object of the ntuple
+        cfg : omegaconf.DictConfig
+            The configuration for plotting
+        step_size : int or str
+            [default: None] Number of entries or memory size per chunk
+        event_store : general.EventStore
+            [default: None] Store to load the whole file through
+        mask_cache : MaskCache
+            [default: None] Cache of the masks of the whole file
+
+    Yields:
+        events : awkward.Array
+            The events of the file or of the chunk
+        numerator_masks : Masks
+            The numerator masks of the events
+        denominator_masks : Masks
+            The denominator masks of the events
+    """
+    if step_size is None:
+        if event_store is None:
+            event_store = general.EventStore()
+        if mask_cache is None:
+            mask_cache = MaskCache(event_store)
+        events = event_store.load(file_path, tree_name, branches)
+        yield (
+            events,
+            mask_cache.get(file_path, tree_name, "numerators", obj_type, cfg),
+            mask_cache.get(file_path, tree_name, "denominators", obj_type, cfg))
+        return
+    for events in general.iterate_events(file_path, tree_name, step_size, branches):
+        yield (
+            events,
+            Masks(events, "numerators", obj_type, cfg),
+            Masks(events, "denominators", obj_type, cfg))
 
 
 def interpret_name(name, cfg, denominator=False, obj_type=None):
     """ If the name contains the sign '@' then this means this is already the
     full name """
-    abs_value = False
-    if denominator:
-        name = f"{obj_type}_{name}"
-    elif '@' not in name:
-        name = f"{cfg.comparison_tau}_{name}"
-    if '|' in name:
-        abs_value = True
-        name = name.replace("|", "")
-    return name, abs_value
+    abs_value = '|' in name
+    name = name.replace("|", "")
+    if name.startswith('@'):
+        return name[1:], abs_value
+    prefix = obj_type if denominator else cfg.comparison_tau
+    return f"{prefix}_{name}", abs_value
+
+
+def read_working_points(cfg, mask_type, obj_type):
+    """ The working points of each ID of the given mask type as configured,
+    the same as Masks.working_points but without evaluating any cut """
+    eff_type = "eff" if obj_type == cfg.genTau else "fake"
+    masks_cfg = cfg[f"TauID_{eff_type}"][mask_type]
+    return {mask: list(masks_cfg[mask]) for mask in masks_cfg if mask != 'Base'}
+
+
+def construct_cut_var_names(cfg, mask_type, obj_type):
+    """ Collects the names of all the variables the masks of the given type
+    are cutting on, so that only those need to be read from the ntuple """
+    eff_type = "eff" if obj_type == cfg.genTau else "fake"
+    denominator = mask_type == 'denominators'
+    cut_var_names = []
+    for mask in cfg[f"TauID_{eff_type}"][mask_type].values():
+        cut_strings = [mask] if isinstance(mask, str) else mask.values()
+        for cut_string in cut_strings:
+            for cut_ in GeneralCut(cut_string).all_cuts:
+                var_name, _ = interpret_name(
+                                        cut_[0], cfg, denominator=denominator,
+                                        obj_type=obj_type)
+                if var_name not in cut_var_names:
+                    cut_var_names.append(var_name)
+    return cut_var_names
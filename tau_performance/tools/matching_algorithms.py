@@ -0,0 +1,215 @@
+""" One-to-one matching algorithms working on flat integer arrays of the
+candidate pairs: the index of the reference object, the index of the tau and
+their angular separation """
+import numpy as np
+from tau_performance.tools import kernels
+
+ALGORITHMS = ['closest_first', 'greedy', 'hungarian']
+
+
+def first_of_groups(sorted_keys: np.ndarray) -> np.ndarray:
+    """ Mask of the first entry of each group of equal consecutive keys """
+    first = np.ones(len(sorted_keys), dtype=bool)
+    first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    return first
+
+
+def closest_first_matching(
+        ref_idx: np.ndarray,
+        tau_idx: np.ndarray,
+        distances: np.ndarray,
+        n_refs: int) -> np.ndarray:
+    """ Matches each reference object to its closest tau, the last of equally
+    close taus, as done in particle_matching.match_taus_to_refs. The
+    reference objects claiming a tau that is claimed by others are matched
+    anew by greedy matching to the taus claimed by such objects, as in
+    particle_matching.resolve_matching_conflicts, so that the losing objects
+    can still get one of those taus
+
+    Args:
+        ref_idx : numpy.ndarray
+            Index of the reference object of each candidate pair
+        tau_idx : numpy.ndarray
+            Index of the tau of each candidate pair
+        distances : numpy.ndarray
+            Angular separation of each candidate pair
+        n_refs : int
+            Total number of reference objects
+
+    Returns:
+        matched_tau_idx : numpy.ndarray
+            Index of the matched tau for each reference object, -1 if none
+    """
+    order = np.lexsort((-tau_idx, distances, ref_idx))
+    closest = order[first_of_groups(ref_idx[order])]
+    matched_tau_idx = np.full(n_refs, -1, dtype=np.int64)
+    matched_tau_idx[ref_idx[closest]] = tau_idx[closest]
+    n_taus = tau_idx.max() + 1 if len(tau_idx) > 0 else 0
+    n_claims = np.bincount(tau_idx[closest], minlength=n_taus)
+    in_conflict = matched_tau_idx >= 0
+    in_conflict[in_conflict] = n_claims[matched_tau_idx[in_conflict]] > 1
+    if not np.any(in_conflict):
+        return matched_tau_idx
+    conflict_tau = np.zeros(n_taus, dtype=bool)
+    conflict_tau[matched_tau_idx[in_conflict]] = True
+    matched_tau_idx[in_conflict] = -1
+    # Pairs farther than the taus' own claims are never taken by the greedy
+    # matching, so the candidate pairs suffice
+    conflict_pairs = in_conflict[ref_idx] & conflict_tau[tau_idx]
+    resolved = greedy_matching(
+                    ref_idx[conflict_pairs], tau_idx[conflict_pairs],
+                    distances[conflict_pairs], n_refs)
+    matched_tau_idx[in_conflict] = resolved[in_conflict]
+    return matched_tau_idx
+
+
+def greedy_matching(
+        ref_idx: np.ndarray,
+        tau_idx: np.ndarray,
+        distances: np.ndarray,
+        n_refs: int) -> np.ndarray:
+    """ Global greedy matching: the candidate pairs are sorted by distance
+    once and each pair is accepted unless its reference object or tau is
+    already taken. Equally close pairs are taken in their input order.
+
+    Instead of walking the sorted pairs one by one, all pairs that are the
+    closest remaining pair of both their reference object and their tau are
+    accepted at once and the pairs sharing an object with them are dropped.
+    This is repeated until no pairs remain and gives exactly the greedy
+    result in a few vectorized rounds.
+
+    Args:
+        ref_idx : numpy.ndarray
+            Index of the reference object of each candidate pair
+        tau_idx : numpy.ndarray
+            Index of the tau of each candidate pair
+        distances : numpy.ndarray
+            Angular separation of each candidate pair
+        n_refs : int
+            Total number of reference objects
+
+    Returns:
+        matched_tau_idx : numpy.ndarray
+            Index of the matched tau for each reference object, -1 if none
+    """
+    matched_tau_idx = np.full(n_refs, -1, dtype=np.int64)
+    order = np.argsort(distances, kind='stable')
+    refs, taus = ref_idx[order], tau_idx[order]
+    n_taus = taus.max() + 1 if len(taus) > 0 else 0
+    tau_taken = np.zeros(n_taus, dtype=bool)
+    while len(refs) > 0:
+        best_for_ref = np.zeros(len(refs), dtype=bool)
+        best_for_ref[np.unique(refs, return_index=True)[1]] = True
+        best_for_tau = np.zeros(len(taus), dtype=bool)
+        best_for_tau[np.unique(taus, return_index=True)[1]] = True
+        accepted = best_for_ref & best_for_tau
+        matched_tau_idx[refs[accepted]] = taus[accepted]
+        tau_taken[taus[accepted]] = True
+        remaining = (matched_tau_idx[refs] < 0) & ~tau_taken[taus]
+        refs, taus = refs[remaining], taus[remaining]
+    return matched_tau_idx
+
+
+def hungarian_matching(
+        ref_idx: np.ndarray,
+        tau_idx: np.ndarray,
+        distances: np.ndarray,
+        n_refs: int,
+        pair_event: np.ndarray) -> np.ndarray:
+    """ Optimal one-to-one matching in each event: the number of matched
+    pairs is maximized and, among those, the total distance is minimized.
+    Only the events where some object takes part in several candidate pairs
+    are passed to the assignment solver (scipy)
+
+    Args:
+        ref_idx : numpy.ndarray
+            Index of the reference object of each candidate pair
+        tau_idx : numpy.ndarray
+            Index of the tau of each candidate pair
+        distances : numpy.ndarray
+            Angular separation of each candidate pair
+        n_refs : int
+            Total number of reference objects
+        pair_event : numpy.ndarray
+            Index of the event of each candidate pair
+
+    Returns:
+        matched_tau_idx : numpy.ndarray
+            Index of the matched tau for each reference object, -1 if none
+    """
+    try:
+        from scipy.optimize import linear_sum_assignment
+    except ImportError as error:
+        raise ImportError(
+            "The 'hungarian' matching algorithm requires scipy") from error
+    matched_tau_idx = np.full(n_refs, -1, dtype=np.int64)
+    shared_ref = np.bincount(ref_idx, minlength=n_refs)[ref_idx] > 1
+    shared_tau = np.bincount(tau_idx)[tau_idx] > 1 if len(tau_idx) > 0 else shared_ref
+    in_conflict = np.zeros(len(pair_event), dtype=bool)
+    conflict_events = np.unique(pair_event[shared_ref | shared_tau])
+    in_conflict[np.isin(pair_event, conflict_events)] = True
+    matched_tau_idx[ref_idx[~in_conflict]] = tau_idx[~in_conflict]
+    if not np.any(in_conflict):
+        return matched_tau_idx
+    order = np.argsort(pair_event[in_conflict], kind='stable')
+    conflict_pairs = np.flatnonzero(in_conflict)[order]
+    boundaries = np.flatnonzero(first_of_groups(pair_event[conflict_pairs]))
+    for event_pairs in np.split(conflict_pairs, boundaries[1:]):
+        refs, ref_pos = np.unique(ref_idx[event_pairs], return_inverse=True)
+        taus, tau_pos = np.unique(tau_idx[event_pairs], return_inverse=True)
+        no_pair_cost = 1 + len(event_pairs) * distances[event_pairs].max()
+        costs = np.full((len(refs), len(taus)), no_pair_cost)
+        costs[ref_pos, tau_pos] = distances[event_pairs]
+        rows, cols = linear_sum_assignment(costs)
+        paired = costs[rows, cols] < no_pair_cost
+        matched_tau_idx[refs[rows[paired]]] = taus[cols[paired]]
+    return matched_tau_idx
+
+
+def match_pairs(
+        ref_idx: np.ndarray,
+        tau_idx: np.ndarray,
+        distances: np.ndarray,
+        n_refs: int,
+        pair_event: np.ndarray = None,
+        algorithm: str = 'closest_first',
+        backend: str = 'numpy') -> np.ndarray:
+    """ Resolves the candidate pairs into one-to-one matches with the chosen
+    algorithm. The closest_first and greedy algorithms have compiled kernels
+
+    Args:
+        ref_idx : numpy.ndarray
+            Index of the reference object of each candidate pair
+        tau_idx : numpy.ndarray
+            Index of the tau of each candidate pair
+        distances : numpy.ndarray
+            Angular separation of each candidate pair
+        n_refs : int
+            Total number of reference objects
+        pair_event : numpy.ndarray
+            [default: None] Index of the event of each candidate pair. Needed
+            only by the hungarian algorithm
+        algorithm : str
+            [default: 'closest_first'] One of ALGORITHMS
+        backend : str
+            [default: 'numpy'] One of kernels.BACKENDS
+
+    Returns:
+        matched_tau_idx : numpy.ndarray
+            Index of the matched tau for each reference object, -1 if none
+    """
+    if algorithm in ['closest_first', 'greedy'] and kernels.use_compiled(backend):
+        n_taus = tau_idx.max() + 1 if len(tau_idx) > 0 else 0
+        kernel = getattr(kernels, f"{algorithm}_matching")
+        return kernel(ref_idx, tau_idx, distances, n_refs, n_taus)
+    if algorithm == 'closest_first':
+        return closest_first_matching(ref_idx, tau_idx, distances, n_refs)
+    if algorithm == 'greedy':
+        return greedy_matching(ref_idx, tau_idx, distances, n_refs)
+    if algorithm == 'hungarian':
+        if pair_event is None:
+            pair_event = np.zeros(len(ref_idx), dtype=np.int64)
+        return hungarian_matching(
+                            ref_idx, tau_idx, distances, n_refs, pair_event)
+    raise ValueError(
+        f"Unknown matching algorithm '{algorithm}', choose from {ALGORITHMS}")
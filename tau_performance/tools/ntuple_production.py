@@ -1,18 +1,20 @@
 import os
 import uproot
 import awkward
+import numpy as np
 from omegaconf import DictConfig
 from collections import defaultdict
 # from . import particle_matching as pm
 # from . import general
 from tau_performance.tools import particle_matching as pm
 from tau_performance.tools import general
+from tau_performance.tools import kernels
 
 def check_pollution_from_non_jets(
         event: awkward.Array,
         ref_obj: str,
         ref_idx: int,
-        cfg: DictConfig) -> list:
+        cfg: DictConfig) -> bool:
     """ Checks pollution from non-jets. Compares to genJet regardless of whether
     RECO or GEN jets are used for tau-matching
 
@@ -23,8 +25,6 @@ def check_pollution_from_non_jets(
             The object comparison tau to match to.
         ref_idx : int
             The index of reference object
-        ref_type : str
-            Type of the reference object
         cfg : omegaconf.DictConfig
             The configuration. Branch names are inferred from that.
 
@@ -32,37 +32,38 @@ def check_pollution_from_non_jets(
         suitable : bool
             Whether or not the fake reference object satisfies the criteria
     """
-    suitable = True
-    for gen_part_idx in range(event['nGenPart']):
-        if abs(event['GenPart_pdgId'][gen_part_idx]) not in [11, 13, 15]:
-            continue
-        if abs(event['GenPart_pt'][gen_part_idx]) < 15:
-            continue
-        if event['GenPart_status'][gen_part_idx] != 1:
-            continue
-        select_lep = ( (abs(event['GenPart_pdgId'][gen_part_idx]) in [11, 13]) and
-                      ( event['GenPart_statusFlags'][gen_part_idx] >> 0 & 1 ))
-        select_tau = ( (abs(event['GenPart_pdgId'][gen_part_idx]) == 15) and
-                       (event['GenPart_statusFlags'][gen_part_idx] >> 1 & 1) and
-                      ( event['GenPart_statusFlags'][gen_part_idx] >> 0 & 1 ))
-        if not (select_lep or select_tau):
-            continue
-        print(f"{event.nGenJet} and {event.Jet_genJetIdx[ref_idx]}")
-        dR = pm.deltaR(
-                        event['GenPart_eta'][gen_part_idx],
-                        event['GenPart_phi'][gen_part_idx],
-                        event['GenJet_eta'][ref_idx],
-                        event['GenJet_phi'][ref_idx])
-        if dR < 0.3:
-            suitable = False
-            break
+    veto_cfg = cfg.quality_cuts.pollution_veto
+    gen_jet_idx = event['Jet_genJetIdx'][ref_idx]
+    pdg_id = np.abs(np.asarray(event['GenPart_pdgId']))
+    status_flags = np.asarray(event['GenPart_statusFlags'])
+    is_prompt = (status_flags >> 0 & 1) == 1
+    select_lep = (np.isin(pdg_id, [11, 13])
+                  & (np.asarray(event['GenPart_status']) == 1))
+    select_tau = (pdg_id == 15) & ((status_flags >> 1 & 1) == 1)
+    pt_mask = np.abs(np.asarray(event['GenPart_pt'])) >= veto_cfg.min_pt
+    selected = (select_lep | select_tau) & is_prompt & pt_mask
+    dRs = pm.deltaR(
+                    np.asarray(event['GenPart_eta'])[selected],
+                    np.asarray(event['GenPart_phi'])[selected],
+                    event['GenJet_eta'][gen_jet_idx],
+                    event['GenJet_phi'][gen_jet_idx])
+    suitable = not np.any(dRs < veto_cfg.dR)
     return suitable
 
 
+def uses_pollution_veto(obj: str, cfg: DictConfig, is_ref: bool = True) -> bool:
+    """ Tells whether the pollution veto is applied to the object. Only the
+    jets are vetoed and only when they are the reference object, i.e. in the
+    fake ntuple """
+    veto_enabled = cfg.quality_cuts.pollution_veto.enabled
+    return is_ref and obj != cfg.genTau and veto_enabled
+
+
 def pick_suitable_ref_objects(
         event: awkward.Array,
         ref_obj: str,
-        cfg: DictConfig) -> list:
+        cfg: DictConfig,
+        is_ref: bool = True) -> list:
     """ Picks only those reference objects that pass the quality cuts
 
     Args:
@@ -72,6 +73,9 @@ def pick_suitable_ref_objects(
             The object comparison tau to match to.
         cfg : omegaconf.DictConfig
             The configuration. Branch names are inferred from that.
+        is_ref : bool
+            [default: True] Whether the objects are the reference objects of
+            the ntuple rather than the opposite objects
 
     Returns:
         good_ref_objects : list
@@ -83,33 +87,136 @@ def pick_suitable_ref_objects(
             continue
         if abs(event[f"{ref_obj}_eta"][ref_idx]) > cfg.quality_cuts.genTau.eta:
             continue
-        # if ref_obj != cfg.genTau:
-        #     if (event["Jet_genJetIdx"][ref_idx] < 0) or (event["Jet_genJetIdx"][ref_idx] >= event["nGenJet"]):
-        #         continue
-        #         print("___________________________---")
-        #         print(event["Jet_genJetIdx"][ref_idx])
-        #         print(event["nGenJet"])
-        #         print("___________________________---")
-        #     suitable = check_pollution_from_non_jets(
-        #                                 event, ref_obj, ref_idx, cfg)
-        #     if not suitable:
-        #         continue
+        if uses_pollution_veto(ref_obj, cfg, is_ref):
+            gen_jet_idx = event["Jet_genJetIdx"][ref_idx]
+            if (gen_jet_idx < 0) or (gen_jet_idx >= event["nGenJet"]):
+                continue
+            suitable = check_pollution_from_non_jets(
+                                        event, ref_obj, ref_idx, cfg)
+            if not suitable:
+                continue
         good_ref_objects.append(ref_idx)
     return good_ref_objects
 
 
+def select_prompt_leptons(events: awkward.Array, cfg: DictConfig) -> awkward.Array:
+    """ Selects the generator level electrons, muons and taus that can pollute
+    the jets, with the same criteria as check_pollution_from_non_jets
 
-def fill_ref_obj_ntuple(
+    Args:
+        events: awkward.Array
+            All events with all the branches
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        lepton_mask : awkward.Array
+            Jagged mask of the selected GenPart entries
+    """
+    pdg_id = abs(events.GenPart_pdgId)
+    status_flags = events.GenPart_statusFlags
+    is_prompt = (status_flags >> 0 & 1) == 1
+    is_decayed_lepton_tau = (status_flags >> 1 & 1) == 1
+    select_lep = ((pdg_id == 11) | (pdg_id == 13)) & (events.GenPart_status == 1)
+    select_tau = (pdg_id == 15) & is_decayed_lepton_tau
+    pt_mask = abs(events.GenPart_pt) >= cfg.quality_cuts.pollution_veto.min_pt
+    return (select_lep | select_tau) & is_prompt & pt_mask
+
+
+def select_non_polluted_jets(events: awkward.Array, cfg: DictConfig) -> awkward.Array:
+    """ Columnar counterpart of check_pollution_from_non_jets. The GenJets
+    close to a selected lepton are found with one jagged broadcast over all
+    GenJets, with the eta-phi grid or with the compiled kernel, and the jets
+    are vetoed through their genJetIdx
+
+    Args:
+        events: awkward.Array
+            All events with all the branches
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        non_polluted_mask : awkward.Array
+            Jagged mask of the jets with a valid and non-polluted GenJet
+    """
+    veto_cfg = cfg.quality_cuts.pollution_veto
+    if kernels.use_compiled(cfg.production.backend):
+        gen_jet_eta, gen_jet_counts = pm.flatten_collection(events.GenJet_eta)
+        part_offsets = kernels.counts_to_offsets(
+                        awkward.to_numpy(awkward.num(events.GenPart_pt, axis=1)))
+        part_branches = [
+            pm.flatten_collection(events[f"GenPart_{var}"])[0]
+            for var in ['pdgId', 'status', 'statusFlags', 'pt', 'eta', 'phi']
+        ]
+        polluted_gen_jets = awkward.unflatten(kernels.polluted_gen_jets(
+                    gen_jet_eta, pm.flatten_collection(events.GenJet_phi)[0],
+                    kernels.counts_to_offsets(gen_jet_counts),
+                    *part_branches, part_offsets,
+                    veto_cfg.min_pt, veto_cfg.dR), gen_jet_counts)
+    elif cfg.matching.spatial_index:
+        lepton_mask = select_prompt_leptons(events, cfg)
+        gen_jet_eta, gen_jet_counts = pm.flatten_collection(events.GenJet_eta)
+        lepton_eta, lepton_counts = pm.flatten_collection(
+                                        events.GenPart_eta[lepton_mask])
+        gen_jet_idx, _, distances = pm.form_candidate_pairs(
+                    gen_jet_eta, pm.flatten_collection(events.GenJet_phi)[0],
+                    gen_jet_counts, lepton_eta,
+                    pm.flatten_collection(events.GenPart_phi[lepton_mask])[0],
+                    lepton_counts, veto_cfg.dR, use_grid=True)
+        n_close = np.bincount(
+                    gen_jet_idx[distances < veto_cfg.dR], minlength=len(gen_jet_eta))
+        polluted_gen_jets = awkward.unflatten(n_close > 0, gen_jet_counts)
+    else:
+        lepton_mask = select_prompt_leptons(events, cfg)
+        distances = pm.deltaR_matrix(
+                        events.GenJet_eta, events.GenJet_phi,
+                        events.GenPart_eta[lepton_mask],
+                        events.GenPart_phi[lepton_mask])
+        polluted_gen_jets = awkward.any(distances < veto_cfg.dR, axis=2)
+    gen_jet_idx = events.Jet_genJetIdx
+    valid_idx = (gen_jet_idx >= 0) & (gen_jet_idx < events.nGenJet)
+    polluted = polluted_gen_jets[awkward.mask(gen_jet_idx, valid_idx)]
+    return valid_idx & ~awkward.fill_none(polluted, True)
+
+
+def select_suitable_ref_objects(
         events: awkward.Array,
+        ref_obj: str,
+        cfg: DictConfig,
+        is_ref: bool = True) -> awkward.Array:
+    """ Columnar counterpart of pick_suitable_ref_objects
+
+    Args:
+        events: awkward.Array
+            All events with all the branches
+        ref_obj : str
+            The object comparison tau to match to.
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+        is_ref : bool
+            [default: True] Whether the objects are the reference objects of
+            the ntuple rather than the opposite objects
+
+    Returns:
+        good_ref_mask : awkward.Array
+            Jagged mask of the reference objects that pass the quality cuts
+    """
+    pt_mask = events[f"{ref_obj}_pt"] >= cfg.quality_cuts.genTau.pt
+    eta_mask = abs(events[f"{ref_obj}_eta"]) <= cfg.quality_cuts.genTau.eta
+    good_ref_mask = pt_mask & eta_mask
+    if uses_pollution_veto(ref_obj, cfg, is_ref):
+        good_ref_mask = good_ref_mask & select_non_polluted_jets(events, cfg)
+    return good_ref_mask
+
+
+def infer_output_path(
         ref_obj: str,
         sample_name: str,
-        cfg: DictConfig) -> None:
-    """Foo bar baz baax
+        cfg: DictConfig) -> tuple[str, str]:
+    """ Infers where the ntuple of a given reference object is written to
 
     Args:
-        events : awkward.Array
-            All events with all the variables from the input ntuple
-        ref_object : str
+        ref_obj : str
             The reference object for the matching
         sample_name : str
             Name of the sample to be ntupelized
@@ -117,47 +224,508 @@ def fill_ref_obj_ntuple(
             The configuration. Branch names are inferred from that.
 
     Returns:
-        None
+        output_path : str
+            Path of the output .root file
+        tree_path : str
+            Path of the tree in the output .root file
     """
-    if ref_obj != cfg.genTau:
-        data_file = cfg.TauID_fake.data_files[sample_name].path
-        tree_path = cfg.TauID_fake.data_files[sample_name].tree_path
-    else:
-        data_file = cfg.TauID_eff.data_files[sample_name].path
-        tree_path = cfg.TauID_eff.data_files[sample_name].tree_path
+    eff_type = "fake" if ref_obj != cfg.genTau else "eff"
+    data_file = cfg[f"TauID_{eff_type}"].data_files[sample_name].path
+    tree_path = cfg[f"TauID_{eff_type}"].data_files[sample_name].tree_path
     output_path = os.path.join(cfg.output_dir, data_file)
+    return output_path, tree_path
+
+
+def opposite_obj(ref_obj: str, cfg: DictConfig) -> str:
+    """ Returns the object whose matching is cross-checked against the
+    reference object: the recoJet for genTau and the genTau otherwise """
+    return cfg.genTau if ref_obj != cfg.genTau else cfg.fakes.recoJet
+
+
+def column_dtype(var_name: str, cfg: DictConfig) -> np.dtype:
+    """ Looks up the type of an ntuple column, either by the full name of the
+    variable or by the name without the object prefix
+
+    Args:
+        var_name : str
+            Full name of the variable, e.g. GenVisTau_status
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        dtype : numpy.dtype
+            The type of the column
+    """
+    column_dtypes = cfg.production.column_dtypes
+    if var_name in column_dtypes:
+        return np.dtype(column_dtypes[var_name])
+    short_name = var_name.split("_", 1)[-1]
+    return np.dtype(column_dtypes.get(short_name, column_dtypes.default))
+
+
+def allocate_columns(all_vars: list, n_entries: int, cfg: DictConfig) -> dict:
+    """ Preallocates the typed ntuple columns, filled with -999 for the
+    entries that will not be set
+
+    Args:
+        all_vars : list
+            Names of the ntuple columns
+        n_entries : int
+            Number of entries in the ntuple
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        res : dict
+            The ntuple columns
+    """
+    return {
+        var: np.full(n_entries, -999, dtype=column_dtype(var, cfg))
+        for var in all_vars
+    }
+
+
+def ntuple_dtypes(cfg: DictConfig) -> dict:
+    """ Returns the types of all the ntuple columns as configured """
+    return {
+        var: column_dtype(var, cfg)
+        for var in general.construct_var_names(cfg, cfg.genTau)
+    }
+
+
+def get_compression(cfg: DictConfig):
+    """ Returns the uproot compression of the output ntuples as configured """
+    compression = cfg.production.compression
+    return getattr(uproot, compression.algorithm)(compression.level)
+
+
+def create_ref_obj_ntuple(
+        events: awkward.Array,
+        ref_obj: str,
+        cfg: DictConfig) -> dict:
+    """ Creates the flat ntuple event by event, one entry per suitable
+    reference object. Only the dR matching method is supported
+
+    Args:
+        events : awkward.Array
+            All events with all the variables from the input ntuple
+        ref_object : str
+            The reference object for the matching
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        res : dict
+            The ntuple columns
+    """
+    if cfg.matching.method != 'dR':
+        raise ValueError(
+            f"Matching method '{cfg.matching.method}' is only available in "
+            "the columnar production without validation, use matching.method "
+            "'dR' for the event-by-event ntuple")
     all_vars = general.construct_var_names(cfg, cfg.genTau)
-    opp_obj = cfg.genTau if ref_obj != cfg.genTau else cfg.fakes.recoJet
-    fill_entries = []
-    for event in events:
-        good_ref_objects = pick_suitable_ref_objects(event, ref_obj, cfg)
-        good_opp_objects = pick_suitable_ref_objects(event, opp_obj, cfg)
+    opp_obj = opposite_obj(ref_obj, cfg)
+    event_ref_objects = [
+        pick_suitable_ref_objects(event, ref_obj, cfg) for event in events]
+    n_entries = sum(len(good_ref_objects) for good_ref_objects in event_ref_objects)
+    res = allocate_columns(all_vars, n_entries, cfg)
+    entry = 0
+    for event, good_ref_objects in zip(events, event_ref_objects):
+        good_opp_objects = pick_suitable_ref_objects(
+                                        event, opp_obj, cfg, is_ref=False)
         matched_ref_objects = pm.match_taus_to_refs(
                                         good_ref_objects, event, ref_obj, cfg)
         matched_opp_objects = pm.match_taus_to_refs(
                                         good_opp_objects, event, opp_obj, cfg)
         for ref_idx in good_ref_objects:
-            fill_entry = {var: -999 for var in all_vars}
             for info_branch in cfg.allVariables.info:
-                fill_entry[info_branch] = event[info_branch]
+                res[info_branch][entry] = event[info_branch]
             for obj_var in cfg.allVariables[ref_obj]:
                 obj_key = f"{ref_obj}_{obj_var}"
-                fill_entry[obj_key] = event[obj_key][ref_idx]
+                res[obj_key][entry] = event[obj_key][ref_idx]
             if ref_idx in matched_ref_objects:
                 matched_tau_idx = matched_ref_objects[ref_idx]
                 for tau_var in cfg.allVariables.tau:
                     tau_key = f"{cfg.comparison_tau}_{tau_var}"
-                    fill_entry[tau_key] = event[tau_key][matched_tau_idx]
+                    res[tau_key][entry] = event[tau_key][matched_tau_idx]
                 if matched_tau_idx in matched_opp_objects.values():
                     matched_opp_obj_idx = list(
                            matched_opp_objects.values()).index(matched_tau_idx)
                     opp_obj_idx = list(matched_opp_objects.keys())[matched_opp_obj_idx]
                     for opp_var in cfg.allVariables[opp_obj]:
                         opp_obj_key = f"{opp_obj}_{opp_var}"
-                        fill_entry[opp_obj_key] = event[opp_obj_key][matched_opp_obj_idx]
-            fill_entries.append(fill_entry)
-    res = {key: [] for key in all_vars}
-    {res[key].append(sub[key]) for sub in fill_entries for key in sub}
-    with uproot.recreate(output_path) as ntuple_file:
-        ntuple_file[tree_path] = res
+                        res[opp_obj_key][entry] = event[opp_obj_key][opp_obj_idx]
+            entry += 1
+    return res
+
+
+def find_matched_opp_objects(
+        matched_ref_taus: awkward.Array,
+        matched_opp_taus: awkward.Array) -> awkward.Array:
+    """ Finds for each reference object the opposite object that was matched
+    to the same tau
+
+    Args:
+        matched_ref_taus : awkward.Array
+            Index of the matched tau for each reference object, -1 if none
+        matched_opp_taus : awkward.Array
+            Index of the matched tau for each opposite object, -1 if none
+
+    Returns:
+        opp_obj_idx : awkward.Array
+            Index of the opposite object for each reference object, -1 if none
+    """
+    pairs = awkward.cartesian(
+                {"ref": matched_ref_taus, "opp": matched_opp_taus}, nested=True)
+    shared_tau = (pairs.ref == pairs.opp) & (pairs.ref >= 0)
+    opp_obj_idx = awkward.fill_none(awkward.argmax(shared_tau, axis=2), -1)
+    return awkward.where(awkward.any(shared_tau, axis=2), opp_obj_idx, -1)
+
+
+def gather(values: awkward.Array, idx: awkward.Array) -> awkward.Array:
+    """ Picks per event the entries of a jagged branch at the given indices,
+    filling -999 where the index is -1 """
+    return awkward.fill_none(values[awkward.mask(idx, idx >= 0)], -999)
+
+
+def match_ref_objects(
+        events: awkward.Array,
+        ref_objs: list,
+        cfg: DictConfig) -> dict:
+    """ Selects and matches the reference objects and their opposite objects
+    to taus, each object type exactly once per selection. The jets are
+    selected with the pollution veto as reference objects and without it as
+    opposite objects
+
+    Args:
+        events : awkward.Array
+            All events with all the variables from the input ntuple
+        ref_objs : list
+            The reference objects for the matching
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        matches : dict
+            The jagged mask of the suitable objects and the index of the
+            matched tau (-1 if none) for each object type and whether the
+            pollution veto is applied to it
+    """
+    matches = {}
+    for ref_obj in ref_objs:
+        for obj, is_ref in [(ref_obj, True), (opposite_obj(ref_obj, cfg), False)]:
+            key = (obj, uses_pollution_veto(obj, cfg, is_ref))
+            if key in matches:
+                continue
+            good_obj_mask = select_suitable_ref_objects(events, obj, cfg, is_ref)
+            matched_taus = pm.match_taus_to_refs_columnar(
+                                            good_obj_mask, events, obj, cfg)
+            matches[key] = (good_obj_mask, matched_taus)
+    return matches
+
+
+def create_ref_obj_ntuple_columnar(
+        events: awkward.Array,
+        ref_obj: str,
+        cfg: DictConfig,
+        matches: dict = None) -> dict:
+    """ Creates the same flat ntuple as create_ref_obj_ntuple, but with
+    whole-array operations over all events at once
+
+    Args:
+        events : awkward.Array
+            All events with all the variables from the input ntuple
+        ref_object : str
+            The reference object for the matching
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+        matches : dict
+            [default: None] The output of match_ref_objects, if already
+            computed for these events
+
+    Returns:
+        res : dict
+            The ntuple columns
+    """
+    all_vars = general.construct_var_names(cfg, cfg.genTau)
+    opp_obj = opposite_obj(ref_obj, cfg)
+    if matches is None:
+        matches = match_ref_objects(events, [ref_obj], cfg)
+    good_ref_mask, matched_ref_taus = matches[
+                                (ref_obj, uses_pollution_veto(ref_obj, cfg))]
+    matched_opp_taus = matches[
+                (opp_obj, uses_pollution_veto(opp_obj, cfg, is_ref=False))][1]
+    opp_obj_idx = find_matched_opp_objects(matched_ref_taus, matched_opp_taus)
+    columns = {}
+    for info_branch in cfg.allVariables.info:
+        columns[info_branch] = awkward.broadcast_arrays(
+                                    events[info_branch], good_ref_mask)[0]
+    for obj_var in cfg.allVariables[ref_obj]:
+        obj_key = f"{ref_obj}_{obj_var}"
+        columns[obj_key] = events[obj_key]
+    for tau_var in cfg.allVariables.tau:
+        tau_key = f"{cfg.comparison_tau}_{tau_var}"
+        columns[tau_key] = gather(events[tau_key], matched_ref_taus)
+    for opp_var in cfg.allVariables[opp_obj]:
+        opp_obj_key = f"{opp_obj}_{opp_var}"
+        columns[opp_obj_key] = gather(events[opp_obj_key], opp_obj_idx)
+    n_entries = awkward.sum(good_ref_mask)
+    res = allocate_columns(all_vars, n_entries, cfg)
+    for var, values in columns.items():
+        res[var][:] = awkward.to_numpy(awkward.flatten(values[good_ref_mask]))
+    return res
+
+
+def validate_columnar_ntuple(
+        events: awkward.Array,
+        ref_obj: str,
+        cfg: DictConfig,
+        n_events: int = None) -> dict:
+    """ Compares the columnar ntuple to the event-by-event one on a sample
+    of the events
+
+    Args:
+        events : awkward.Array
+            All events with all the variables from the input ntuple
+        ref_object : str
+            The reference object for the matching
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+        n_events : int
+            Number of events to validate on. All events if None
+
+    Returns:
+        mismatches : dict
+            Number of differing entries per column that does not agree
+    """
+    sample = events if n_events is None else events[:n_events]
+    expected = create_ref_obj_ntuple(sample, ref_obj, cfg)
+    observed = create_ref_obj_ntuple_columnar(sample, ref_obj, cfg)
+    mismatches = {}
+    for key, expected_values in expected.items():
+        expected_values = np.asarray(expected_values, dtype=float)
+        observed_values = np.asarray(observed[key], dtype=float)
+        if len(expected_values) != len(observed_values):
+            mismatches[key] = abs(len(expected_values) - len(observed_values))
+            continue
+        n_differing = np.sum(~np.isclose(expected_values, observed_values))
+        if n_differing > 0:
+            mismatches[key] = int(n_differing)
+    return mismatches
+
+
+class NtupleWriter:
+    """ Writes the ntuple to a .root file, either in one go or chunk by chunk.
+    The branch types are fixed by the given dtypes, so that the tree exists
+    even if nothing is written, or else by the first written chunk """
+    def __init__(
+            self,
+            output_path: str,
+            tree_path: str,
+            compression=None,
+            dtypes: dict = None) -> None:
+        self.output_path = output_path
+        self.tree_path = tree_path
+        self.dtypes = None
+        self.n_entries = 0
+        if compression is None:
+            self.ntuple_file = uproot.recreate(output_path)
+        else:
+            self.ntuple_file = uproot.recreate(
+                                        output_path, compression=compression)
+        if dtypes is not None:
+            self.dtypes = dict(dtypes)
+            self.ntuple_file.mktree(self.tree_path, self.dtypes)
+
+    def write(self, res: dict) -> None:
+        """ Appends the ntuple columns to the output tree """
+        if self.dtypes is None:
+            res = {key: np.asarray(values) for key, values in res.items()}
+            self.dtypes = {key: values.dtype for key, values in res.items()}
+            self.ntuple_file.mktree(self.tree_path, self.dtypes)
+            self.ntuple_file[self.tree_path].extend(res)
+        else:
+            res = {key: np.asarray(values, dtype=self.dtypes[key])
+                   for key, values in res.items()}
+            self.ntuple_file[self.tree_path].extend(res)
+        self.n_entries += len(next(iter(res.values())))
+
+    def close(self) -> None:
+        self.ntuple_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def create_ntuple(
+        events: awkward.Array,
+        ref_obj: str,
+        cfg: DictConfig) -> dict:
+    """ Creates the ntuple columns either in columnar or event-by-event mode
+    as set in the configuration """
+    if cfg.production.columnar:
+        return create_ref_obj_ntuple_columnar(events, ref_obj, cfg)
+    return create_ref_obj_ntuple(events, ref_obj, cfg)
+
+
+def create_ntuples(
+        events: awkward.Array,
+        ref_objs: list,
+        cfg: DictConfig) -> dict:
+    """ Creates the ntuples of several reference objects in one pass. In
+    columnar mode the matching of each object type is done only once and
+    shared between the ntuples
+
+    Args:
+        events : awkward.Array
+            All events with all the variables from the input ntuple
+        ref_objs : list
+            The reference objects for the matching
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        ntuples : dict
+            The ntuple columns for each reference object
+    """
+    if not cfg.production.columnar:
+        return {
+            ref_obj: create_ref_obj_ntuple(events, ref_obj, cfg)
+            for ref_obj in ref_objs
+        }
+    matches = match_ref_objects(events, ref_objs, cfg)
+    return {
+        ref_obj: create_ref_obj_ntuple_columnar(events, ref_obj, cfg, matches)
+        for ref_obj in ref_objs
+    }
+
+
+def report_validation(
+        events: awkward.Array,
+        ref_obj: str,
+        sample_name: str,
+        cfg: DictConfig) -> None:
+    """ Runs the validation of the columnar ntuple if it is enabled """
+    if not cfg.production.validation.enabled:
+        return None
+    mismatches = validate_columnar_ntuple(
+                events, ref_obj, cfg, cfg.production.validation.n_events)
+    if mismatches:
+        print(f"Columnar {ref_obj} ntuple differs from the event-by-event "
+              f"one in {sample_name}: {mismatches}")
+    else:
+        print(f"Columnar {ref_obj} ntuple validated for {sample_name}")
+    return None
+
+
+def fill_ref_obj_ntuple(
+        events: awkward.Array,
+        ref_obj: str,
+        sample_name: str,
+        cfg: DictConfig) -> None:
+    """ Creates the ntuple for the reference object and writes it to the
+    output directory
+
+    Args:
+        events : awkward.Array
+            All events with all the variables from the input ntuple
+        ref_object : str
+            The reference object for the matching
+        sample_name : str
+            Name of the sample to be ntupelized
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        None
+    """
+    output_path, tree_path = infer_output_path(ref_obj, sample_name, cfg)
+    report_validation(events, ref_obj, sample_name, cfg)
+    with NtupleWriter(output_path, tree_path, get_compression(cfg)) as writer:
+        writer.write(create_ntuple(events, ref_obj, cfg))
+    return None
+
+
+def fill_ntuples_in_chunks(
+        input_path: str,
+        tree_name: str,
+        ref_objs: list,
+        sample_name: str,
+        cfg: DictConfig) -> None:
+    """ Streams the input file chunk by chunk, creating the ntuples for all
+    the reference objects and appending them to the output trees, so that
+    the memory usage does not depend on the size of the input file. Used
+    when production.checkpoint is disabled, otherwise
+    parallel_production.fill_ntuples_in_checkpointed_chunks is used
+
+    Args:
+        input_path : str
+            Path to the input .root file
+        tree_name : str
+            Path of the tree in the input .root file
+        ref_objs : list
+            The reference objects for which the ntuples are created
+        sample_name : str
+            Name of the sample to be ntupelized
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        None
+    """
+    writers = {}
+    for ref_obj in ref_objs:
+        output_path, tree_path = infer_output_path(ref_obj, sample_name, cfg)
+        writers[ref_obj] = NtupleWriter(
+                                output_path, tree_path, get_compression(cfg),
+                                ntuple_dtypes(cfg))
+    try:
+        chunks = general.iterate_events(
+                    input_path, tree_name, cfg.production.step_size,
+                    general.construct_input_branches(cfg))
+        for chunk_idx, events in enumerate(chunks):
+            if chunk_idx == 0:
+                for ref_obj in ref_objs:
+                    report_validation(events, ref_obj, sample_name, cfg)
+            ntuples = create_ntuples(events, ref_objs, cfg)
+            for ref_obj in ref_objs:
+                writers[ref_obj].write(ntuples[ref_obj])
+            print(f"Processed chunk {chunk_idx} with {len(events)} events")
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return None
+
+
+def fill_ntuples(
+        events: awkward.Array,
+        ref_objs: list,
+        sample_name: str,
+        cfg: DictConfig) -> None:
+    """ Creates the ntuples of all the reference objects in one pass over the
+    events and writes them to the output directory
+
+    Args:
+        events : awkward.Array
+            All events with all the variables from the input ntuple
+        ref_objs : list
+            The reference objects for which the ntuples are created
+        sample_name : str
+            Name of the sample to be ntupelized
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        None
+    """
+    for ref_obj in ref_objs:
+        report_validation(events, ref_obj, sample_name, cfg)
+    ntuples = create_ntuples(events, ref_objs, cfg)
+    for ref_obj in ref_objs:
+        output_path, tree_path = infer_output_path(ref_obj, sample_name, cfg)
+        with NtupleWriter(output_path, tree_path, get_compression(cfg)) as writer:
+            writer.write(ntuples[ref_obj])
     return None
@@ -0,0 +1,453 @@
+""" Tools for producing the ntuples with multiple processes """
+import os
+import glob
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from omegaconf import DictConfig, OmegaConf
+from tau_performance.tools import ntuple_production as npro
+from tau_performance.tools import general
+from tau_performance.tools import caching
+
+
+def split_entry_ranges(
+        n_entries: int,
+        n_ranges: int = None,
+        entries_per_range: int = None) -> list[tuple[int, int]]:
+    """ Splits the entries of a tree into consecutive ranges
+
+    Args:
+        n_entries : int
+            Number of entries in the tree
+        n_ranges : int
+            [default: None] Number of ranges to split the entries into. Used
+            only when entries_per_range is not given
+        entries_per_range : int
+            [default: None] Maximal number of entries in one range
+
+    Returns:
+        entry_ranges : list[tuple[int, int]]
+            The start (inclusive) and stop (exclusive) entry of each range
+    """
+    if entries_per_range is None:
+        entries_per_range = -(-n_entries // max(n_ranges, 1))
+    entries_per_range = max(entries_per_range, 1)
+    entry_ranges = []
+    for entry_start in range(0, n_entries, entries_per_range):
+        entry_stop = min(entry_start + entries_per_range, n_entries)
+        entry_ranges.append((entry_start, entry_stop))
+    return entry_ranges
+
+
+def create_work_units(
+        input_paths: list,
+        tree_name: str,
+        cfg: DictConfig) -> list[tuple[str, tuple]]:
+    """ Splits the input files into work units. Each file is one unit unless
+    production.entries_per_range is set, a single input file is split into
+    one entry range per worker
+
+    Args:
+        input_paths : list
+            Paths of the input .root files
+        tree_name : str
+            Path of the tree in the input .root files
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        work_units : list[tuple[str, tuple]]
+            The input path and the entry range of each work unit
+    """
+    entries_per_range = cfg.production.entries_per_range
+    if len(input_paths) > 1 and entries_per_range is None:
+        return [(input_path, (None, None)) for input_path in input_paths]
+    work_units = []
+    for input_path in input_paths:
+        entry_ranges = split_entry_ranges(
+                        general.count_entries(input_path, tree_name),
+                        n_ranges=cfg.production.n_workers,
+                        entries_per_range=entries_per_range)
+        work_units.extend((input_path, entry_range) for entry_range in entry_ranges)
+    return work_units
+
+
+def infer_partial_output_path(
+        output_path: str,
+        unit_idx: int,
+        cfg: DictConfig) -> str:
+    """ Infers where the partial ntuple of a work unit is written to """
+    file_name, extension = os.path.splitext(os.path.basename(output_path))
+    partial_dir = os.path.join(cfg.output_dir, "partial")
+    return os.path.join(partial_dir, f"{file_name}_{unit_idx:05d}{extension}")
+
+
+def process_entry_range(
+        input_path: str,
+        tree_name: str,
+        entry_range: tuple,
+        unit_idx: int,
+        ref_objs: list,
+        sample_name: str,
+        cfg: DictConfig) -> dict:
+    """ Creates the ntuples of all the reference objects for one entry range
+    of an input file and writes them to partial output files. The range is
+    read in chunks if production.step_size is set. The validation is run on
+    the first chunk of the first work unit
+
+    Args:
+        input_path : str
+            Path to the input .root file
+        tree_name : str
+            Path of the tree in the input .root file
+        entry_range : tuple
+            The start (inclusive) and stop (exclusive) entry to be processed,
+            (None, None) for the whole file
+        unit_idx : int
+            Index of the work unit, used for naming the partial outputs
+        ref_objs : list
+            The reference objects for which the ntuples are created
+        sample_name : str
+            Name of the sample to be ntupelized
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        partial_paths : dict
+            Path of the partial output for each reference object
+    """
+    input_branches = general.construct_input_branches(cfg)
+    entry_start, entry_stop = entry_range
+    if cfg.production.step_size is None:
+        chunks = [general.load_events(
+                        input_path, tree_name, input_branches,
+                        entry_start=entry_start, entry_stop=entry_stop)]
+    else:
+        chunks = general.iterate_events(
+                        input_path, tree_name, cfg.production.step_size,
+                        input_branches, entry_start=entry_start,
+                        entry_stop=entry_stop)
+    writers = {}
+    partial_paths = {}
+    for ref_obj in ref_objs:
+        output_path, tree_path = npro.infer_output_path(ref_obj, sample_name, cfg)
+        partial_paths[ref_obj] = infer_partial_output_path(
+                                                output_path, unit_idx, cfg)
+        writers[ref_obj] = npro.NtupleWriter(
+                        partial_paths[ref_obj], tree_path,
+                        npro.get_compression(cfg), npro.ntuple_dtypes(cfg))
+    try:
+        for chunk_idx, events in enumerate(chunks):
+            if unit_idx == 0 and chunk_idx == 0:
+                for ref_obj in ref_objs:
+                    npro.report_validation(events, ref_obj, sample_name, cfg)
+            ntuples = npro.create_ntuples(events, ref_objs, cfg)
+            for ref_obj in ref_objs:
+                writers[ref_obj].write(ntuples[ref_obj])
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return partial_paths
+
+
+def merge_partial_ntuples(
+        partial_paths: list,
+        output_path: str,
+        tree_path: str,
+        compression=None,
+        dtypes: dict = None) -> None:
+    """ Merges the partial ntuples into one in the given order. The merged
+    tree is created from the column types even if there are no entries
+
+    Args:
+        partial_paths : list
+            Paths of the partial ntuples, in the order of the entries
+        output_path : str
+            Path of the merged output .root file
+        tree_path : str
+            Path of the tree in the .root files
+        compression : uproot compression
+            [default: None] Compression of the merged output
+        dtypes : dict
+            [default: None] Types of the columns of the merged tree, see
+            ntuple_production.ntuple_dtypes
+
+    Returns:
+        None
+    """
+    with npro.NtupleWriter(output_path, tree_path, compression, dtypes) as writer:
+        for partial_path in partial_paths:
+            events = general.load_events(partial_path, tree_path)
+            writer.write({key: events[key].to_numpy() for key in events.fields})
+    return None
+
+
+def collect_partial_ntuples(
+        partial_paths: list,
+        output_path: str) -> None:
+    """ Moves the partial ntuples next to the output path instead of merging
+    them, numbered in the order of the work units """
+    file_name, extension = os.path.splitext(output_path)
+    for unit_idx, partial_path in enumerate(partial_paths):
+        os.replace(partial_path, f"{file_name}_{unit_idx:05d}{extension}")
+    return None
+
+
+def find_output_paths(output_path: str) -> list:
+    """ Finds the existing ntuples written for an output path, i.e. the
+    output itself and the numbered ntuples of the work units that are kept
+    by collect_partial_ntuples when production.merge is disabled
+
+    Args:
+        output_path : str
+            Path of the merged output .root file
+
+    Returns:
+        output_paths : list
+            Paths of the existing ntuples, the numbered ones in the order of
+            the work units
+    """
+    file_name, extension = os.path.splitext(output_path)
+    numbered_paths = sorted(glob.glob(
+                f"{glob.escape(file_name)}_{'[0-9]' * 5}{extension}"))
+    merged_paths = [output_path] if os.path.exists(output_path) else []
+    return merged_paths + numbered_paths
+
+
+def compute_manifest_key(
+        work_units: list,
+        ref_objs: list,
+        sample_name: str,
+        cfg: DictConfig) -> str:
+    """ Computes the key identifying a production, i.e. the work units, the
+    identity of the input files and the parts of the configuration that
+    affect the content of the ntuples """
+    production_cfg = OmegaConf.to_container(cfg.production, resolve=True)
+    del production_cfg["n_workers"]
+    key_content = {
+        "work_units": [
+            [os.path.abspath(input_path), list(entry_range)]
+            for input_path, entry_range in work_units
+        ],
+        "inputs": [
+            caching.file_identity(input_path, cfg.production.cache.checksum)
+            for input_path in dict.fromkeys(
+                        input_path for input_path, _ in work_units)
+        ],
+        "ref_objs": list(ref_objs),
+        "sample_name": sample_name,
+        "comparison_tau": cfg.comparison_tau,
+        "genTau": cfg.genTau,
+        "fakes": OmegaConf.to_container(cfg.fakes, resolve=True),
+        "matching": OmegaConf.to_container(cfg.matching, resolve=True),
+        "quality_cuts": OmegaConf.to_container(cfg.quality_cuts, resolve=True),
+        "allVariables": OmegaConf.to_container(cfg.allVariables, resolve=True),
+        "production": production_cfg,
+    }
+    serialized = json.dumps(key_content, sort_keys=True)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+def load_manifest(manifest_path: str, key: str) -> dict:
+    """ Loads the checkpoint manifest of a production. A manifest written
+    for different inputs or configuration is discarded
+
+    Args:
+        manifest_path : str
+            Path of the manifest .json file
+        key : str
+            The key of the current production
+
+    Returns:
+        manifest : dict
+            The key and the partial output paths of the completed work units
+    """
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "rt") as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest["key"] == key:
+            return manifest
+        print(f"Discarding the outdated checkpoint {manifest_path}")
+    return {"key": key, "completed": {}}
+
+
+def save_manifest(manifest: dict, manifest_path: str) -> None:
+    """ Writes the manifest atomically, so that an interrupted run never
+    leaves a corrupt one behind """
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "wt") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.replace(tmp_path, manifest_path)
+    return None
+
+
+def is_completed(unit_idx: int, manifest: dict) -> bool:
+    """ Checks whether the work unit is recorded as done in the manifest and
+    its partial outputs still exist """
+    partial_paths = manifest["completed"].get(str(unit_idx))
+    if partial_paths is None:
+        return False
+    return all(os.path.exists(path) for path in partial_paths.values())
+
+
+def create_chunk_units(
+        input_path: str,
+        tree_name: str,
+        cfg: DictConfig) -> list[tuple[str, tuple]]:
+    """ Splits the input file into work units of one production.step_size
+    chunk each """
+    entries_per_chunk = general.count_step_entries(
+                        input_path, tree_name, cfg.production.step_size,
+                        general.construct_input_branches(cfg))
+    entry_ranges = split_entry_ranges(
+                        general.count_entries(input_path, tree_name),
+                        entries_per_range=entries_per_chunk)
+    return [(input_path, entry_range) for entry_range in entry_ranges]
+
+
+def fill_work_units(
+        work_units: list,
+        tree_name: str,
+        ref_objs: list,
+        sample_name: str,
+        cfg: DictConfig) -> None:
+    """ Creates the ntuples of each work unit, in separate processes if
+    production.n_workers is above one, and merges them preserving the entry
+    order. With production.checkpoint the completed units are recorded in a
+    manifest and skipped when rerun
+
+    Args:
+        work_units : list
+            The input path and the entry range of each work unit
+        tree_name : str
+            Path of the tree in the input .root files
+        ref_objs : list
+            The reference objects for which the ntuples are created
+        sample_name : str
+            Name of the sample to be ntupelized
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        None
+    """
+    n_workers = cfg.production.n_workers
+    partial_dir = os.path.join(cfg.output_dir, "partial")
+    os.makedirs(partial_dir, exist_ok=True)
+    manifest_path = os.path.join(partial_dir, f"{sample_name}_manifest.json")
+    key = compute_manifest_key(work_units, ref_objs, sample_name, cfg)
+    if cfg.production.checkpoint:
+        manifest = load_manifest(manifest_path, key)
+    else:
+        manifest = {"key": key, "completed": {}}
+    unit_args = [
+        (input_path, tree_name, entry_range, unit_idx, ref_objs, sample_name, cfg)
+        for unit_idx, (input_path, entry_range) in enumerate(work_units)
+        if not is_completed(unit_idx, manifest)
+    ]
+    n_skipped = len(work_units) - len(unit_args)
+    if n_skipped > 0:
+        print(f"Skipping {n_skipped} work units completed in a previous run")
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(process_entry_range, *args): args[3]
+                       for args in unit_args}
+            failures = {}
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    failures[futures[future]] = future.exception()
+                    continue
+                manifest["completed"][str(futures[future])] = future.result()
+                if cfg.production.checkpoint:
+                    save_manifest(manifest, manifest_path)
+            if failures:
+                messages = [
+                    f"  unit {unit_idx}: {type(error).__name__}: {error}"
+                    for unit_idx, error in sorted(failures.items())
+                ]
+                raise RuntimeError(
+                    f"Work units {sorted(failures)} failed:\n"
+                    + "\n".join(messages)) from failures[min(failures)]
+    else:
+        for args in unit_args:
+            manifest["completed"][str(args[3])] = process_entry_range(*args)
+            if cfg.production.checkpoint:
+                save_manifest(manifest, manifest_path)
+    print(f"Processed {len(unit_args)} work units")
+    all_partial_paths = [
+        manifest["completed"][str(unit_idx)] for unit_idx in range(len(work_units))
+    ]
+    for ref_obj in ref_objs:
+        output_path, tree_path = npro.infer_output_path(ref_obj, sample_name, cfg)
+        partial_paths = [paths[ref_obj] for paths in all_partial_paths]
+        if cfg.production.merge:
+            merge_partial_ntuples(
+                partial_paths, output_path, tree_path,
+                npro.get_compression(cfg), npro.ntuple_dtypes(cfg))
+            for partial_path in partial_paths:
+                os.remove(partial_path)
+        else:
+            collect_partial_ntuples(partial_paths, output_path)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    return None
+
+
+def fill_ntuples_in_parallel(
+        input_paths: list,
+        tree_name: str,
+        ref_objs: list,
+        sample_name: str,
+        cfg: DictConfig) -> None:
+    """ Splits the input files into work units, creates the ntuples of each
+    unit in a separate process and merges them preserving the entry order
+
+    Args:
+        input_paths : list
+            Paths of the input .root files
+        tree_name : str
+            Path of the tree in the input .root files
+        ref_objs : list
+            The reference objects for which the ntuples are created
+        sample_name : str
+            Name of the sample to be ntupelized
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        None
+    """
+    work_units = create_work_units(input_paths, tree_name, cfg)
+    fill_work_units(work_units, tree_name, ref_objs, sample_name, cfg)
+    return None
+
+
+def fill_ntuples_in_checkpointed_chunks(
+        input_path: str,
+        tree_name: str,
+        ref_objs: list,
+        sample_name: str,
+        cfg: DictConfig) -> None:
+    """ Streams the input file chunk by chunk like
+    ntuple_production.fill_ntuples_in_chunks, but writes each chunk as a
+    work unit of its own, so that an interrupted run resumes after the last
+    completed chunk
+
+    Args:
+        input_path : str
+            Path to the input .root file
+        tree_name : str
+            Path of the tree in the input .root file
+        ref_objs : list
+            The reference objects for which the ntuples are created
+        sample_name : str
+            Name of the sample to be ntupelized
+        cfg : omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        None
+    """
+    work_units = create_chunk_units(input_path, tree_name, cfg)
+    fill_work_units(work_units, tree_name, ref_objs, sample_name, cfg)
+    return None
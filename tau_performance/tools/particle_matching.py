@@ -2,45 +2,46 @@
 import numpy as np
 import awkward
 from omegaconf import DictConfig
-from collections import Counter
+from tau_performance.tools import matching_algorithms as ma
+from tau_performance.tools import kernels
+from tau_performance.tools import spatial_index
 
 
-def deltaPhi(phi1: float, phi2: float) -> float:
-    """ Calculates the difference in azimuthal angle between two particles
+def deltaPhi(phi1, phi2):
+    """ Calculates the difference in azimuthal angle between two particles.
+    Works on scalars, NumPy arrays and (jagged) awkward arrays alike
 
     Args:
-        phi1 : float
+        phi1 : float, numpy.ndarray or awkward.Array
             The azimuthal angle of the first particle
-        phi2: float
+        phi2: float, numpy.ndarray or awkward.Array
             The azimuthal angle of the second particle
 
     Returns:
-        dPhi : float
+        dPhi : float, numpy.ndarray or awkward.Array
             The difference in azimuthal angle.
     """
     phi = np.abs(phi1 - phi2)
-    if phi <= np.pi:
-        return phi
-    else:
-        return 2*np.pi - phi
+    return np.minimum(phi, 2*np.pi - phi)
 
 
-def deltaR(eta1: float, phi1: float, eta2: float, phi2: float) -> float:
+def deltaR(eta1, phi1, eta2, phi2):
     """ Calculates the angular separation between two particles given the
-    pseudorapidities and azimuthal angles of both particles
+    pseudorapidities and azimuthal angles of both particles. Works on
+    scalars, NumPy arrays and (jagged) awkward arrays alike
 
     Args:
-        eta1 : float
+        eta1 : float, numpy.ndarray or awkward.Array
             The pseudorapidity of the first particle
-        phi1 : float
+        phi1 : float, numpy.ndarray or awkward.Array
             The azimuthal angle of the first particle
-        eta2 : float
+        eta2 : float, numpy.ndarray or awkward.Array
             The pseudorapidity of the second particle
-        phi2: float
+        phi2: float, numpy.ndarray or awkward.Array
             The azimuthal angle of the second particle
 
     Returns:
-        deltaR : float
+        deltaR : float, numpy.ndarray or awkward.Array
             The angular separation between two particles.
     """
     deta = eta1 - eta2
@@ -48,6 +49,40 @@ def deltaR(eta1: float, phi1: float, eta2: float, phi2: float) -> float:
     return np.hypot(deta, dphi)
 
 
+def deltaR_matrix(eta1, phi1, eta2, phi2):
+    """ Calculates the angular separation between all pairs of particles of
+    two collections. For jagged awkward arrays the pairs are formed within
+    each event
+
+    Args:
+        eta1 : numpy.ndarray or awkward.Array
+            The pseudorapidities of the first collection
+        phi1 : numpy.ndarray or awkward.Array
+            The azimuthal angles of the first collection
+        eta2 : numpy.ndarray or awkward.Array
+            The pseudorapidities of the second collection
+        phi2: numpy.ndarray or awkward.Array
+            The azimuthal angles of the second collection
+
+    Returns:
+        distances : numpy.ndarray or awkward.Array
+            The angular separations, indexed as [(event,) first, second]
+    """
+    if isinstance(eta1, awkward.Array) and eta1.ndim > 1:
+        first = awkward.zip({"eta": eta1, "phi": phi1})
+        second = awkward.zip({"eta": eta2, "phi": phi2})
+        pairs = awkward.cartesian(
+                            {"first": first, "second": second}, nested=True)
+        return deltaR(
+                    pairs.first.eta, pairs.first.phi,
+                    pairs.second.eta, pairs.second.phi)
+    return deltaR(
+                np.asarray(eta1)[..., :, np.newaxis],
+                np.asarray(phi1)[..., :, np.newaxis],
+                np.asarray(eta2)[..., np.newaxis, :],
+                np.asarray(phi2)[..., np.newaxis, :])
+
+
 def check_for_double_count(matched_objects: dict) -> tuple[int, list[int]]:
     """ Counts the number of taus that are represented multiple times and
     returns the objects that share the same tau reference.
@@ -63,65 +98,28 @@ def check_for_double_count(matched_objects: dict) -> tuple[int, list[int]]:
         objects_sharing_tau : list[int]
             Indices of the objects that have duplicate taus
     """
-    objects_sharing_tau = []
-    all_taus_w_duplicates = list(matched_objects.values())
-    unique_taus = set(all_taus_w_duplicates)
-    duplicate_taus = list(
-            (Counter(all_taus_w_duplicates) - Counter(unique_taus)).elements())
-    for duplicate_tau in duplicate_taus:
-        duplicate_locs = list(np.where(
-            np.array(all_taus_w_duplicates) == duplicate_tau)[0])
-        for duplicate_loc in duplicate_locs:
-            objects_sharing_tau.append(list(matched_objects.keys())[duplicate_loc])
-    double_count = len(duplicate_taus)
+    objects = np.fromiter(matched_objects.keys(), dtype=np.int64)
+    taus = np.fromiter(matched_objects.values(), dtype=np.int64)
+    _, tau_pos, tau_counts = np.unique(
+                                taus, return_inverse=True, return_counts=True)
+    shared = tau_counts[tau_pos] > 1
+    # Grouped by tau, in the order the taus first appear
+    first_appearance = np.full(len(tau_counts), len(taus))
+    np.minimum.at(first_appearance, tau_pos, np.arange(len(taus)))
+    order = np.argsort(first_appearance[tau_pos[shared]], kind='stable')
+    objects_sharing_tau = objects[shared][order].tolist()
+    double_count = int(np.sum(tau_counts - 1))
     return double_count, objects_sharing_tau
 
 
-def calculate_conflicting_obj_distances(
-        objects_sharing_tau: list[int],
-        matched_objects: dict,
-        event: awkward.Array,
-        ref_obj: str,
-        cfg: DictConfig) -> dict:
-    """ Calculates the distances of the conflicting objects to the taus
-
-    Args:
-        objects_sharing_tau: list[int]
-            Objects that share the same tau between themselves
-        matched_objects: dict
-            The object indices with matching tau index
-        event: awkward.Array
-            The event entry with all the variables
-        ref_obj : str
-            The object comparison tau to match to.
-        cfg: omegaconf.DictConfig
-            The configuration. Branch names are inferred from that.
-
-    Returns:
-        distances : dict
-            Distances between all conflicting taus and objects
-    """
-    distances = {}
-    duplicate_taus = [matched_objects[obj_idx] for obj_idx in objects_sharing_tau]
-    for obj_idx in objects_sharing_tau:
-        for tau_idx in duplicate_taus:
-            distance_key = "_".join([str(obj_idx), str(tau_idx)])
-            distances[distance_key] = deltaR(
-                event["%s_eta" %cfg.comparison_tau][tau_idx],
-                event["%s_phi" %cfg.comparison_tau][tau_idx],
-                event[f"{ref_obj}_eta"][obj_idx],
-                event[f"{ref_obj}_phi"][obj_idx]
-            )
-    return distances
-
-
 def resolve_matching_conflicts(
         objects_sharing_tau: list[int],
         matched_objects: dict,
         event: awkward.Array,
         ref_obj: str,
         cfg: DictConfig) -> dict:
-    """ Resolves the conflicts of objects that share the same tau.
+    """ Resolves the conflicts of objects that share the same tau by greedy
+    matching of all the conflicting object and tau pairs.
 
     Args:
         objects_sharing_tau: list[int]
@@ -139,23 +137,24 @@ def resolve_matching_conflicts(
         matched_objects_ : dict
             The matched taus to the requested objects
 """
-    matched_objects_ = matched_objects.copy()
-    distances = calculate_conflicting_obj_distances(
-                    objects_sharing_tau, matched_objects_, event, ref_obj, cfg)
-    for obj_idx in objects_sharing_tau:
-        del matched_objects_[obj_idx]
-    while distances != {}:
-        shortest_distance_key = min(distances, key=distances.get)
-        obj_idx = int(shortest_distance_key.split("_")[0])
-        tau_idx = int(shortest_distance_key.split("_")[1])
-        matched_objects_[obj_idx] = tau_idx
-        for_removal = []
-        for distance_key in distances.keys():
-            obj_part, tau_part = distance_key.split("_")
-            if (obj_part == str(obj_idx)) or (tau_part == str(tau_idx)):
-                for_removal.append(distance_key)
-        for distance_key in for_removal:
-            del distances[distance_key]
+    objects = list(dict.fromkeys(objects_sharing_tau))
+    taus = list(dict.fromkeys(matched_objects[obj_idx] for obj_idx in objects))
+    distance_matrix = deltaR_matrix(
+        np.asarray(event[f"{ref_obj}_eta"])[objects],
+        np.asarray(event[f"{ref_obj}_phi"])[objects],
+        np.asarray(event["%s_eta" %cfg.comparison_tau])[taus],
+        np.asarray(event["%s_phi" %cfg.comparison_tau])[taus]
+    )
+    ref_idx, tau_idx = np.indices(distance_matrix.shape)
+    matched_tau_idx = ma.greedy_matching(
+        ref_idx.ravel(), tau_idx.ravel(), distance_matrix.ravel(), len(objects))
+    matched_objects_ = {
+        obj_idx: tau for obj_idx, tau in matched_objects.items()
+        if obj_idx not in objects
+    }
+    for obj_idx, tau_pos in zip(objects, matched_tau_idx):
+        if tau_pos >= 0:
+            matched_objects_[obj_idx] = taus[tau_pos]
     return matched_objects_
 
 
@@ -165,7 +164,9 @@ def match_taus_to_refs(
         ref_obj: str,
         cfg: DictConfig) -> dict:
     """ Matches taus to the reference objects and reports the double count
-    after the matching.
+    after the matching. Algorithms other than closest_first in
+    matching.algorithm are applied to the pairs within dR_max with
+    matching_algorithms.match_pairs
 
     Args:
         reference_obj_idxs : list[int]
@@ -182,24 +183,366 @@ def match_taus_to_refs(
             The matched taus to the requested objects
     """
     matched_objects = {}
+    tau_eta = np.asarray(event["%s_eta" %cfg.comparison_tau])
+    tau_phi = np.asarray(event["%s_phi" %cfg.comparison_tau])
+    ref_eta = np.asarray(event[f"{ref_obj}_eta"])
+    ref_phi = np.asarray(event[f"{ref_obj}_phi"])
+    if cfg.matching.algorithm != 'closest_first':
+        objects = np.asarray(reference_obj_idxs, dtype=np.int64)
+        distance_matrix = deltaR_matrix(
+                ref_eta[objects], ref_phi[objects], tau_eta, tau_phi)
+        ref_idx, tau_idx = np.nonzero(distance_matrix <= cfg.matching.dR_max)
+        matched_tau_idx = ma.match_pairs(
+                ref_idx, tau_idx, distance_matrix[ref_idx, tau_idx],
+                len(objects), algorithm=cfg.matching.algorithm)
+        return {
+            int(obj_idx): int(tau) for obj_idx, tau in zip(objects, matched_tau_idx)
+            if tau >= 0
+        }
     for obj_idx in reference_obj_idxs:
-        best_match_idx = -1
-        dR_max = cfg.matching.dR_max
-        for tau_idx in range(event[f"n{cfg.comparison_tau}"]):
-            dR = deltaR(
-                event["%s_eta" %cfg.comparison_tau][tau_idx],
-                event["%s_phi" %cfg.comparison_tau][tau_idx],
-                event[f"{ref_obj}_eta"][obj_idx],
-                event[f"{ref_obj}_phi"][obj_idx]
-            )
-            if dR > dR_max:
-                continue
-            dR_max = dR
-            best_match_idx = tau_idx
-        if best_match_idx >= 0:
-            matched_objects[obj_idx] = best_match_idx
+        dRs = deltaR(tau_eta, tau_phi, ref_eta[obj_idx], ref_phi[obj_idx])
+        if not np.any(dRs <= cfg.matching.dR_max):
+            continue
+        # The last of equally close taus is picked
+        best_match_idx = len(dRs) - 1 - np.argmin(dRs[::-1])
+        matched_objects[obj_idx] = int(best_match_idx)
     double_count, objects_sharing_tau = check_for_double_count(matched_objects)
     if double_count > 0:
         matched_objects = resolve_matching_conflicts(
             objects_sharing_tau, matched_objects, event, ref_obj, cfg)
     return matched_objects
+
+
+def flatten_collection(values: awkward.Array) -> tuple[np.ndarray, np.ndarray]:
+    """ Splits a jagged collection into its flat content and the per event
+    counts """
+    counts = awkward.to_numpy(awkward.num(values, axis=1))
+    return awkward.to_numpy(awkward.flatten(values, axis=1)), counts
+
+
+def form_candidate_pairs(
+        ref_eta: np.ndarray,
+        ref_phi: np.ndarray,
+        ref_counts: np.ndarray,
+        tau_eta: np.ndarray,
+        tau_phi: np.ndarray,
+        tau_counts: np.ndarray,
+        dR_max: float,
+        use_grid: bool = False) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Forms all the reference object and tau pairs within the same event
+    that are closer than dR_max, working on the flat content of the
+    collections. The distances are computed for all the pairs of an event or,
+    with use_grid, only for the pairs in neighbouring eta-phi grid cells
+
+    Args:
+        ref_eta, ref_phi : numpy.ndarray
+            Flat pseudorapidities and azimuthal angles of the reference objects
+        ref_counts : numpy.ndarray
+            Number of reference objects in each event
+        tau_eta, tau_phi : numpy.ndarray
+            Flat pseudorapidities and azimuthal angles of the taus
+        tau_counts : numpy.ndarray
+            Number of taus in each event
+        dR_max : float
+            Maximal angular separation of a pair
+        use_grid : bool
+            [default: False] Whether to preselect the pairs with
+            spatial_index.neighbour_pairs
+
+    Returns:
+        ref_idx : numpy.ndarray
+            Flat index of the reference object of each pair
+        tau_idx : numpy.ndarray
+            Flat index of the tau of each pair
+        distances : numpy.ndarray
+            Angular separation of each pair
+    """
+    if use_grid:
+        ref_idx, tau_idx = spatial_index.neighbour_pairs(
+                                ref_eta, ref_phi, ref_counts,
+                                tau_eta, tau_phi, tau_counts, dR_max)
+    else:
+        ref_offsets = np.cumsum(ref_counts) - ref_counts
+        tau_offsets = np.cumsum(tau_counts) - tau_counts
+        n_pairs = ref_counts * tau_counts
+        pair_event = np.repeat(np.arange(len(n_pairs)), n_pairs)
+        pair_offsets = np.cumsum(n_pairs) - n_pairs
+        local_pair_idx = np.arange(np.sum(n_pairs)) - pair_offsets[pair_event]
+        event_tau_counts = tau_counts[pair_event]
+        ref_idx = ref_offsets[pair_event] + local_pair_idx // event_tau_counts
+        tau_idx = tau_offsets[pair_event] + local_pair_idx % event_tau_counts
+    distances = deltaR(
+                    ref_eta[ref_idx], ref_phi[ref_idx],
+                    tau_eta[tau_idx], tau_phi[tau_idx])
+    close = distances <= dR_max
+    return ref_idx[close], tau_idx[close], distances[close]
+
+
+def match_collections(
+        ref_eta: awkward.Array,
+        ref_phi: awkward.Array,
+        tau_eta: awkward.Array,
+        tau_phi: awkward.Array,
+        dR_max: float,
+        ref_mask: awkward.Array = None,
+        algorithm: str = 'closest_first',
+        backend: str = 'numpy',
+        tau_mask: awkward.Array = None,
+        use_grid: bool = False) -> awkward.Array:
+    """ Matches the taus to the reference objects of all the events at once.
+    The collections are flattened, the candidate pairs within dR_max are
+    formed and the conflicts are resolved with the chosen algorithm of
+    matching_algorithms, without any per-event Python loop
+
+    Args:
+        ref_eta, ref_phi : awkward.Array
+            Jagged pseudorapidities and azimuthal angles of the reference objects
+        tau_eta, tau_phi : awkward.Array
+            Jagged pseudorapidities and azimuthal angles of the taus
+        dR_max : float
+            Maximal angular separation of a matched pair
+        ref_mask : awkward.Array
+            [default: None] Jagged mask of the reference objects to be matched
+        algorithm : str
+            [default: 'closest_first'] The matching algorithm, one of
+            matching_algorithms.ALGORITHMS
+        backend : str
+            [default: 'numpy'] One of kernels.BACKENDS. With the compiled
+            backend the candidate pairs and their resolution are computed by
+            the kernels
+        tau_mask : awkward.Array
+            [default: None] Jagged mask of the taus that can be matched
+        use_grid : bool
+            [default: False] Whether to form the candidate pairs with the
+            eta-phi grid of spatial_index. Not used by the compiled backend
+
+    Returns:
+        matched_tau_idx : awkward.Array
+            Per event index of the matched tau for each reference object,
+            -1 if none
+    """
+    ref_eta_flat, ref_counts = flatten_collection(ref_eta)
+    ref_phi_flat, _ = flatten_collection(ref_phi)
+    tau_eta_flat, tau_counts = flatten_collection(tau_eta)
+    tau_phi_flat, _ = flatten_collection(tau_phi)
+    if kernels.use_compiled(backend):
+        ref_idx, tau_idx, distances = kernels.candidate_pairs(
+                    ref_eta_flat, ref_phi_flat, kernels.counts_to_offsets(ref_counts),
+                    tau_eta_flat, tau_phi_flat, kernels.counts_to_offsets(tau_counts),
+                    dR_max)
+    else:
+        ref_idx, tau_idx, distances = form_candidate_pairs(
+                                ref_eta_flat, ref_phi_flat, ref_counts,
+                                tau_eta_flat, tau_phi_flat, tau_counts, dR_max,
+                                use_grid)
+    selected = np.ones(len(ref_idx), dtype=bool)
+    if ref_mask is not None:
+        selected &= flatten_collection(ref_mask)[0][ref_idx]
+    if tau_mask is not None:
+        selected &= flatten_collection(tau_mask)[0][tau_idx]
+    ref_idx, tau_idx, distances = (
+                ref_idx[selected], tau_idx[selected], distances[selected])
+    ref_event = np.repeat(np.arange(len(ref_counts)), ref_counts)
+    matched_tau_idx = ma.match_pairs(
+                            ref_idx, tau_idx, distances, len(ref_eta_flat),
+                            ref_event[ref_idx], algorithm, backend)
+    return to_local_index(matched_tau_idx, ref_counts, tau_counts)
+
+
+def to_local_index(
+        matched_tau_idx: np.ndarray,
+        ref_counts: np.ndarray,
+        tau_counts: np.ndarray) -> awkward.Array:
+    """ Converts the flat indices of the matched taus into per event indices
+    and restores the jagged structure of the reference objects """
+    ref_event = np.repeat(np.arange(len(ref_counts)), ref_counts)
+    tau_offsets = np.cumsum(tau_counts) - tau_counts
+    matched = matched_tau_idx >= 0
+    matched_tau_idx[matched] -= tau_offsets[ref_event[matched]]
+    return awkward.unflatten(matched_tau_idx, ref_counts)
+
+
+def index_links(events: awkward.Array, ref_obj: str, cfg: DictConfig) -> awkward.Array:
+    """ Finds for each tau the reference object it is linked to by the index
+    branches: jetIdx for reco jets, jetIdx followed by Jet_genJetIdx for
+    GenJets and genPartIdx of the genuine taus (genPartFlav 5) for the
+    generator level visible taus
+
+    Args:
+        events: awkward.Array
+            All events with all the variables
+        ref_obj : str
+            The object comparison tau to match to.
+        cfg: omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        links : awkward.Array
+            Index of the linked reference object for each tau, -1 if the tau
+            has no valid link
+    """
+    tau = cfg.comparison_tau
+    if ref_obj == cfg.genTau:
+        is_genuine = events[f"{tau}_genPartFlav"] == 5
+        links = awkward.where(is_genuine, events[f"{tau}_genPartIdx"], -1)
+    elif ref_obj == cfg.fakes.recoJet:
+        links = events[f"{tau}_jetIdx"]
+    elif ref_obj == cfg.fakes.genJet:
+        jet_links = events[f"{tau}_jetIdx"]
+        valid = (jet_links >= 0) & (jet_links < events[f"n{cfg.fakes.recoJet}"])
+        links = awkward.fill_none(
+                events["Jet_genJetIdx"][awkward.mask(jet_links, valid)], -1)
+    else:
+        raise ValueError(f"No index links from the taus to '{ref_obj}'")
+    valid = (links >= 0) & (links < events[f"n{ref_obj}"])
+    return awkward.where(valid, links, -1)
+
+
+def match_by_index(
+        links: awkward.Array,
+        ref_eta: awkward.Array,
+        ref_phi: awkward.Array,
+        tau_eta: awkward.Array,
+        tau_phi: awkward.Array,
+        dR_max: float,
+        ref_mask: awkward.Array = None,
+        algorithm: str = 'closest_first',
+        backend: str = 'numpy',
+        use_grid: bool = False) -> awkward.Array:
+    """ Matches the taus to the reference objects they are linked to. Only
+    the links to selected reference objects within dR_max are followed, the
+    same distance limit as in the dR matching. When several taus are linked
+    to the same object, the conflict is resolved by the distance with the
+    chosen algorithm. The reference objects no tau is linked to are matched
+    by dR to the taus without such a link
+
+    Args:
+        links : awkward.Array
+            Index of the linked reference object for each tau, -1 if none
+        ref_eta, ref_phi : awkward.Array
+            Jagged pseudorapidities and azimuthal angles of the reference objects
+        tau_eta, tau_phi : awkward.Array
+            Jagged pseudorapidities and azimuthal angles of the taus
+        dR_max : float
+            Maximal angular separation of a matched pair, linked or not
+        ref_mask : awkward.Array
+            [default: None] Jagged mask of the reference objects to be matched
+        algorithm : str
+            [default: 'closest_first'] The matching algorithm, one of
+            matching_algorithms.ALGORITHMS
+        backend : str
+            [default: 'numpy'] One of kernels.BACKENDS
+        use_grid : bool
+            [default: False] Whether to use the eta-phi grid in the dR matching
+
+    Returns:
+        matched_tau_idx : awkward.Array
+            Per event index of the matched tau for each reference object,
+            -1 if none
+    """
+    ref_eta_flat, ref_counts = flatten_collection(ref_eta)
+    ref_phi_flat, _ = flatten_collection(ref_phi)
+    tau_eta_flat, tau_counts = flatten_collection(tau_eta)
+    tau_phi_flat, _ = flatten_collection(tau_phi)
+    links_flat = flatten_collection(links)[0]
+    if ref_mask is None:
+        ref_mask = awkward.ones_like(ref_eta, dtype=bool)
+    ref_mask_flat = flatten_collection(ref_mask)[0]
+    ref_offsets = np.cumsum(ref_counts) - ref_counts
+    tau_event = np.repeat(np.arange(len(tau_counts)), tau_counts)
+    tau_idx = np.flatnonzero(links_flat >= 0)
+    ref_idx = ref_offsets[tau_event[tau_idx]] + links_flat[tau_idx]
+    distances = deltaR(
+                    ref_eta_flat[ref_idx], ref_phi_flat[ref_idx],
+                    tau_eta_flat[tau_idx], tau_phi_flat[tau_idx])
+    followed = ref_mask_flat[ref_idx] & (distances <= dR_max)
+    ref_idx, tau_idx = ref_idx[followed], tau_idx[followed]
+    distances = distances[followed]
+    tau_linked = np.zeros(len(tau_eta_flat), dtype=bool)
+    tau_linked[tau_idx] = True
+    ref_linked = np.zeros(len(ref_eta_flat), dtype=bool)
+    ref_linked[ref_idx] = True
+    ref_event = np.repeat(np.arange(len(ref_counts)), ref_counts)
+    matched_tau_idx = ma.match_pairs(
+                            ref_idx, tau_idx, distances, len(ref_eta_flat),
+                            ref_event[ref_idx], algorithm, backend)
+    matched_by_index = to_local_index(matched_tau_idx, ref_counts, tau_counts)
+    matched_by_dR = match_collections(
+        ref_eta, ref_phi, tau_eta, tau_phi, dR_max,
+        awkward.unflatten(ref_mask_flat & ~ref_linked, ref_counts),
+        algorithm, backend, awkward.unflatten(~tau_linked, tau_counts),
+        use_grid)
+    return awkward.where(matched_by_index >= 0, matched_by_index, matched_by_dR)
+
+def count_disagreements(
+        matched_tau_idx: awkward.Array,
+        other_matched_tau_idx: awkward.Array,
+        ref_mask: awkward.Array) -> tuple[int, int]:
+    """ Counts the selected reference objects that are matched differently
+    by the two matchings
+
+    Args:
+        matched_tau_idx : awkward.Array
+            Index of the matched tau for each reference object, -1 if none
+        other_matched_tau_idx : awkward.Array
+            The same from the other matching
+        ref_mask : awkward.Array
+            Jagged mask of the reference objects to be compared
+
+    Returns:
+        n_disagreements : int
+            Number of objects with a different matched tau
+        n_objects : int
+            Number of selected objects
+    """
+    differs = (matched_tau_idx != other_matched_tau_idx) & ref_mask
+    return int(awkward.sum(differs)), int(awkward.sum(ref_mask))
+
+
+def match_taus_to_refs_columnar(
+        reference_obj_mask: awkward.Array,
+        events: awkward.Array,
+        ref_obj: str,
+        cfg: DictConfig) -> awkward.Array:
+    """ Columnar counterpart of match_taus_to_refs, matching all the events
+    at once with match_collections, or through the index branches with
+    match_by_index when matching.method is 'index'
+
+    Args:
+        reference_obj_mask : awkward.Array
+            Jagged mask of the reference objects to which to match
+        events: awkward.Array
+            All events with all the variables
+        ref_obj : str
+            The object comparison tau to match to.
+        cfg: omegaconf.DictConfig
+            The configuration. Branch names are inferred from that.
+
+    Returns:
+        matched_tau_idx : awkward.Array
+            Index of the matched tau for each reference object, -1 if none
+    """
+    kinematics = [
+        events[f"{ref_obj}_eta"], events[f"{ref_obj}_phi"],
+        events[f"{cfg.comparison_tau}_eta"], events[f"{cfg.comparison_tau}_phi"],
+        cfg.matching.dR_max, reference_obj_mask
+    ]
+    matched_by_dR = None
+    if cfg.matching.method == 'dR' or cfg.matching.report_disagreement:
+        matched_by_dR = match_collections(
+                *kinematics, cfg.matching.algorithm, cfg.production.backend,
+                use_grid=cfg.matching.spatial_index)
+    if cfg.matching.method == 'dR':
+        return matched_by_dR
+    if cfg.matching.method != 'index':
+        raise ValueError(f"Unknown matching method '{cfg.matching.method}'")
+    matched_by_index = match_by_index(
+                index_links(events, ref_obj, cfg), *kinematics,
+                cfg.matching.algorithm, cfg.production.backend,
+                cfg.matching.spatial_index)
+    if cfg.matching.report_disagreement:
+        n_disagreements, n_objects = count_disagreements(
+                        matched_by_index, matched_by_dR, reference_obj_mask)
+        print(f"Index and dR matching disagree for {n_disagreements} "
+              f"of {n_objects} {ref_obj} objects")
+    return matched_by_index
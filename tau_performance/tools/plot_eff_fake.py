@@ -41,6 +41,18 @@ def plot_efficiencies(efficiencies, eff_type, ref_obj, cfg):
                             cfg)
 
 
+def efficiency_errors(efficiency_histogram):
+    """ Distances of the interval bounds from the efficiency of each bin,
+    zero for the empty bins. None if the histogram has no interval """
+    if efficiency_histogram.interval is None:
+        return None
+    lower, upper = efficiency_histogram.interval
+    errors = np.stack([
+        efficiency_histogram.binned_data - lower,
+        upper - efficiency_histogram.binned_data])
+    return np.clip(np.nan_to_num(errors), 0, None)
+
+
 def plot_all_id_on_one(
         efficiencies, var_name, var_output_dir, eff_type, x_range, cfg, output_dir
 ):
@@ -49,8 +61,9 @@ def plot_all_id_on_one(
     hep.cms.label(f": {var_name}", data=False)
     for tau_id_key in efficiencies[var_name]:
         efficiency_histogram = efficiencies[var_name][tau_id_key]["Default"]
-        plt.plot(
+        plt.errorbar(
             efficiency_histogram.bin_centers, efficiency_histogram.binned_data,
+            yerr=efficiency_errors(efficiency_histogram),
             label=tau_id_key, marker="v", markersize=12, lw=3)
     plt.xlabel(var_name, fontdict={'size': 20})
     plt.ylabel(eff_type, fontdict={'size': 20})
@@ -86,7 +99,8 @@ def plot_efficiency(
         output_dir: str,
         eff_type: str,
         cfg: DictConfig) -> None:
-    """ Plots the efficiencies given histograms
+    """ Plots the efficiencies given histograms, with the confidence
+    intervals of the bins as error bars
 
     Args:
         efficiency_histograms : dict
@@ -107,8 +121,8 @@ def plot_efficiency(
     hep.style.use(hep.style.ROOT)
     hep.cms.label(f": {iso_tau_id}", data=False)
     for wp_key, entry in efficiency_histograms.items():
-        plt.plot(
-            entry.bin_centers, entry.binned_data,
+        plt.errorbar(
+            entry.bin_centers, entry.binned_data, yerr=efficiency_errors(entry),
             label=wp_key, marker="v", markersize=12, lw=3)
     plt.xlabel(var_name, fontdict={'size': 20})
     plt.ylabel(eff_type, fontdict={'size': 20})
@@ -5,6 +5,7 @@ import numpy as np
 from omegaconf import DictConfig, OmegaConf
 import mplhep as hep
 import matplotlib.pyplot as plt
+from . import general
 
 
 def plot_all_responses(energy_responses, ref_obj, sample_name, cfg):
@@ -19,9 +20,12 @@ def plot_response_per_id(id_responses, tau_id_key, sample_name, output_dir, ref_
     fig, ax = plt.subplots(figsize=(12,12))
     hep.style.use(hep.style.ROOT)
     hep.cms.label(f": {tau_id_key}", data=False)
-    for wp_key in id_responses:
-        n_bins = int(np.sqrt(len(id_responses[wp_key])))
-        histogram = np.histogram(id_responses[wp_key], bins=n_bins)
+    for wp_key, responses in id_responses.items():
+        if isinstance(responses, general.Histogram):
+            histogram = (responses.binned_data, responses.bin_edges)
+        else:
+            n_bins = int(np.sqrt(len(responses)))
+            histogram = np.histogram(responses, bins=n_bins)
         hep.histplot(
                         histogram, density=True,
                         label=wp_key, histtype='step')
@@ -0,0 +1,100 @@
+""" Eta-phi grid for finding the close pairs of objects of two large
+collections without comparing all the objects of an event with each other """
+import numpy as np
+
+
+def n_phi_cells(cell_size: float) -> int:
+    """ Number of cells the azimuthal angle is divided into, so that the
+    cells are at least cell_size wide """
+    return max(int(2*np.pi // cell_size), 1)
+
+
+def cell_coordinates(
+        eta: np.ndarray,
+        phi: np.ndarray,
+        cell_size: float) -> tuple[np.ndarray, np.ndarray]:
+    """ Finds the grid cell of each object. The phi cells wrap around at
+    +-pi
+
+    Args:
+        eta : numpy.ndarray
+            Flat pseudorapidities of the objects
+        phi : numpy.ndarray
+            Flat azimuthal angles of the objects
+        cell_size : float
+            Minimal width of the cells in eta and phi
+
+    Returns:
+        eta_cell : numpy.ndarray
+            Index of the eta cell of each object
+        phi_cell : numpy.ndarray
+            Index of the phi cell of each object
+    """
+    n_phi = n_phi_cells(cell_size)
+    eta_cell = np.floor(eta / cell_size).astype(np.int64)
+    phi_cell = np.floor(np.mod(phi + np.pi, 2*np.pi) / (2*np.pi / n_phi))
+    phi_cell = np.minimum(phi_cell.astype(np.int64), n_phi - 1)
+    return eta_cell, phi_cell
+
+
+def neighbour_pairs(
+        ref_eta: np.ndarray,
+        ref_phi: np.ndarray,
+        ref_counts: np.ndarray,
+        tau_eta: np.ndarray,
+        tau_phi: np.ndarray,
+        tau_counts: np.ndarray,
+        cell_size: float) -> tuple[np.ndarray, np.ndarray]:
+    """ Forms the pairs of reference objects and taus of the same event that
+    are in the same or in neighbouring grid cells. With cell_size equal to
+    the maximal angular separation, all the pairs within it are among those.
+    The taus are sorted by their cell once and the taus of each of the nine
+    cells around a reference object are looked up with a binary search
+
+    Args:
+        ref_eta, ref_phi : numpy.ndarray
+            Flat pseudorapidities and azimuthal angles of the reference objects
+        ref_counts : numpy.ndarray
+            Number of reference objects in each event
+        tau_eta, tau_phi : numpy.ndarray
+            Flat pseudorapidities and azimuthal angles of the taus
+        tau_counts : numpy.ndarray
+            Number of taus in each event
+        cell_size : float
+            Minimal width of the cells in eta and phi
+
+    Returns:
+        ref_idx : numpy.ndarray
+            Flat index of the reference object of each pair
+        tau_idx : numpy.ndarray
+            Flat index of the tau of each pair, ordered as the pairs of
+            particle_matching.form_candidate_pairs
+    """
+    if len(ref_eta) == 0 or len(tau_eta) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    n_phi = n_phi_cells(cell_size)
+    ref_eta_cell, ref_phi_cell = cell_coordinates(ref_eta, ref_phi, cell_size)
+    tau_eta_cell, tau_phi_cell = cell_coordinates(tau_eta, tau_phi, cell_size)
+    eta_min = min(ref_eta_cell.min(), tau_eta_cell.min()) - 1
+    n_eta = max(ref_eta_cell.max(), tau_eta_cell.max()) - eta_min + 2
+    ref_event = np.repeat(np.arange(len(ref_counts)), ref_counts)
+    tau_event = np.repeat(np.arange(len(tau_counts)), tau_counts)
+    tau_keys = (tau_event * n_eta + tau_eta_cell - eta_min) * n_phi + tau_phi_cell
+    tau_order = np.argsort(tau_keys, kind='stable')
+    sorted_keys = tau_keys[tau_order]
+    ref_indices = np.arange(len(ref_eta))
+    ref_idx, tau_idx = [], []
+    for eta_shift in [-1, 0, 1]:
+        for phi_shift in np.unique(np.mod([-1, 0, 1], n_phi)):
+            keys = ((ref_event * n_eta + ref_eta_cell - eta_min + eta_shift) * n_phi
+                    + np.mod(ref_phi_cell + phi_shift, n_phi))
+            starts = np.searchsorted(sorted_keys, keys, side='left')
+            counts = np.searchsorted(sorted_keys, keys, side='right') - starts
+            pair_offsets = np.cumsum(counts) - counts
+            positions = (np.arange(np.sum(counts)) - np.repeat(pair_offsets, counts)
+                         + np.repeat(starts, counts))
+            ref_idx.append(np.repeat(ref_indices, counts))
+            tau_idx.append(tau_order[positions])
+    ref_idx, tau_idx = np.concatenate(ref_idx), np.concatenate(tau_idx)
+    order = np.lexsort((tau_idx, ref_idx))
+    return ref_idx[order], tau_idx[order]
@@ -1,26 +1,124 @@
 import os
+import sys
 import uproot
 import awkward
 import numpy as np
 from omegaconf import DictConfig, OmegaConf
 from . import general
-from .masking import Masks
+from . import caching
+from . import masking
+from .masking import construct_cut_var_names, iterate_masks
 
 
 class Response:
-    def __init__(self, sample_name, ref_obj, cfg):
+    """ Energy response of the comparison taus passing each ID and working
+    point. The response histograms and summaries are accumulated over the
+    chunks of the ntuple when performance.step_size is set, in which case the
+    responses of the individual taus are not kept. Otherwise the whole ntuple
+    is loaded through the event store and the mask cache. The response
+    histograms and summaries are stored in the result cache and loaded from
+    there while the ntuple and the configuration are unchanged """
+    def __init__(self, sample_name, ref_obj, cfg, event_store=None, mask_cache=None):
         self.sample_name = sample_name
         self.ref_obj = ref_obj
         self.cfg = cfg
         self.eff_type = "eff" if self.ref_obj == cfg.genTau else "fake"
         self._response = {}
+        self._response_histos = {}
+        self._sums = {}
         self.input_path = self.infer_input_path()
-        self.events = general.load_events(
-                self.input_path,
-                cfg[f"TauID_{self.eff_type}"].data_files[self.sample_name].tree_path)
-        self.numerators = Masks(self.events, "numerators", ref_obj, cfg).masks
-        self.denominator = Masks(self.events, "denominators", ref_obj, cfg).masks
-        self.calculate_responses()
+        tree_path = cfg[f"TauID_{self.eff_type}"].data_files[self.sample_name].tree_path
+        self.streaming = cfg.performance.step_size is not None
+        bins_cfg = cfg.performance.response_bins
+        self.bins = np.linspace(bins_cfg.min, bins_cfg.max, bins_cfg.n_bins + 1)
+        self.numerators = masking.read_working_points(cfg, "numerators", ref_obj)
+        cache_path = caching.result_cache_path(
+                    cfg, f"response_{sample_name}_{ref_obj}",
+                    self.compute_result_key(tree_path))
+        if cache_path is not None and os.path.exists(cache_path):
+            print(f"Loading the cached responses from {cache_path}")
+            self.restore(*caching.load_arrays(cache_path))
+            return
+        self.initialize_results()
+        for events, numerator_masks, denominator_masks in iterate_masks(
+                        self.input_path, tree_path, self.construct_branch_names(),
+                        ref_obj, cfg, cfg.performance.step_size, event_store,
+                        mask_cache):
+            self.events = events
+            self.masks = numerator_masks.store
+            self.denominator = denominator_masks.store.packed('Base')
+            self.calculate_responses()
+            if self.streaming:
+                self.events = self.masks = self.denominator = None
+        if cache_path is not None:
+            caching.save_arrays(cache_path, *self.reduced_results())
+
+    def initialize_results(self):
+        """ Sets the response histograms and sums of all working points to
+        zero, so that an ntuple without entries gives empty results """
+        self.events = self.masks = self.denominator = None
+        for tau_id_key, wps in self.numerators.items():
+            self._response_histos[tau_id_key] = {
+                wp_key: general.Histogram(
+                    np.zeros(len(self.bins) - 1, dtype=np.int64), self.bins,
+                    "Response", binned=True)
+                for wp_key in wps}
+            self._sums[tau_id_key] = {wp_key: np.zeros(3) for wp_key in wps}
+
+    def compute_result_key(self, tree_path):
+        content = {
+            "tree": tree_path,
+            "ref_obj": self.ref_obj,
+            "comparison_tau": self.cfg.comparison_tau,
+            "genTau": self.cfg.genTau,
+            "TauID": OmegaConf.to_container(
+                        self.cfg[f"TauID_{self.eff_type}"], resolve=True),
+            "response_bins": OmegaConf.to_container(
+                        self.cfg.performance.response_bins, resolve=True),
+        }
+        return caching.compute_result_key(
+                    self.input_path, content,
+                    [general, masking, sys.modules[__name__]],
+                    self.cfg.production.cache.checksum)
+
+    def reduced_results(self):
+        """ The response histograms and sums as named arrays, with the
+        working points of each ID as metadata """
+        arrays = {}
+        for tau_id_key, id_histos in self._response_histos.items():
+            for wp_key, histogram in id_histos.items():
+                for name, value in histogram.to_dict().items():
+                    arrays[f"histogram::{tau_id_key}::{wp_key}::{name}"
+                           ] = np.asarray(value)
+                arrays[f"sums::{tau_id_key}::{wp_key}"] = self._sums[tau_id_key][wp_key]
+        metadata = {
+            "sample_name": self.sample_name,
+            "ref_obj": self.ref_obj,
+            "numerators": self.numerators,
+        }
+        return arrays, metadata
+
+    def restore(self, arrays, metadata):
+        """ Sets the response histograms and sums from reduced_results. The
+        responses of the individual taus are not stored """
+        self.numerators = metadata["numerators"]
+        self.events = self.masks = self.denominator = None
+        for tau_id_key, wps in self.numerators.items():
+            self._response_histos[tau_id_key] = {}
+            self._sums[tau_id_key] = {}
+            for wp_key in wps:
+                prefix = f"histogram::{tau_id_key}::{wp_key}::"
+                self._response_histos[tau_id_key][wp_key] = general.Histogram.from_dict({
+                    name[len(prefix):]: value for name, value in arrays.items()
+                    if name.startswith(prefix)})
+                self._sums[tau_id_key][wp_key] = arrays[f"sums::{tau_id_key}::{wp_key}"]
+
+    def construct_branch_names(self):
+        branches = [f"{self.ref_obj}_pt", f"{self.cfg.comparison_tau}_pt"]
+        for mask_type in ["numerators", "denominators"]:
+            branches.extend(
+                    construct_cut_var_names(self.cfg, mask_type, self.ref_obj))
+        return general.unique(branches)
 
     def infer_input_path(self):
         file_name = self.cfg[f"TauID_{self.eff_type}"].data_files[self.sample_name].path
@@ -30,29 +128,61 @@ class Response:
     def calculate_responses(self):
         ref_name = f"{self.ref_obj}_pt"
         comparison_name = f"{self.cfg.comparison_tau}_pt"
-        self._response = self.calculate_response_per_var(
-                                                  ref_name, comparison_name)
+        id_response = self.calculate_response_per_var(ref_name, comparison_name)
+        for tau_id_key, wp_responses in id_response.items():
+            for wp_key, responses in wp_responses.items():
+                self.accumulate(tau_id_key, wp_key, responses)
+        if not self.streaming:
+            self._response = id_response
 
     def calculate_response_per_var(self, ref_name, comparison_name):
         id_response = {}
         for tau_id_key in self.numerators:
-            full_id_key = f"{self.cfg.comparison_tau}_{tau_id_key}"
-            wp_numerators = self.numerators[tau_id_key]
             id_response[tau_id_key] = self.calculate_wp_responses(
-                                    ref_name, comparison_name, wp_numerators)
+                                    ref_name, comparison_name, tau_id_key)
         return id_response
 
-    def calculate_wp_responses(self, ref_name, comparison_name, wp_numerators):
+    def calculate_wp_responses(self, ref_name, comparison_name, tau_id_key):
         wp_responses = {}
         all_ref_entries = self.events[ref_name]
         all_comparison_entries = self.events[comparison_name]
-        for wp_numerator_key in wp_numerators:
-            full_mask = self.denominator & wp_numerators[wp_numerator_key]
+        for wp_numerator_key in self.numerators[tau_id_key]:
+            full_mask = self.masks.unpack(self.masks.logical_and(
+                            (tau_id_key, wp_numerator_key), self.denominator))
             ref_entries = np.array(all_ref_entries[full_mask])
             comparison_entries = np.array(all_comparison_entries[full_mask])
             wp_responses[wp_numerator_key] = comparison_entries/ref_entries
         return wp_responses
 
+    def accumulate(self, tau_id_key, wp_key, responses):
+        """ Adds the responses to the histogram and to the sums the summary
+        is calculated from """
+        histogram = general.Histogram(
+                        responses, self.bins, "Response", keep_data=False)
+        sums = np.array([len(responses), np.sum(responses), np.sum(responses**2)])
+        self._response_histos[tau_id_key][wp_key] += histogram
+        self._sums[tau_id_key][wp_key] += sums
+
     @property
     def energy_response(self):
+        """ Responses of the individual taus. Not kept when accumulating
+        over chunks or loading from the result cache """
         return self._response
+
+    @property
+    def response_histograms(self):
+        return self._response_histos
+
+    @property
+    def response_summaries(self):
+        """ Number of taus, mean and standard deviation of the response of
+        each ID and working point """
+        summaries = {}
+        for tau_id_key, id_sums in self._sums.items():
+            summaries[tau_id_key] = {}
+            for wp_key, (n, sum_, sum_squared) in id_sums.items():
+                mean = sum_ / n if n > 0 else np.nan
+                variance = max(sum_squared / n - mean**2, 0.0) if n > 0 else np.nan
+                summaries[tau_id_key][wp_key] = {
+                    "n": int(n), "mean": mean, "std": np.sqrt(variance)}
+        return summaries
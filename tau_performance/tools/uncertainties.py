@@ -0,0 +1,120 @@
+""" Confidence intervals of efficiencies, computed for arrays of any shape at
+once, e.g. for all the bins of all working points """
+from statistics import NormalDist
+import numpy as np
+
+INTERVALS = ['clopper_pearson', 'wilson']
+
+
+def effective_counts(
+        passed: np.ndarray,
+        total: np.ndarray,
+        total_sumw2: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+    """ Converts weighted counts into the effective number of entries of the
+    total (sum of weights squared over sum of squared weights), keeping the
+    efficiency. Unweighted counts (sum of squared weights equal to the
+    counts) are returned as they are
+
+    Args:
+        passed : numpy.ndarray
+            (Sum of weights of the) entries passing the selection
+        total : numpy.ndarray
+            (Sum of weights of) all the entries
+        total_sumw2 : numpy.ndarray
+            [default: None] Sum of squared weights of all the entries
+
+    Returns:
+        passed : numpy.ndarray
+            Effective number of passing entries
+        total : numpy.ndarray
+            Effective number of entries
+    """
+    passed = np.asarray(passed, dtype=float)
+    total = np.asarray(total, dtype=float)
+    if total_sumw2 is None:
+        return passed, total
+    total_sumw2 = np.asarray(total_sumw2, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        efficiency = passed / total
+        n_effective = np.where(total_sumw2 > 0, np.square(total) / total_sumw2, 0.0)
+    unweighted = total_sumw2 == total
+    return (
+        np.where(unweighted, passed, np.nan_to_num(efficiency) * n_effective),
+        np.where(unweighted, total, n_effective))
+
+
+def clopper_pearson(
+        passed: np.ndarray,
+        total: np.ndarray,
+        confidence: float) -> tuple[np.ndarray, np.ndarray]:
+    """ Exact binomial interval from the quantiles of the beta distribution.
+    NaN where there are no entries """
+    try:
+        from scipy.stats import beta
+    except ImportError as error:
+        raise ImportError(
+            "The 'clopper_pearson' interval requires scipy") from error
+    alpha = 1 - confidence
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lower = beta.ppf(alpha / 2, passed, total - passed + 1)
+        upper = beta.ppf(1 - alpha / 2, passed + 1, total - passed)
+    lower = np.where(passed <= 0, 0.0, lower)
+    upper = np.where(passed >= total, 1.0, upper)
+    empty = total <= 0
+    return np.where(empty, np.nan, lower), np.where(empty, np.nan, upper)
+
+
+def wilson(
+        passed: np.ndarray,
+        total: np.ndarray,
+        confidence: float) -> tuple[np.ndarray, np.ndarray]:
+    """ Wilson score interval. NaN where there are no entries """
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        efficiency = passed / total
+        denominator = 1 + z**2 / total
+        center = (efficiency + z**2 / (2 * total)) / denominator
+        half_width = z / denominator * np.sqrt(
+            np.clip(efficiency * (1 - efficiency), 0, None) / total
+            + z**2 / (4 * np.square(total)))
+    return center - half_width, center + half_width
+
+
+def efficiency_intervals(
+        passed: np.ndarray,
+        total: np.ndarray,
+        total_sumw2: np.ndarray = None,
+        method: str = 'clopper_pearson',
+        confidence: float = 0.682689492137) -> tuple[np.ndarray, np.ndarray]:
+    """ Lower and upper bounds of the efficiencies passed/total. The counts
+    can have any shape, the total being broadcast against the passing
+    counts. With the sum of squared weights of the total given, the
+    intervals of weighted counts are computed from the effective number of
+    entries
+
+    Args:
+        passed : numpy.ndarray
+            (Sum of weights of the) entries passing the selection
+        total : numpy.ndarray
+            (Sum of weights of) all the entries
+        total_sumw2 : numpy.ndarray
+            [default: None] Sum of squared weights of all the entries
+        method : str
+            [default: 'clopper_pearson'] One of INTERVALS
+        confidence : float
+            [default: 0.682689492137] Confidence level of the interval
+
+    Returns:
+        lower : numpy.ndarray
+            Lower bounds of the efficiencies, NaN where there are no entries
+        upper : numpy.ndarray
+            Upper bounds of the efficiencies, NaN where there are no entries
+    """
+    if method not in INTERVALS:
+        raise ValueError(
+            f"Unknown efficiency interval '{method}', expected one of {INTERVALS}")
+    passed, total = effective_counts(passed, total, total_sumw2)
+    passed, total = np.broadcast_arrays(passed, total)
+    if method == 'clopper_pearson':
+        return clopper_pearson(passed, total, confidence)
+    return wilson(passed, total, confidence)